@@ -6,6 +6,7 @@ from kivy.uix.popup import Popup
 from kivy.uix.label import Label
 from kivy.properties import ObjectProperty
 from kivy.uix.screenmanager import ScreenManager, Screen
+from kivy.clock import Clock
 
 import asyncio
 from agent import Agent
@@ -17,7 +18,6 @@ from modules.proof import Proof
 from credential_page import CredentialPage, CredentialView
 from pending_connection import PendingConnection
 from pairwise_connection import PairwiseConnection
-import socket_client
 
 
 class LoginWindow(Screen):
@@ -254,11 +254,16 @@ class ConnectServer(Screen):
         When clicking on connect button, it will try t connect to the server with the IP and port number entered.
         """
         print("start server")
-        port = int(self.port.text)
+        # a unix:///path address needs no port
+        port = int(self.port.text) if self.port.text else None
         ip = self.ip.text
         username = self.agent.text
 
-        if not socket_client.connect(ip, port, username, show_error):
+        try:
+            # connection lives on the agent's event loop, which run_loop keeps running
+            LOOP.run_until_complete(AGENT.connect_server(ip, port, username, show_error))
+        except OSError as e:
+            show_error('Connection error: {}'.format(str(e)))
             print("not connected")
             self.connected.text = "Not connected"
         else:
@@ -266,15 +271,17 @@ class ConnectServer(Screen):
             self.connected.text = "Connected"
             self.ip.text = ""
             self.port.text = ""
-            socket_client.start_listening(self.incoming_message, show_error)
+            LOOP.create_task(AGENT.handle_messages(self.incoming_message))
 
-    def incoming_message(self, username, message):
+    async def incoming_message(self, username, message):
         '''
         Function listens for incoming messages being sent. It checks what type of message it is in order
         to follow the correct function.
         '''
-        print(f'\n\n{username}:   {message}')
-        msg = LOOP.run_until_complete(AGENT.read_msg(message))      # message read
+        print(f'\n\n{username}:   {len(message)} bytes')
+        msg = await AGENT.read_msg(message)      # message read
+        if msg is None:
+            return      # not for us, or could not be unpacked
         print("\nMESSAGE: ", msg)
         print("MSG TYPE: ", msg.type)
         type = msg.type                 # type of message
@@ -282,21 +289,21 @@ class ConnectServer(Screen):
         print("SENDTO: ", sendTo)
         print("agent: ", AGENT.owner)
         if type == "SEND_REQUEST" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(CONNECTION.request_recieved(msg))
+            await CONNECTION.request_recieved(msg)
         elif type == "SEND_RESPONSE" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(CONNECTION.response_recieved(msg))
+            await CONNECTION.response_recieved(msg)
         elif type == "credential_offer" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(CREDENTIAL.credential_offer(msg))
+            await CREDENTIAL.credential_offer(msg)
         elif type == "credential_request" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(CREDENTIAL.credential_request(msg))
+            await CREDENTIAL.credential_request(msg)
         elif type == "credential" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(CREDENTIAL.credential_received(msg))
+            await CREDENTIAL.credential_received(msg)
         elif type == "proof_offer" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(PROOF.proof_offer(msg))
+            await PROOF.proof_offer(msg)
         elif type == "proof_request" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(PROOF.proof_request(msg))
+            await PROOF.proof_request(msg)
         elif type == "proof" and sendTo == AGENT.owner:
-            LOOP.run_until_complete(PROOF.proof_received(msg))
+            await PROOF.proof_received(msg)
         else:
             print("other request: ", msg)
 
@@ -480,11 +487,20 @@ def show_error(message):
     print(message)
 
 
+def run_loop(dt):
+    '''
+    Let the agent's event loop run between UI events, so the server connection and the handling of
+    received messages make progress on this thread
+    '''
+    LOOP.run_until_complete(asyncio.sleep(0))
+
+
 if __name__ == "__main__":
     LOOP = asyncio.get_event_loop()
     global AGENT, CONNECTION
     AGENT = None
     CONNECTION = None
+    Clock.schedule_interval(run_loop, 0.02)
     try:
         LOOP.create_task(MyMainApp().run())  # start app
     except KeyboardInterrupt:
@@ -1,9 +1,11 @@
 import json
 import base64
 import asyncio
+import collections
 import time
 import struct
-import socket_client
+import framing
+from transport import Transport
 from indy import wallet, did, error, crypto, pairwise, pool, anoncreds
 from indy_sdk_utils import get_wallet_records
 from message import Message
@@ -11,6 +13,8 @@ import serializer.json_serializer as Serializer
 import indy_sdk_utils as utils
 from indy.error import IndyError
 
+MESSAGE_CONCURRENCY = 8     # received messages of different pairwise relationships handled at the same time
+
 
 class WalletConnectionException(Exception):
     pass
@@ -30,10 +34,17 @@ class Agent:
         self.owner = None
         self.wallet_handle = None
         self.endpoint_vk = None
+        self.verkeys = set()        # verkeys this agent receives messages for, registered with the server
+        self.transport = None       # Transport to the server on this agent's event loop, None until connected
+        self.stream = None          # stream id on transport when it is shared with other agents, see host_on_connection
+        self.dispatching = False    # handle_messages is running
         self.initialized = False
         self.invitations = None
         self.pairwise_connections = None
         self.message_queue = asyncio.Queue()
+        self.message_stats = {      # messages passed to read_msg, see there
+            'received': 0, 'foreign_skipped': 0, 'unpacked': 0, 'unpack_failed': 0,
+        }
         self.outbound_admin_message_queue = asyncio.Queue()
         self.modules = {}
 
@@ -118,6 +129,103 @@ class Agent:
         '''
         return self.got_consent_credential
 
+    async def get_verkeys(self):
+        '''
+        :return: all verkeys of this wallet that messages can be packed for
+        '''
+        if self.initialized:
+            self.verkeys = await utils.get_my_verkeys(self.wallet_handle)
+        return self.verkeys
+
+    def add_verkey(self, verkey):
+        '''
+        Remember a newly created verkey and register it with the server so messages for it are routed here
+        '''
+        if verkey not in self.verkeys:
+            self.verkeys.add(verkey)
+            if self.transport is not None:
+                self.transport.register([verkey], self.stream)
+
+    async def connect_server(self, ip, port, username, error_callback):
+        '''
+        Connect to the server on this event loop and register our verkeys. Received messages are put on
+        message_queue, see handle_messages. A connection made before is closed once the new one is up;
+        if connecting fails (OSError), it is kept.
+        '''
+        transport = Transport(self.message_queue, error_callback)
+        await transport.connect(ip, port, username, role=self.type.lower())
+        if self.transport is not None and self.stream is None:
+            await self.transport.close()
+        self.transport = transport
+        self.stream = None
+        self.transport.register(list(await self.get_verkeys()))
+
+    async def handle_messages(self, handler, concurrency=MESSAGE_CONCURRENCY):
+        '''
+        Pass the messages put on message_queue to handler(username, message). Messages of different
+        pairwise relationships are handled concurrently, up to concurrency at a time, so a credential
+        being issued to one agent does not hold up the handshakes of others. Messages of one relationship
+        (packed for the same verkey of ours, which covers every thread in it) are handled one at a time,
+        in the order they arrived. Returns right away if it is already running for this agent, as a second
+        one would break that order.
+        '''
+        if self.dispatching:
+            return
+        self.dispatching = True
+        slots = asyncio.Semaphore(concurrency)
+        waiting = {}    # order key -> deque of (username, message) behind the one being handled
+        try:
+            while True:
+                username, message = await self.message_queue.get()
+                key = self.message_order_key(username, message)
+                if key in waiting:
+                    waiting[key].append((username, message))
+                    continue
+                waiting[key] = collections.deque()
+                await slots.acquire()
+                asyncio.get_running_loop().create_task(
+                    self._handle_in_order(handler, key, username, message, waiting, slots))
+        finally:
+            self.dispatching = False
+
+    async def _handle_in_order(self, handler, key, username, message, waiting, slots):
+        '''
+        Handle a message and then the ones that arrived for the same key meanwhile
+        '''
+        try:
+            while True:
+                try:
+                    await handler(username, message)
+                except Exception as e:
+                    print("Failed to handle message from {}: {}".format(username, e))
+                if not waiting[key]:
+                    del waiting[key]
+                    return
+                username, message = waiting[key].popleft()
+        finally:
+            slots.release()
+
+    def message_order_key(self, username, message):
+        '''
+        Messages with the same key are handled in order: a packed message's recipient verkeys, which are
+        ours for one pairwise relationship (or the connection key of an invitation), otherwise the sender
+        '''
+        kids = framing.recipient_kids(message)
+        if kids:
+            return tuple(sorted(kids))
+        return username
+
+    async def host_on_connection(self, transport):
+        '''
+        Share the server connection (a connected Transport) with the other agents hosted in this process:
+        open a stream for this agent and register its verkeys on it. Messages for them are put on this
+        agent's message_queue, see handle_messages.
+        '''
+        name = await self.get_agent_name()
+        self.stream = transport.open_stream(name, self.message_queue, self.type.lower())
+        self.transport = transport
+        self.transport.register(list(await self.get_verkeys()), self.stream)
+
     async def get_pairwise_connections(self):
         '''
         Get the connections that already exist for that user.
@@ -192,15 +300,18 @@ class Agent:
 
     async def unpack_agent_message(self, wire_msg_bytes):
         '''
-        Message passed is unpacked as bytes and returned
+        Message passed is unpacked as bytes and returned. Bytes as received from the server are passed
+        to the wallet as they are, anything else is converted once.
         '''
         print("\nUnpack agent message")
         if isinstance(wire_msg_bytes, str):
-            wire_msg_bytes = bytes(wire_msg_bytes, 'utf-8')
+            wire_msg_bytes = wire_msg_bytes.encode('utf-8')
+        elif not isinstance(wire_msg_bytes, bytes):
+            wire_msg_bytes = bytes(wire_msg_bytes)      # bytearray, memoryview
         unpacked = json.loads(
             await crypto.unpack_message(
                 self.wallet_handle,
-                bytes(wire_msg_bytes)
+                wire_msg_bytes
             )
         )
         print("UNPACKED: ", unpacked)
@@ -226,9 +337,9 @@ class Agent:
         print("Message context: ", msg.context)
         return msg
 
-    async def send_message_to_agent(self, to_did, msg:Message):
+    async def send_message_to_agent(self, to_did, msg:Message, lane=None):
         '''
-        Pairwise information is retrieved and message is sent to user
+        Pairwise information is retrieved and message is sent to user, in the given transport lane
         '''
         print("\nSending message to agent:", msg)
         their_did = to_did
@@ -240,11 +351,13 @@ class Agent:
         their_vk = pairwise_meta['their_vk']
         my_vk = await did.key_for_local_did(self.wallet_handle, my_did)
 
-        await self.send_message_to_endpoint_and_key(my_vk, their_vk, msg)
+        return await self.send_message_to_endpoint_and_key(my_vk, their_vk, msg, lane)
 
-    async def send_message_to_endpoint_and_key(self, my_ver_key, their_ver_key, msg):
+    async def send_message_to_endpoint_and_key(self, my_ver_key, their_ver_key, msg, lane=None):
         '''
-        Message is encrypted and sent to the other user through the server
+        Message is encrypted and sent to the other user through the server. Returns a future set once
+        the message is written to the server connection; while the connection is down it is kept and
+        sent after reconnecting. Raises ConnectionError if connect_server was never called.
         '''
         print("\nSend message to end and key")
         print(my_ver_key, their_ver_key, msg)
@@ -256,26 +369,40 @@ class Agent:
             my_ver_key
         )
         print("wire:", wire_message)
-        socket_client.send(wire_message)
+        if self.transport is None:
+            raise ConnectionError('Not connected to the server')
+        written = await self.transport.send(wire_message, lane, self.stream)
         print("SEND MESSAGE")
+        return written
 
     async def read_msg(self, wire_msg):
         '''
-        Message is unpacked depending on how its encrypted and returned unpacked
+        Message is unpacked depending on how its encrypted and returned unpacked. A packed message
+        whose recipients are none of our verkeys is skipped (None is returned) without calling the
+        wallet, only its protected header is read.
         '''
-        print("read wire msg: ", wire_msg)
+        self.message_stats['received'] += 1
+        kids = framing.recipient_kids(wire_msg)
+        if kids is not None and self.verkeys and self.verkeys.isdisjoint(kids):
+            # the server sent us someone else's message
+            self.message_stats['foreign_skipped'] += 1
+            return None
+        print("read wire msg: {} bytes".format(len(wire_msg)))     # not the message, printing it copies it
         msg = ""
-        try:
-            msg = Serializer.unpack(wire_msg)
-        except Exception as e:
-            print("Message encrypted, trying to unpack", e)
+        if kids is None:
+            try:
+                msg = Serializer.unpack(wire_msg)
+            except Exception as e:
+                print("Message encrypted, trying to unpack", e)
 
         if not isinstance(msg, Message) or "@type" not in msg:
             try:
                 msg = await self.unpack_agent_message(wire_msg)
                 print("msg unpack: ", msg)
+                self.message_stats['unpacked'] += 1
                 return msg
             except Exception as e:
+                self.message_stats['unpack_failed'] += 1
                 print("Failed to unpack messgae", e)
 
     async def delete_wallet(self, agent_name, passphrase):
@@ -0,0 +1,4 @@
+""" Benchmarks for the relay server and the client transport.
+
+    Run from the repository root, e.g. ``python -m benchmarks.relay_load --spawn``.
+"""
@@ -0,0 +1,127 @@
+""" Allocations of the client receive path, from the socket to crypto.unpack_message.
+
+    A small in-process server answers the v2 handshake and writes packed-message sized frames to a
+    Transport connected with Transport.connect. Every message the transport queues is passed to
+    Agent.read_msg, logging and the recipient pre-filter included, with crypto.unpack_message replaced
+    by a stand-in that like the indy wrapper only takes bytes and ends the path there (read_msg counts
+    it as a failed unpack). ConnectServer.incoming_message is not driven, it needs kivy.
+
+    Compares the current path, which passes the received bytes straight through, with a message
+    decoded to str first as the client used to, which read_msg has to encode again.
+
+    Reports the memory allocated per message from the queue to the wallet call, and the time per
+    message including the receive loop. Reading a frame from the socket makes one copy of the message
+    on either path, which is not counted. agent.py imports indy, so python3-indy has to be installed.
+    Run from the repository root, e.g.:
+        python -m benchmarks.receive_path --sizes 2000,48000,1000000 --messages 200
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+
+import agent
+import framing
+from transport import Transport
+
+
+class Unpacked(Exception):
+    '''
+    Raised by the unpack_message stand-in once the message reached the wallet call
+    '''
+
+
+async def unpack_message(wallet_handle, wire_msg):
+    '''
+    Stand-in for crypto.unpack_message: the wallet only takes bytes
+    '''
+    if not isinstance(wire_msg, bytes):
+        raise TypeError('unpack_message needs bytes')
+    raise Unpacked()
+
+
+def packed_message(size):
+    protected = base64.urlsafe_b64encode(json.dumps({'recipients': [{'header': {'kid': 'K'}}]}).encode('utf-8'))
+    return b'{"protected":"' + protected + b'","ciphertext":"' + b'A' * max(size - 100, 0) + b'"}'
+
+
+async def serve(messages, frame, served, reader, writer):
+    '''
+    Answer the v2 handshake without a session, then write messages copies of frame. served is set once
+    the client has closed the connection.
+    '''
+    await reader.readexactly(len(framing.V2_MAGIC))
+    length, _, _ = framing.V2_HEADER.unpack(await reader.readexactly(framing.V2_HEADER.size))
+    await reader.readexactly(length)
+    writer.write(framing.encode_v2_frame(framing.WELCOME, json.dumps({'session': None}).encode('utf-8'), 1))
+    for _ in range(messages):
+        writer.write(frame)
+        await writer.drain()
+    await reader.read()     # until the client closes
+    writer.close()
+    served.set_result(None)
+
+
+def run(size, messages, decode):
+    '''
+    Receive messages frames of size bytes and read them with Agent.read_msg, decoded to str first if
+    decode. Returns (mean bytes allocated, seconds) per message.
+    '''
+    frame = framing.encode_v2_frame(framing.DATA, packed_message(size))
+    recipient = agent.Agent('patient')
+    recipient.verkeys = {'K'}
+    allocated = []
+
+    async def receive():
+        served = asyncio.get_running_loop().create_future()
+        server = await asyncio.start_server(lambda r, w: serve(messages, frame, served, r, w), '127.0.0.1', 0)
+        queue = asyncio.Queue()
+        transport = Transport(queue, print, heartbeat_interval=0)
+        await transport.connect('127.0.0.1', server.sockets[0].getsockname()[1], 'bench')
+        for _ in range(messages):
+            _, message = await queue.get()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await recipient.read_msg(message.decode('utf-8') if decode else message)
+            allocated.append(tracemalloc.get_traced_memory()[1] - before)
+        await transport.close()
+        await served
+        server.close()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(receive())
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    assert recipient.message_stats['unpack_failed'] == messages, recipient.message_stats
+    return sum(allocated) / len(allocated), elapsed / messages
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the allocations of the client receive path.')
+    parser.add_argument('--sizes', default='2000,48000,1000000', help='comma separated message sizes in bytes')
+    parser.add_argument('--messages', type=int, default=200, help='messages received per size and path')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    agent.crypto.unpack_message = unpack_message
+    print('{:>10} {:>8} {:>14} {:>12}'.format('size', 'path', 'bytes/message', 'us/message'))
+    for size in (int(size) for size in args.sizes.split(',')):
+        results = {}
+        for name, decode in (('str', True), ('bytes', False)):
+            results[name] = run(size, args.messages, decode)
+            allocated, seconds = results[name]
+            print('{:>10} {:>8} {:>14.0f} {:>12.1f}'.format(size, name, allocated, seconds * 1e6))
+        saved = results['str'][0] - results['bytes'][0]
+        print('{:>10} {:>8} {:>14.0f} ({:.1f} copies of the message)'.format(size, 'saved', saved, saved / size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+""" Load generator for the relay server.
+
+    Starts N simulated agents that speak the client protocol (username handshake, optional
+    v2 negotiation, verkey registration) and send packed-message shaped frames to each other at a
+    controlled rate. Frame sizes follow a mix modelled on the agent protocols: small connection
+    requests and responses, and large credential offers / credentials carrying a full cred_def.
+
+    Reports throughput, end-to-end latency percentiles and the relay's CPU time and RSS (Linux, read
+    from /proc for the relay pid and its worker processes).
+
+    Run from the repository root, e.g.:
+        python -m benchmarks.relay_load --clients 200 --rate 5 --duration 30 --spawn
+        python -m benchmarks.relay_load --port 1234 --relay-pid 4242 --json results.json
+        python -m benchmarks.relay_load --spawn --unix /tmp/relay.sock
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import framing
+
+_padding = ''    # base64 of random bytes, compresses like a real ciphertext
+
+# (payload bytes, weight): connection request/response, credential request, credential offer / credential
+DEFAULT_SIZES = '1800:0.5,6000:0.2,24000:0.2,48000:0.1'
+
+
+def parse_sizes(spec):
+    sizes = []
+    for item in spec.split(','):
+        size, weight = item.split(':')
+        sizes.append((int(size), float(weight)))
+    return sizes
+
+
+def padding(length):
+    global _padding
+    if len(_padding) < length:
+        _padding = base64.urlsafe_b64encode(os.urandom(length)).decode('ascii')
+    return _padding[:length]
+
+
+def envelope(kid, size, seq, sent_at):
+    '''
+    Frame shaped like a crypto.pack_message envelope addressed to kid, padded to about size bytes. The
+    send time and sequence number ride in a plain "bench" field so the receiver can time it.
+    '''
+    protected = base64.urlsafe_b64encode(json.dumps({
+        'enc': 'xchacha20poly1305_ietf',
+        'typ': 'JWM/1.0',
+        'alg': 'Authcrypt',
+        'recipients': [{'encrypted_key': 'A' * 64, 'header': {'kid': kid, 'sender': 'B' * 96, 'iv': 'C' * 32}}],
+    }).encode('utf-8')).decode('ascii')
+    head = '{{"protected":"{}","iv":"D5ItJ0WTdsFj0bGz","bench":"{:.9f},{}","ciphertext":"'.format(
+        protected, sent_at, seq)
+    tail = '","tag":"Fsno8ihcnNQYnGsPCLsjvA=="}'
+    return (head + padding(max(0, size - len(head) - len(tail))) + tail).encode('utf-8')
+
+
+def bench_field(payload):
+    start = payload.find(b'"bench":"')
+    if start < 0:
+        return None
+    start += len(b'"bench":"')
+    end = payload.find(b'"', start)
+    sent_at, seq = payload[start:end].split(b',')
+    return float(sent_at), int(seq)
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.wire_bytes_out = 0     # sent payload bytes after compression
+        self.latencies = []
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class SimulatedAgent:
+    '''
+    One agent connection: handshake, registration, a reader task and a paced sender task
+    '''
+    def __init__(self, index, args, stats, sizes):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.sizes = sizes
+        self.verkey = 'BenchKey{:06d}'.format(index)
+        self.reader = None
+        self.writer = None
+        self.version = args.protocol
+        self.codec = None
+
+    async def connect(self):
+        if self.args.unix:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.args.unix)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.args.ip, self.args.port)
+        username = 'bench-{}'.format(self.index)
+        if self.version == 2:
+            hello = {'username': username}
+            if self.args.compression:
+                hello['compression'] = [self.args.compression]
+            hello = json.dumps(hello).encode('utf-8')
+            self.writer.write(framing.V2_MAGIC + framing.encode_v2_frame(framing.HELLO, hello))
+            length, frame_type, _ = framing.V2_HEADER.unpack(await self.reader.readexactly(framing.V2_HEADER.size))
+            welcome = json.loads(await self.reader.readexactly(length))
+            if frame_type != framing.WELCOME:
+                raise RuntimeError('relay did not accept protocol v2')
+            if welcome.get('compression') == self.args.compression and self.args.compression:
+                self.codec = framing.CODECS[self.args.compression]()
+            self.send_frame(framing.encode_control(framing.REGISTER, verkeys=[self.verkey]), framing.CONTROL)
+        else:
+            self.writer.write(framing.encode_frame(username.encode('utf-8')))
+            self.send_frame(framing.encode_control(framing.REGISTER, verkeys=[self.verkey]))
+        await self.writer.drain()
+
+    def send_frame(self, payload, frame_type=framing.DATA):
+        if frame_type == framing.DATA:
+            if self.codec is not None and len(payload) >= framing.COMPRESS_MIN_BYTES:
+                compressed = self.codec.compress(payload)
+                if len(compressed) < len(payload):
+                    payload = compressed
+                    frame_type |= framing.COMPRESSED
+            self.stats.wire_bytes_out += len(payload)
+        if self.version == 2:
+            self.writer.writelines([framing.encode_v2_header(frame_type, len(payload)), payload])
+        else:
+            self.writer.writelines([framing.encode_header(len(payload)), payload])
+
+    async def read_frame(self):
+        if self.version == 2:
+            while True:
+                length, frame_type, _ = framing.V2_HEADER.unpack(await self.reader.readexactly(framing.V2_HEADER.size))
+                payload = await self.reader.readexactly(length)
+                if frame_type == framing.DATA | framing.COMPRESSED:
+                    return self.codec.decompress(payload, framing.MAX_FRAME_BYTES)
+                if frame_type == framing.DATA:
+                    return payload
+        username_length = framing.decode_header(await self.reader.readexactly(framing.HEADER_LENGTH))
+        await self.reader.readexactly(username_length)
+        length = framing.decode_header(await self.reader.readexactly(framing.HEADER_LENGTH))
+        return await self.reader.readexactly(length)
+
+    async def receive(self):
+        try:
+            while True:
+                payload = await self.read_frame()
+                received_at = time.monotonic()
+                field = bench_field(payload)
+                self.stats.received += 1
+                self.stats.received_bytes += len(payload)
+                if field is not None:
+                    self.stats.latencies.append(received_at - field[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def send(self, deadline):
+        '''
+        Send to random peers at args.rate messages per second until deadline
+        '''
+        sizes, weights = zip(*self.sizes)
+        interval = 1.0 / self.args.rate
+        next_send = time.monotonic() + random.random() * interval
+        seq = 0
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                return
+            if next_send > now:
+                await asyncio.sleep(next_send - now)
+            peer = random.randrange(self.args.clients - 1)
+            if peer >= self.index:
+                peer += 1
+            size = random.choices(sizes, weights)[0]
+            payload = envelope('BenchKey{:06d}'.format(peer), size, seq, time.monotonic())
+            self.send_frame(payload)
+            await self.writer.drain()
+            self.stats.sent += 1
+            self.stats.sent_bytes += len(payload)
+            seq += 1
+            next_send += interval
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def process_tree(pid):
+    '''
+    pid and its descendants, so a relay running with --workers is measured as a whole
+    '''
+    pids = [pid]
+    for child in subprocess.run(['pgrep', '-P', str(pid)], capture_output=True, text=True).stdout.split():
+        pids += process_tree(int(child))
+    return pids
+
+
+def cpu_seconds(pids):
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0.0
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks     # utime + stime
+        except (OSError, IndexError):
+            pass
+    return total
+
+
+def rss_kb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+async def run(args):
+    stats = Stats()
+    sizes = parse_sizes(args.sizes)
+    agents = [SimulatedAgent(index, args, stats, sizes) for index in range(args.clients)]
+
+    # connect in batches so the listen backlog does not overflow
+    for start in range(0, len(agents), 100):
+        await asyncio.gather(*(agent.connect() for agent in agents[start:start + 100]))
+    readers = [asyncio.ensure_future(agent.receive()) for agent in agents]
+    await asyncio.sleep(args.warmup)
+
+    pids = process_tree(args.relay_pid) if args.relay_pid else []
+    cpu_start = cpu_seconds(pids)
+    started = time.monotonic()
+    await asyncio.gather(*(agent.send(started + args.duration) for agent in agents))
+    sent_done = time.monotonic()
+
+    # wait for messages still in flight
+    while stats.received < stats.sent and time.monotonic() - sent_done < args.drain_timeout:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    cpu_used = cpu_seconds(pids) - cpu_start
+    rss = rss_kb(pids)
+
+    for agent in agents:
+        agent.close()
+    for reader in readers:
+        reader.cancel()
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'clients': args.clients,
+        'protocol': args.protocol,
+        'rate_per_client': args.rate,
+        'duration': round(elapsed, 3),
+        'sent': stats.sent,
+        'received': stats.received,
+        'lost': stats.sent - stats.received,
+        'throughput_msgs': round(stats.received / elapsed, 1),
+        'throughput_mb': round(stats.received_bytes / elapsed / 1e6, 3),
+        'sent_wire_ratio': round(stats.wire_bytes_out / stats.sent_bytes, 3) if stats.sent_bytes else None,
+        'latency_p50_ms': ms(stats.percentile(0.5)),
+        'latency_p99_ms': ms(stats.percentile(0.99)),
+        'latency_p999_ms': ms(stats.percentile(0.999)),
+        'relay_cpu_seconds': round(cpu_used, 3) if pids else None,
+        'relay_cpu_percent': round(100 * cpu_used / elapsed, 1) if pids else None,
+        'relay_rss_kb': rss if pids else None,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the relay server.')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--unix', default=None, metavar='PATH',
+                        help='connect over this Unix domain socket instead of TCP (--spawn listens on it)')
+    parser.add_argument('--clients', type=int, default=50, help='number of simulated agents')
+    parser.add_argument('--rate', type=float, default=2, help='messages per second sent by each agent')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send for')
+    parser.add_argument('--warmup', type=float, default=0.5, help='seconds to wait after connecting')
+    parser.add_argument('--drain-timeout', type=float, default=5, help='seconds to wait for in-flight messages')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='payload size mix as size:weight,...')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=2, help='framing protocol version')
+    parser.add_argument('--compression', default='', help='codec to negotiate with the relay (v2 only)')
+    parser.add_argument('--relay-pid', type=int, default=None, help='pid of the relay to measure CPU and RSS of')
+    parser.add_argument('--spawn', action='store_true',
+                        help='start a relay (python -m server.server) on --port for the run')
+    parser.add_argument('--relay-args', default='', help='extra arguments for the spawned relay')
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.clients < 2:
+        raise SystemExit('need at least 2 clients')
+    relay = None
+    if args.spawn:
+        relay = subprocess.Popen([sys.executable, '-m', 'server.server', '--ip', args.ip, '--port', str(args.port),
+                                  '--mailbox-dir', ''] + (['--unix', args.unix] if args.unix else []) +
+                                 args.relay_args.split(),
+                                 stdout=subprocess.DEVNULL)
+        args.relay_pid = relay.pid
+        time.sleep(1)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if relay is not None:
+            relay.terminate()
+            relay.wait()
+    for key, value in results.items():
+        print('{:>20}: {}'.format(key, value))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
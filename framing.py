@@ -0,0 +1,447 @@
+""" Wire framing shared by the client transport and the relay server.
+
+    Every frame on the wire is a fixed size header holding the payload length
+    as space padded ASCII digits, followed by the payload itself. The first
+    frame a client sends is its username, every following frame is a message.
+    The relay forwards a message as the sender's username frame followed by
+    the message frame.
+
+    Frames whose payload starts with CONTROL_PREFIX are control messages for
+    the relay itself (for example registering the verkeys a client owns) and
+    are never forwarded.
+
+    Protocol v2 is negotiated by opening the connection with V2_MAGIC, which
+    can never start a legacy header. Every v2 frame has a binary header holding
+    the payload length, a frame type and a numeric sender id, so forwarded
+    messages no longer repeat the sender's username. The relay answers HELLO
+    with WELCOME carrying the client's own sender id, and announces a sender's
+    name with a PEER frame before the first message it forwards from it.
+
+    v2 peers can also agree on a compression codec: HELLO lists the codecs the
+    client supports under "compression" and WELCOME names the one the relay
+    picked. Frames with the COMPRESSED flag set in their type carry a payload
+    compressed with that codec. Small frames are always sent as they are.
+
+    A v2 client may ask for a resumable session by sending "session" in HELLO
+    (empty for a new session, or the token of the session to resume together
+    with "received", the number of DATA frames it got in it). Sequence numbers
+    are implicit: the n-th DATA frame sent in either direction of a session is
+    number n. Each side acknowledges what it received with ACK frames and keeps
+    what it sent until it is acknowledged. WELCOME carries the session token,
+    "resumed", "seq" (the number of the frame before the first one the relay
+    will send now) and "received" (DATA frames the relay got from the client),
+    so after a reconnect only unacknowledged frames are sent again.
+
+    Either v2 side sends PING once it has heard nothing from the other for
+    HEARTBEAT_INTERVAL seconds, and answers a PING with a PONG carrying the
+    same payload. A peer silent for IDLE_TIMEOUT seconds is taken for dead and
+    its connection is closed.
+
+    One v2 connection can carry many identities, for hosting many agents in
+    one process. After its own HELLO, the client opens a stream per hosted
+    identity with an OPEN frame ({"username": ...}). Frames of a stream have
+    the STREAM flag set in their type and a payload starting with the stream's
+    STREAM_ID. Stream frames are DATA and CONTROL frames from the client, and
+    DATA frames from the relay. PEER frames announce a sender for the whole
+    connection. CLOSE ends a stream. Streams are not part of the connection's
+    session.
+
+    A relay shutting down for a restart sends DRAIN ({"reconnect_within": ...})
+    to its v2 clients and stores their later messages for its successor. Each
+    client reconnects at a random moment within that many seconds, reaching
+    the relay that took over the port. Before leaving, it waits for its own
+    frames to be acknowledged and acknowledges every frame it received, so
+    nothing is sent twice across the two relays.
+
+    Both sides refuse frames longer than their maximum frame size as soon as
+    the header is read. v2 peers tell each other their maximum in HELLO and
+    WELCOME ("max_frame"). A parser can also spill the payload of a very large
+    DATA frame to a temporary file as it arrives (SpilledFrame), so it is never
+    held in memory as a whole.
+
+    Frames are sent in priority lanes so small frames are not held up behind
+    large messages. Frames other than DATA (handshakes, acks, heartbeats) are
+    in the control lane, which always goes first. DATA frames are interactive
+    unless they are bulk (credentials, proofs): a v2 client marks those with
+    the BULK flag once WELCOME says the relay has lanes ("lanes": true), and
+    the relay also treats every large enough message as bulk. Order is only
+    kept within a lane.
+"""
+import base64
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+HEADER_LENGTH = 10
+MAX_FRAME_BYTES = 16 * 1024 * 1024     # longest frame payload accepted by default
+SPILL_CHUNK = 64 * 1024     # bytes of a spilled frame read or written at a time
+
+# most buffers a single sendmsg / writev call accepts
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+V2_MAGIC = b'\x00RL2'
+V2_HEADER = struct.Struct('>IBI')       # payload length, frame type, sender id
+
+# v2 frame types
+DATA = 0            # packed agent message
+HELLO = 1           # client -> relay: {"username": ...}
+WELCOME = 2         # relay -> client: {"sender_id": ...}
+PEER = 3            # relay -> client: sender name for the sender id in the header
+CONTROL = 4         # client -> relay: control message
+ACK = 5             # both ways: number of DATA frames received in the session
+PING = 6            # both ways: heartbeat, answered with PONG
+PONG = 7            # both ways: answer to PING, echoing its payload
+OPEN = 8            # client -> relay, stream frame: {"username": ...} of an identity hosted on the connection
+CLOSE = 9           # client -> relay, stream frame: the stream's identity left
+DRAIN = 10          # relay -> client: {"reconnect_within": seconds}, the relay is going away
+
+COMPRESSED = 0x80   # frame type flag: the payload is compressed with the negotiated codec
+STREAM = 0x40       # frame type flag: the payload starts with STREAM_ID, the rest belongs to that stream
+STREAM_ID = struct.Struct('>I')
+BULK = 0x20         # frame type flag: DATA frame in the bulk lane
+COMPRESS_MIN_BYTES = 1024   # smaller payloads are not worth compressing
+
+LANE_CONTROL = 0
+LANE_INTERACTIVE = 1
+LANE_BULK = 2
+LANES = ('control', 'interactive', 'bulk')      # highest priority first
+BULK_BYTES = 16 * 1024      # DATA frames this long go in the bulk lane unless the sender says otherwise
+
+ACK_PAYLOAD = struct.Struct('>Q')
+ACK_EVERY = 16      # acknowledge once this many DATA frames are unacknowledged
+ACK_DELAY = 0.5     # or this many seconds after the first unacknowledged one
+
+HEARTBEAT_INTERVAL = 30     # seconds of silence before a PING is sent
+IDLE_TIMEOUT = 90           # seconds of silence before the connection is given up
+
+# Control message types
+REGISTER = "relay/register"
+
+CONTROL_PREFIX = b'{"@type":"relay/'
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_header(length: int) -> bytes:
+    '''
+    Build the fixed size length header for a payload of the given length
+    '''
+    return f"{length:<{HEADER_LENGTH}}".encode('utf-8')
+
+
+def encode_frame(payload: bytes) -> bytes:
+    '''
+    Prefix the payload with its length header
+    '''
+    return encode_header(len(payload)) + payload
+
+
+def decode_header(header) -> int:
+    '''
+    Convert a length header (bytes or memoryview) to the payload length
+    '''
+    try:
+        length = int(bytes(header))
+    except ValueError:
+        raise FrameError('Invalid frame header: {!r}'.format(bytes(header)))
+    if length < 0:
+        # would never advance the parser
+        raise FrameError('Invalid frame header: {!r}'.format(bytes(header)))
+    return length
+
+
+class SpilledFrame:
+    '''
+    Payload of a large frame kept in an anonymous temporary file instead of memory. The file goes away
+    with the last reference to it.
+    '''
+    def __init__(self, length, directory=None):
+        self.length = length
+        self.received = 0
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.hash = hashlib.blake2b(digest_size=16)
+
+    def __len__(self):
+        return self.length
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.received += len(data)
+
+    def complete(self):
+        return self.received == self.length
+
+    def digest(self):
+        '''
+        blake2b digest (16 bytes) of the payload
+        '''
+        return self.hash.digest()
+
+    def read(self, offset=0, size=None):
+        self.file.flush()
+        self.file.seek(offset)
+        return self.file.read(self.length - offset if size is None else size)
+
+    def head(self, size=SPILL_CHUNK):
+        '''
+        The start of the payload, enough to find the recipients of a packed message
+        '''
+        return self.read(0, size)
+
+    def chunks(self, size=SPILL_CHUNK):
+        for offset in range(0, self.length, size):
+            yield self.read(offset, size)
+
+
+class FrameParser:
+    '''
+    Incremental frame parser. Data is appended to a single buffer as it arrives from the socket and
+    complete frames are cut out of it, so a frame split over many reads (or many frames in one read)
+    never blocks the reader and is never truncated. A frame longer than max_length is refused as soon
+    as its header is read.
+    '''
+    def __init__(self, max_length=None):
+        self.buffer = bytearray()
+        self.max_length = max_length
+
+    def check_length(self, length):
+        if self.max_length is not None and length > self.max_length:
+            raise FrameError('Frame of {} bytes is over the limit of {}'.format(length, self.max_length))
+
+    def feed(self, data):
+        '''
+        Append newly received bytes
+        '''
+        self.buffer += data
+
+    def frames(self):
+        '''
+        Return the payloads of every complete frame in the buffer
+        '''
+        frames = []
+        buffer = self.buffer
+        offset = 0
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= HEADER_LENGTH:
+                length = decode_header(view[offset:offset + HEADER_LENGTH])
+                self.check_length(length)
+                end = offset + HEADER_LENGTH + length
+                if end > len(buffer):
+                    break           # body not fully received yet
+                frames.append(bytes(view[offset + HEADER_LENGTH:end]))
+                offset = end
+        # compact the buffer once per read instead of once per frame
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def pending(self):
+        '''
+        Number of buffered bytes that do not form a complete frame yet
+        '''
+        return len(self.buffer)
+
+
+def encode_v2_header(frame_type: int, length: int, sender_id: int = 0) -> bytes:
+    return V2_HEADER.pack(length, frame_type, sender_id)
+
+
+def encode_stream_header(frame_type: int, stream_id: int, length: int, sender_id: int = 0) -> bytes:
+    '''
+    Header of a frame of stream stream_id with a length bytes payload, followed by the stream id
+    '''
+    return V2_HEADER.pack(STREAM_ID.size + length, frame_type | STREAM, sender_id) + STREAM_ID.pack(stream_id)
+
+
+def encode_v2_frame(frame_type: int, payload: bytes, sender_id: int = 0) -> bytes:
+    return V2_HEADER.pack(len(payload), frame_type, sender_id) + payload
+
+
+class V2FrameParser(FrameParser):
+    '''
+    Incremental parser for v2 frames, returns (frame type, sender id, payload) tuples. The payload of a
+    DATA frame (bulk or not) of spill_length bytes or more is written to a SpilledFrame in directory as
+    it arrives.
+    '''
+    def __init__(self, max_length=None, spill_length=None, directory=None):
+        super().__init__(max_length)
+        self.spill_length = spill_length
+        self.directory = directory
+        self.spilling = None        # (frame type, sender id, SpilledFrame) being received
+
+    def feed(self, data):
+        if self.spilling is not None:
+            spilled = self.spilling[2]
+            take = min(len(data), spilled.length - spilled.received)
+            spilled.write(data[:take])
+            data = data[take:]
+        self.buffer += data
+
+    def frames(self):
+        frames = []
+        if self.spilling is not None:
+            if not self.spilling[2].complete():
+                return frames
+            frames.append(self.spilling)
+            self.spilling = None
+        buffer = self.buffer
+        offset = 0
+        header_size = V2_HEADER.size
+        unpack_from = V2_HEADER.unpack_from
+        with memoryview(buffer) as view:
+            while len(buffer) - offset >= header_size:
+                length, frame_type, sender_id = unpack_from(buffer, offset)
+                self.check_length(length)
+                if self.spill_length and length >= self.spill_length and frame_type & ~BULK == DATA:
+                    spilled = SpilledFrame(length, self.directory)
+                    offset += header_size
+                    take = min(len(buffer) - offset, length)
+                    spilled.write(view[offset:offset + take])
+                    offset += take
+                    if spilled.complete():
+                        frames.append((frame_type, sender_id, spilled))
+                        continue
+                    self.spilling = (frame_type, sender_id, spilled)
+                    break
+                end = offset + header_size + length
+                if end > len(buffer):
+                    break
+                frames.append((frame_type, sender_id, bytes(view[offset + header_size:end])))
+                offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+
+def unsent(parts, sent):
+    '''
+    The parts of a vectored write left after its first sent bytes went out
+    '''
+    for index, part in enumerate(parts):
+        if sent < len(part):
+            return [memoryview(part)[sent:]] + parts[index + 1:] if sent else parts[index:]
+        sent -= len(part)
+    return []
+
+
+class Codec:
+    '''
+    Compression codec for v2 frames. Subclasses set name and implement compress and decompress, and are
+    made available for negotiation with register_codec. decompress raises FrameError rather than return
+    more than max_length bytes, so a small frame cannot expand past the frame size limit.
+    '''
+    name = None
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes, max_length: int) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data, max_length):
+        decompressor = zlib.decompressobj()
+        try:
+            # one byte more than allowed tells a frame that is too long from one that is just long enough
+            payload = decompressor.decompress(data, max_length + 1)
+        except zlib.error as e:
+            raise FrameError('Invalid compressed frame: {}'.format(e))
+        if len(payload) > max_length or decompressor.unconsumed_tail:
+            raise FrameError('Compressed frame is over the limit of {} bytes'.format(max_length))
+        if not decompressor.eof:
+            raise FrameError('Invalid compressed frame: truncated')
+        return payload
+
+
+CODECS = {}     # codec name -> Codec class, in order of preference
+
+
+def register_codec(codec_class):
+    CODECS[codec_class.name] = codec_class
+
+
+register_codec(ZlibCodec)
+
+
+def pick_codec(offered, supported):
+    '''
+    First codec name in offered that is also in supported, or None
+    '''
+    for name in offered:
+        if name in supported:
+            return name
+    return None
+
+
+def encode_control(msg_type: str, **fields) -> bytes:
+    '''
+    Serialize a relay control message. Separators are fixed so the relay can recognize it by prefix.
+    '''
+    return json.dumps(dict({'@type': msg_type}, **fields), separators=(',', ':')).encode('utf-8')
+
+
+def decode_control(payload):
+    '''
+    Return the control message in payload as a dict, or None if payload is a regular message
+    '''
+    if not payload.startswith(CONTROL_PREFIX):
+        return None
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def _b64url_decode(data) -> bytes:
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _protected_header(payload):
+    '''
+    Locate the base64url "protected" value of a packed message without parsing the (large) ciphertext
+    '''
+    start = payload.find(b'"protected"')
+    if start < 0:
+        return None
+    start = payload.find(b'"', start + len(b'"protected"') + 1)
+    if start < 0:
+        return None
+    end = payload.find(b'"', start + 1)
+    if end < 0:
+        return None
+    return payload[start + 1:end]
+
+
+def recipient_kids(payload):
+    '''
+    Recipient verkeys ("kid"s) of a crypto.pack_message JWE envelope, read from the protected header
+    without decrypting anything. Returns None if payload is not a packed message.
+    '''
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    try:
+        protected = _protected_header(payload)
+        if protected is None:
+            return None
+        header = json.loads(_b64url_decode(protected))
+        return [recipient['header']['kid'] for recipient in header['recipients']]
+    except (ValueError, KeyError, TypeError):
+        return None
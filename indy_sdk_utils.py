@@ -89,3 +89,30 @@ async def get_wallet_records(wallet_handle: int, search_type: str) -> list:
     await non_secrets.close_wallet_search(search_handle)
 
     return list_of_records
+
+
+async def get_my_verkeys(wallet_handle: int) -> set:
+    """ Collect every verkey this wallet can receive messages for: the verkeys
+        of all my DIDs and the connection keys handed out in invitations.
+    :param wallet_handle: Handle of the wallet to search.
+    :return: Set of verkeys.
+    """
+    verkeys = set()
+    for my_did in json.loads(await did.list_my_dids_with_meta(wallet_handle)):
+        verkeys.add(my_did['verkey'])
+
+    search_handle = await non_secrets.open_wallet_search(wallet_handle,
+                                                         'connection_key',
+                                                         json.dumps({}),
+                                                         json.dumps({'retrieveTotalCount': True}))
+    while True:
+        results = json.loads(await non_secrets.fetch_wallet_search_next_records(wallet_handle,
+                                                                                search_handle, 10))
+        if results['totalCount'] == 0 or results['records'] is None:
+            break
+        for record in results['records']:
+            verkeys.add(record['id'])
+
+    await non_secrets.close_wallet_search(search_handle)
+
+    return verkeys
@@ -27,6 +27,7 @@ class Connection:
         '''
         connection_key = await did.create_key(self.agent.wallet_handle, "{}")
         print("Connection Key: ", connection_key)
+        self.agent.add_verkey(connection_key)
 
         # store key
         await non_secrets.add_wallet_record(self.agent.wallet_handle,
@@ -101,6 +102,7 @@ class Connection:
 
         # create info for connection
         (my_did, my_vk) = await create_and_store_my_did(self.agent.wallet_handle)
+        self.agent.add_verkey(my_vk)
         await did.set_did_metadata(
             self.agent.wallet_handle,
             my_did,
@@ -233,6 +235,7 @@ class Connection:
         )
         # Create my information for connection
         (my_did, my_vk) = await utils.create_and_store_my_did(self.agent.wallet_handle)
+        self.agent.add_verkey(my_vk)
 
         # Create pairwise relationship between my did and their did
         await pairwise.create_pairwise(
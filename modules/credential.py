@@ -8,6 +8,7 @@ import base64
 from indy import crypto, did, pairwise, non_secrets, error, anoncreds
 from indy.error import IndyError, ErrorCode
 import serializer.json_serializer as Serializer
+import framing
 from message import Message
 from pprint import pprint
 
@@ -212,7 +213,7 @@ class Credential:
         cred_msg['signature'] = await self.agent.sign_agent_message_field(
             cred_msg['data'], verkey)
         # send msg to other user
-        await self.agent.send_message_to_agent(their_did, cred_msg)
+        await self.agent.send_message_to_agent(their_did, cred_msg, framing.LANE_BULK)
 
         print("+++ CREDENTIAL: sending a CREDENTIAL.")
         pprint(cred_msg)
@@ -7,6 +7,7 @@ import json
 import base64
 from indy import crypto, did, pairwise, non_secrets, error, anoncreds
 import serializer.json_serializer as Serializer
+import framing
 from message import Message
 from pprint import pprint
 
@@ -247,7 +248,7 @@ class Proof:
         verkey = await did.key_for_did(self.agent.pool_handle, self.agent.wallet_handle, my_did)
         cred_msg['signature'] = await self.agent.sign_agent_message_field(
             cred_msg['data'], verkey)
-        await self.agent.send_message_to_agent(their_did, cred_msg)
+        await self.agent.send_message_to_agent(their_did, cred_msg, framing.LANE_BULK)
 
         print("+++ PROOF: sending a PROOF.")
         pprint(cred_msg)
@@ -0,0 +1,4 @@
+""" Relay server forwarding framed agent messages between connected clients.
+
+    Run from the repository root with ``python -m server.server``.
+"""
@@ -0,0 +1,292 @@
+""" Multi-process relay. N forked workers share the listening port through SO_REUSEPORT, each one
+    owning the client connections the kernel hands to it. Workers are joined by a full mesh of Unix
+    socketpairs carrying v2 frames.
+
+    The verkey routing table is partitioned: every verkey has a home worker (crc32 of the key modulo
+    N) that records which worker the key's client is connected to and keeps the key's mailbox. A
+    message for a key that is not connected locally goes to the key's home, which delivers it to the
+    owning worker or stores it, so each worker only holds its own connections plus 1/N of the
+    directory.
+"""
+import asyncio
+import os
+import signal
+import socket
+import struct
+import time
+import zlib
+
+import framing
+from server.relay import FlowControlProtocol
+
+# Frame types between workers
+ROUTE = 1       # to the key's home: deliver or store a message for a key
+DELIVER = 2     # to the owning worker: send a message to the local client owning a key
+CLAIM = 3       # to the key's home: a client registered the key on the sending worker
+CLAIMED = 4     # to the owning worker: the key's mailbox has been delivered
+RELEASE = 5     # to the key's home: the client owning the key disconnected
+FANOUT = 6      # message for unknown keys, send to clients that did not register keys
+BROADCAST = 7   # message without recipient keys, send to every client
+
+ROUTE_HEADER = struct.Struct('>HH')     # key length, sender name length
+
+
+def pack_route(kid, sender_name, payload=b''):
+    '''
+    Parts of a frame carrying a message for kid. A spilled payload stays the last part and is written
+    from its file by FlowControlProtocol.write_frame.
+    '''
+    kid = kid.encode('utf-8')
+    return [ROUTE_HEADER.pack(len(kid), len(sender_name)), kid, sender_name, payload]
+
+
+def unpack_route(data):
+    kid_length, sender_length = ROUTE_HEADER.unpack_from(data)
+    start = ROUTE_HEADER.size
+    kid = data[start:start + kid_length].decode('utf-8')
+    start += kid_length
+    sender_name = data[start:start + sender_length]
+    return kid, sender_name, data[start + sender_length:]
+
+
+class WorkerLink(FlowControlProtocol):
+    '''
+    Connection to another worker over a socketpair
+    '''
+    def __init__(self, cluster, peer):
+        super().__init__(cluster.relay.coalesce_delay)
+        self.cluster = cluster
+        self.peer = peer
+        self.parser = framing.V2FrameParser()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.parser.feed(data)
+        relay = self.cluster.relay
+        relay.read_at = time.monotonic()
+        for frame_type, _, payload in self.parser.frames():
+            self.cluster.handle(self.peer, frame_type, payload)
+        relay.read_at = None
+
+    def connection_lost(self, exc):
+        print('Lost link to worker {}'.format(self.peer))
+        self.resume_writing()
+
+    def send(self, frame_type, parts):
+        length = sum(len(part) for part in parts)
+        self.write_frame([framing.encode_v2_header(frame_type, length, self.cluster.index)] + parts,
+                         framing.V2_HEADER.size + length)
+
+
+class Cluster:
+    '''
+    One worker's view of the cluster: links to the other workers and its partition of the directory
+    '''
+    def __init__(self, relay, index, size, sockets):
+        self.relay = relay
+        self.index = index
+        self.size = size
+        self.sockets = sockets      # peer index -> socketpair end
+        self.links = {}             # peer index -> WorkerLink
+        self.directory = {}         # verkey homed here -> index of the worker its client is connected to
+        self.delivering = set()     # keys homed here whose mailbox is being delivered
+        relay.cluster = self
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for peer, sock in self.sockets.items():
+            _, self.links[peer] = await loop.create_unix_connection(lambda peer=peer: WorkerLink(self, peer),
+                                                                    sock=sock)
+        print('Worker {} of {} started (pid {})'.format(self.index, self.size, os.getpid()))
+
+    def home(self, kid):
+        return zlib.crc32(kid.encode('utf-8')) % self.size
+
+    # Called by the local relay
+
+    def route(self, kid, sender, payload):
+        '''
+        Hand a message for a key without a local owner to the key's home
+        '''
+        home = self.home(kid)
+        if home == self.index:
+            self.lookup(kid, sender, payload)
+        else:
+            self.links[home].send(ROUTE, pack_route(kid, sender.name, payload))
+
+    def claim(self, kid):
+        home = self.home(kid)
+        if home == self.index:
+            self.claimed(kid, self.index)
+        else:
+            self.links[home].send(CLAIM, pack_route(kid, b''))
+
+    def release(self, kid):
+        home = self.home(kid)
+        if home == self.index:
+            self.released(kid, self.index)
+        else:
+            self.links[home].send(RELEASE, pack_route(kid, b''))
+
+    def broadcast(self, sender, payload):
+        for link in self.links.values():
+            link.send(BROADCAST, pack_route('', sender.name, payload))
+
+    # Home worker side
+
+    def lookup(self, kid, sender, payload):
+        '''
+        Deliver a message for a key homed here to the worker owning it, or store it
+        '''
+        owner = self.directory.get(kid)
+        if owner is None or kid in self.delivering:
+            self.relay.store(kid, sender, payload)
+            if owner is None:
+                # the owner may be a client that does not register its keys
+                self.relay.fanout(sender, payload)
+                for link in self.links.values():
+                    link.send(FANOUT, pack_route('', sender.name, payload))
+        elif owner == self.index:
+            self.deliver(kid, sender, payload)
+        else:
+            self.links[owner].send(DELIVER, pack_route(kid, sender.name, payload))
+
+    def claimed(self, kid, owner):
+        self.directory[kid] = owner
+        if kid in self.delivering:
+            return      # the running delivery continues to the new owner
+        if self.relay.mailbox is not None and self.relay.mailbox.has_mail(kid):
+            self.delivering.add(kid)
+            asyncio.get_running_loop().create_task(self.deliver_mailbox(kid))
+        else:
+            self.mailbox_delivered(kid, owner)
+
+    def released(self, kid, owner):
+        if self.directory.get(kid) == owner:
+            del self.directory[kid]
+
+    async def deliver_mailbox(self, kid):
+        '''
+        Stream the mailbox of a key homed here to the worker its client is connected to
+        '''
+        count = 0
+        try:
+            for sender_name, payload in self.relay.mailbox.read(kid):
+                owner = self.directory.get(kid)
+                if owner is None:
+                    return      # client went away, the rest stays queued
+                if owner == self.index:
+                    client = self.relay.routes.get(kid)
+                    if client is None:
+                        return
+                    client.send(self.relay.sender(sender_name), payload, kid)
+                    await client.drain()
+                else:
+                    link = self.links[owner]
+                    link.send(DELIVER, pack_route(kid, sender_name, payload))
+                    await link.drain()
+                count += 1
+        finally:
+            self.delivering.discard(kid)
+            self.relay.metrics.inc('mailbox_delivered_total', count)
+        owner = self.directory.get(kid)
+        print('Delivered {} queued messages for {} to worker {}'.format(count, kid, owner))
+        if owner is not None:
+            self.mailbox_delivered(kid, owner)
+
+    def mailbox_delivered(self, kid, owner):
+        if owner == self.index:
+            self.delivery_done(kid)
+        else:
+            self.links[owner].send(CLAIMED, pack_route(kid, b''))
+
+    # Owning worker side
+
+    def deliver(self, kid, sender, payload):
+        client = self.relay.routes.get(kid)
+        if client is None:
+            # disconnected meanwhile, our RELEASE already reached the home so it will store it
+            self.relay.route_offline(kid, sender, payload)
+        else:
+            client.send(sender, payload, kid)
+
+    def delivery_done(self, kid):
+        client = self.relay.routes.get(kid)
+        if client is not None:
+            client.delivering.discard(kid)
+
+    def handle(self, peer, frame_type, data):
+        '''
+        Frame received from another worker
+        '''
+        kid, sender_name, payload = unpack_route(data)
+        if frame_type == ROUTE:
+            self.lookup(kid, self.relay.sender(sender_name), payload)
+        elif frame_type == DELIVER:
+            self.deliver(kid, self.relay.sender(sender_name), payload)
+        elif frame_type == CLAIM:
+            self.claimed(kid, peer)
+        elif frame_type == CLAIMED:
+            self.delivery_done(kid)
+        elif frame_type == RELEASE:
+            self.released(kid, peer)
+        elif frame_type == FANOUT:
+            self.relay.fanout(self.relay.sender(sender_name), payload)
+        elif frame_type == BROADCAST:
+            self.relay.fanout(self.relay.sender(sender_name), payload, everyone=True)
+        else:
+            print('Unknown frame type {} from worker {}'.format(frame_type, peer))
+
+
+def run(make_relay, workers):
+    '''
+    Fork the workers, each running the relay returned by make_relay(), and wait for them
+    '''
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('Multiple workers need fork() and SO_REUSEPORT')
+
+    # full mesh of socketpairs, sockets[i][j] is worker i's end of the link to worker j
+    sockets = [{} for _ in range(workers)]
+    for i in range(workers):
+        for j in range(i + 1, workers):
+            sockets[i][j], sockets[j][i] = socket.socketpair()
+
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            for other in range(workers):
+                if other != index:
+                    for sock in sockets[other].values():
+                        sock.close()
+            relay = make_relay()
+            Cluster(relay, index, workers, sockets[index])
+            try:
+                asyncio.run(relay.serve_forever())
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    for worker_sockets in sockets:
+        for sock in worker_sockets.values():
+            sock.close()
+
+    def stop(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for child in children:
+            os.waitpid(child, 0)
+    except KeyboardInterrupt:
+        # the workers got the interrupt too
+        for child in children:
+            os.waitpid(child, 0)
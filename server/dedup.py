@@ -0,0 +1,40 @@
+""" Duplicate suppression. Clients retrying after a reconnect send the same packed message again.
+    Every packed message is encrypted with a fresh key and nonce, so a message whose digest was seen
+    within the last window seconds is a retry that does not need to be forwarded.
+"""
+import collections
+import time
+
+
+class DuplicateCache:
+    '''
+    Fingerprints seen within the last window seconds. They are kept in time buckets so expiry drops
+    whole sets at once, and the oldest buckets are dropped early once max_entries is reached.
+    '''
+    def __init__(self, window=60, max_entries=200000, buckets=6):
+        self.window = window
+        self.width = window / buckets       # seconds covered by one bucket
+        self.max_entries = max_entries
+        self.buckets = collections.deque()  # (start time, set of fingerprints), oldest first
+        self.size = 0
+
+    def seen(self, fingerprint, now=None):
+        '''
+        True if fingerprint was seen within the window, otherwise remember it and return False
+        '''
+        if now is None:
+            now = time.monotonic()
+        buckets = self.buckets
+        # drop buckets whose newest entry is older than the window
+        while buckets and buckets[0][0] + self.width <= now - self.window:
+            self.size -= len(buckets.popleft()[1])
+        for _, fingerprints in buckets:
+            if fingerprint in fingerprints:
+                return True
+        if not buckets or buckets[-1][0] + self.width <= now:
+            buckets.append((now, set()))
+        buckets[-1][1].add(fingerprint)
+        self.size += 1
+        while self.size > self.max_entries:
+            self.size -= len(buckets.popleft()[1])
+        return False
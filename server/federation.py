@@ -0,0 +1,305 @@
+""" Federation of relays running at different sites.
+
+    Relays peer over persistent TCP links (one per pair of sites, either side may dial) carrying v2
+    frames after FEDERATION_MAGIC. Each relay periodically sends its peers a Bloom filter of the
+    verkeys registered by its clients. A message for a key without a local owner is forwarded over
+    the link of the first peer whose filter contains the key. A peer that turns out not to own the
+    key (a false positive, or the client just left) answers MISS and the next matching peer is
+    tried, until the message ends up in the local mailbox.
+
+    Messages stored locally follow their recipient: when a peer's summary shows it now owns a key
+    with mail here, the mailbox is forwarded to it.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import struct
+import time
+
+import framing
+from server.cluster import ROUTE_HEADER, pack_route, unpack_route
+from server.relay import FlowControlProtocol
+
+FEDERATION_MAGIC = b'\x00RLF'
+
+# Frame types between relays
+HELLO = 1       # {"site": ...}
+SUMMARY = 2     # Bloom filter of the sending relay's registered verkeys
+ROUTE = 3       # message for a key the receiving relay's summary contains
+MISS = 4        # the ROUTEd key has no owner here, returned to the sending relay
+
+BLOOM_HEADER = struct.Struct('>IB')     # size in bits, number of hashes
+ROUTE_OVERHEAD = ROUTE_HEADER.size + 2 * 0xffff     # longest key and sender name in front of a ROUTEd message
+
+
+class BloomFilter:
+    '''
+    Bloom filter over verkeys, sized for an expected number of keys and false positive rate
+    '''
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, keys, error_rate=0.01):
+        keys = list(keys)
+        bits = max(1024, int(-len(keys) * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, round(bits / max(1, len(keys)) * math.log(2)))
+        bloom = cls(bits, min(hashes, 16))
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def _positions(self, key):
+        # double hashing with the two halves of one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def encode(self):
+        return BLOOM_HEADER.pack(self.bits, self.hashes) + bytes(self.data)
+
+    @classmethod
+    def decode(cls, data):
+        bits, hashes = BLOOM_HEADER.unpack_from(data)
+        if not bits or not hashes or len(data) - BLOOM_HEADER.size != (bits + 7) // 8:
+            raise framing.FrameError('Invalid routing summary')
+        return cls(bits, hashes, data[BLOOM_HEADER.size:])
+
+
+class FederationLink(FlowControlProtocol):
+    '''
+    Link to a peer relay. The dialing side opens with FEDERATION_MAGIC, then both sides send HELLO and
+    their current summary.
+    '''
+    def __init__(self, federation, outgoing=False):
+        super().__init__(federation.relay.coalesce_delay)
+        self.federation = federation
+        self.outgoing = outgoing
+        self.site = None            # peer's site name, from its HELLO
+        self.filter = None          # BloomFilter of the peer's verkeys, None until its first SUMMARY
+        self.handshake = bytearray()
+        self.parser = None
+        self.address = None
+        self.lost = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        if self.outgoing:
+            transport.write(FEDERATION_MAGIC)
+            self.parser = framing.V2FrameParser(self.federation.relay.max_frame_bytes + ROUTE_OVERHEAD)
+            self.federation.link_made(self)
+
+    def data_received(self, data):
+        if self.parser is None:
+            self.handshake += data
+            if len(self.handshake) < len(FEDERATION_MAGIC):
+                return
+            if not self.handshake.startswith(FEDERATION_MAGIC):
+                print('Invalid federation handshake from {}'.format(self.address))
+                self.transport.close()
+                return
+            data = bytes(self.handshake[len(FEDERATION_MAGIC):])
+            self.parser = framing.V2FrameParser(self.federation.relay.max_frame_bytes + ROUTE_OVERHEAD)
+            self.federation.link_made(self)
+        self.parser.feed(data)
+        relay = self.federation.relay
+        relay.read_at = time.monotonic()
+        try:
+            for frame_type, _, payload in self.parser.frames():
+                self.federation.handle(self, frame_type, payload)
+        except framing.FrameError as e:
+            print('Closing federation link to {}: {}'.format(self.name(), e))
+            self.transport.close()
+        relay.read_at = None
+
+    def connection_lost(self, exc):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.outbox = []
+        self.federation.link_lost(self)
+        self.lost.set_result(None)
+        self.resume_writing()
+
+    def name(self):
+        return self.site or str(self.address)
+
+    def send(self, frame_type, parts):
+        length = sum(len(part) for part in parts)
+        self.write_frame([framing.encode_v2_header(frame_type, length)] + parts, framing.V2_HEADER.size + length)
+
+
+class Federation:
+    '''
+    This relay's links to the relays of other sites
+    '''
+    def __init__(self, relay, site, listen=None, peers=(), summary_interval=1.0):
+        self.relay = relay
+        self.site = site
+        self.listen = listen                # (ip, port) to accept peer relays on, or None
+        self.peers = list(peers)            # (host, port) of peer relays to dial
+        self.summary_interval = summary_interval
+        self.links = []                     # connected FederationLinks
+        self.summary = None                 # encoded summary of our keys, None when it needs rebuilding
+        self.stored = set()                 # keys with mail stored here, forwarded when a peer owns them
+        self.forwarding = set()             # keys whose stored mail is being forwarded to a peer
+        self.server = None
+        relay.federation = self
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.listen is not None:
+            self.server = await loop.create_server(lambda: FederationLink(self), *self.listen, reuse_address=True)
+            print('Federation of site {} listening on {}:{}'.format(self.site, *self.listen))
+        for host, port in self.peers:
+            loop.create_task(self.dial(host, port))
+        loop.create_task(self.publish_periodically())
+
+    async def dial(self, host, port):
+        '''
+        Keep a link to the peer relay at host:port, reconnecting with a jittered backoff
+        '''
+        loop = asyncio.get_running_loop()
+        delay = 1
+        while True:
+            try:
+                _, link = await loop.create_connection(lambda: FederationLink(self, outgoing=True), host, port)
+            except OSError as e:
+                print('Cannot reach peer relay {}:{}: {}'.format(host, port, e))
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, 30)
+                continue
+            delay = 1
+            await link.lost
+
+    def link_made(self, link):
+        self.links.append(link)
+        link.send(HELLO, [json.dumps({'site': self.site}).encode('utf-8')])
+        link.send(SUMMARY, [self.current_summary()])
+
+    def link_lost(self, link):
+        if link in self.links:
+            self.links.remove(link)
+            print('Lost federation link to {}'.format(link.name()))
+
+    def changed(self):
+        '''
+        The set of registered keys changed, the summary is rebuilt and sent on the next tick
+        '''
+        self.summary = None
+
+    def current_summary(self):
+        if self.summary is None:
+            self.summary = BloomFilter.for_keys(self.relay.routes).encode()
+        return self.summary
+
+    async def publish_periodically(self):
+        while True:
+            await asyncio.sleep(self.summary_interval)
+            if self.summary is None:
+                summary = self.current_summary()
+                for link in self.links:
+                    link.send(SUMMARY, [summary])
+
+    def route(self, kid, sender, payload, after=None):
+        '''
+        Forward a message for a key without a local owner to the first peer (after the given link) whose
+        summary contains the key. Returns False if no peer may own it.
+        '''
+        if kid in self.forwarding:
+            return False        # stored behind the mail being forwarded, to keep the order
+        links = self.links
+        if after is not None:
+            links = links[links.index(after) + 1:] if after in links else []
+        for link in links:
+            if link.filter is not None and kid in link.filter:
+                link.send(ROUTE, pack_route(kid, sender.name, payload))
+                self.relay.metrics.inc('federation_routed_total')
+                return True
+        return False
+
+    def routed(self, link, kid, sender, payload):
+        '''
+        Message from a peer for a key its summary of us contains
+        '''
+        self.relay.metrics.inc('federation_received_total')
+        client = self.relay.routes.get(kid)
+        if client is None:
+            link.send(MISS, pack_route(kid, sender.name, payload))
+        elif kid in client.delivering:
+            self.relay.store(kid, sender, payload)
+        else:
+            client.send(sender, payload, kid)
+
+    def missed(self, link, kid, sender, payload):
+        self.relay.metrics.inc('federation_misses_total')
+        if not self.route(kid, sender, payload, after=link):
+            self.relay.store(kid, sender, payload)
+
+    def summary_received(self, link, data):
+        link.filter = BloomFilter.decode(data)
+        # mail stored here for keys the peer now owns follows them
+        for kid in list(self.stored):
+            if kid in self.relay.routes or kid in self.forwarding:
+                continue
+            if not self.relay.mailbox.has_mail(kid):
+                self.stored.discard(kid)
+            elif kid in link.filter:
+                self.stored.discard(kid)
+                asyncio.get_running_loop().create_task(self.forward_mailbox(link, kid))
+
+    async def forward_mailbox(self, link, kid):
+        '''
+        Send the mail stored for kid to the peer owning it. Messages for kid arriving meanwhile are
+        stored, and forwarded behind it.
+        '''
+        count = 0
+        self.forwarding.add(kid)
+        try:
+            for sender_name, payload in self.relay.mailbox.read(kid):
+                if link.transport.is_closing():
+                    # link went away, the rest stays here
+                    self.stored.add(kid)
+                    break
+                link.send(ROUTE, pack_route(kid, sender_name, payload))
+                count += 1
+                await link.drain()
+        finally:
+            self.forwarding.discard(kid)
+            self.relay.metrics.inc('federation_routed_total', count)
+        print('Forwarded {} stored messages for {} to {}'.format(count, kid, link.name()))
+
+    def handle(self, link, frame_type, data):
+        '''
+        Frame received from a peer relay
+        '''
+        if frame_type == HELLO:
+            try:
+                link.site = json.loads(data)['site']
+            except (ValueError, KeyError, TypeError):
+                raise framing.FrameError('Invalid federation HELLO')
+            print('Federation link to site {} ({}) up'.format(link.site, link.address))
+        elif frame_type == SUMMARY:
+            self.summary_received(link, data)
+        elif frame_type in (ROUTE, MISS):
+            kid, sender_name, payload = unpack_route(data)
+            sender = self.relay.sender(sender_name)
+            if frame_type == ROUTE:
+                self.routed(link, kid, sender, payload)
+            else:
+                self.missed(link, kid, sender, payload)
+        else:
+            print('Unknown frame type {} from peer relay {}'.format(frame_type, link.name()))
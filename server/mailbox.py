@@ -0,0 +1,193 @@
+""" Store-and-forward mailbox for recipients that are not connected to the relay.
+
+    Every recipient verkey gets its own directory holding an append-only log split into numbered
+    segment files. A record is a fixed header (store time, sender length, payload length) followed
+    by the sender's username and the packed message. Records expire after a TTL and the oldest
+    segments are dropped to make room when a mailbox would grow over its size cap; a message too large
+    for the cap on its own is not stored.
+
+    Several relay processes may share the directory (the workers of a cluster, or an old and a new
+    relay during a restart). Appending and removing a segment hold a lock on the directory,
+    so a record appended by another process while a segment is read is never removed with it.
+"""
+import contextlib
+import hashlib
+import os
+import struct
+import time
+
+import framing
+
+try:
+    import fcntl
+except ImportError:     # no flock, the directory is not shared
+    fcntl = None
+
+RECORD_HEADER = struct.Struct('>dII')     # stored at, sender length, payload length
+SEGMENT_SUFFIX = '.seg'
+
+
+class Mailbox:
+    '''
+    Per-recipient append-only segment logs on local disk
+    '''
+    def __init__(self, directory, ttl=7 * 24 * 3600, max_bytes=64 * 1024 * 1024, segment_bytes=1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl                      # seconds a record is kept
+        self.max_bytes = max_bytes          # cap on the size of a single recipient's mailbox
+        self.segment_bytes = segment_bytes  # a new segment is started once the current one is this big
+        self.sizes = {}                     # verkey -> bytes on disk, loaded lazily
+        os.makedirs(directory, exist_ok=True)
+        self.lock_path = os.path.join(directory, '.lock')
+        self.shared = False                 # another relay stores mail here too, sizes are not cached
+
+    @contextlib.contextmanager
+    def locked(self):
+        '''
+        Hold the lock other processes sharing the directory take to append or remove segments
+        '''
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _path(self, verkey):
+        # verkeys come from untrusted frames, never use them as file names directly
+        return os.path.join(self.directory, hashlib.sha256(verkey.encode('utf-8')).hexdigest()[:32])
+
+    def _segments(self, path):
+        '''
+        Segment file names of a mailbox, oldest first
+        '''
+        try:
+            names = [name for name in os.listdir(path) if name.endswith(SEGMENT_SUFFIX)]
+        except FileNotFoundError:
+            return []
+        return sorted(names)
+
+    def _size(self, verkey, path):
+        if verkey not in self.sizes:
+            self.sizes[verkey] = sum(os.path.getsize(os.path.join(path, name)) for name in self._segments(path))
+        return self.sizes[verkey]
+
+    def has_mail(self, verkey):
+        if self.shared:
+            self.sizes.pop(verkey, None)
+        return self._size(verkey, self._path(verkey)) > 0
+
+    def append(self, verkey, sender, payload):
+        '''
+        Store a message for verkey at the end of its log, a spilled payload is copied from its file in
+        chunks. Returns False if it is over the size cap on its own and was not stored.
+        '''
+        path = self._path(verkey)
+        record = RECORD_HEADER.pack(time.time(), len(sender), len(payload))
+        record_size = len(record) + len(sender) + len(payload)
+        if record_size > self.max_bytes:
+            print('Message of {} bytes for {} is over the mailbox cap, not stored'.format(record_size, verkey))
+            return False
+        with self.locked():
+            os.makedirs(path, exist_ok=True)
+            segments = self._segments(path)
+            size = self._size(verkey, path)
+            # drop the oldest segments until the message fits, before picking the one it goes to
+            dropped = False
+            while segments and size + record_size > self.max_bytes:
+                oldest = os.path.join(path, segments.pop(0))
+                try:
+                    size -= os.path.getsize(oldest)
+                    os.remove(oldest)
+                except FileNotFoundError:
+                    pass        # consumed or expired meanwhile
+                dropped = True
+            if dropped:
+                print('Mailbox full, dropped oldest messages for {}'.format(verkey))
+            if segments and os.path.getsize(os.path.join(path, segments[-1])) < self.segment_bytes:
+                segment = segments[-1]
+            else:
+                number = int(segments[-1][:-len(SEGMENT_SUFFIX)]) + 1 if segments else 0
+                segment = '{:020d}{}'.format(number, SEGMENT_SUFFIX)
+                segments.append(segment)
+            with open(os.path.join(path, segment), 'ab') as f:
+                f.write(record)
+                f.write(sender)
+                for chunk in payload.chunks() if isinstance(payload, framing.SpilledFrame) else [payload]:
+                    f.write(chunk)
+            self.sizes[verkey] = size + record_size
+        return True
+
+    def read(self, verkey):
+        '''
+        Stream the (sender, payload) records stored for verkey, oldest first, one record in memory at a
+        time. A segment is removed once all its records have been consumed, so a delivery interrupted
+        part way through is repeated from the start of that segment. Records appended while reading are
+        also returned.
+        '''
+        path = self._path(verkey)
+        expired_before = time.time() - self.ttl
+        while True:
+            segments = self._segments(path)
+            if not segments:
+                break
+            segment = os.path.join(path, segments[0])
+            try:
+                f = open(segment, 'rb')
+            except FileNotFoundError:
+                continue    # dropped by the size cap or expiry meanwhile
+            with f:
+                stuck = None
+                while True:
+                    start = f.tell()
+                    header = f.read(RECORD_HEADER.size)
+                    sender = payload = b''
+                    if len(header) == RECORD_HEADER.size:
+                        stored_at, sender_length, payload_length = RECORD_HEADER.unpack(header)
+                        sender = f.read(sender_length)
+                        payload = f.read(payload_length)
+                        if len(payload) == payload_length:
+                            if stored_at >= expired_before:
+                                yield sender, payload
+                            continue
+                    # end of the segment, unless another process is appending to it right now
+                    f.seek(start)
+                    with self.locked():
+                        if os.fstat(f.fileno()).st_size == start or stuck == start:
+                            # consumed, or a truncated record left by a relay that died while writing it
+                            self.sizes[verkey] = max(0, self._size(verkey, path) - os.fstat(f.fileno()).st_size)
+                            try:
+                                os.remove(segment)
+                            except FileNotFoundError:
+                                pass        # already dropped by the size cap or expiry
+                            break
+                    stuck = start
+        self.sizes.pop(verkey, None)
+        with self.locked():
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    def expire(self):
+        '''
+        Remove segments whose newest record is older than the TTL
+        '''
+        expired_before = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+            with self.locked():
+                for segment in self._segments(path):
+                    segment = os.path.join(path, segment)
+                    try:
+                        if os.path.getmtime(segment) < expired_before:
+                            os.remove(segment)
+                    except FileNotFoundError:
+                        pass        # delivered meanwhile, or expired by another worker
+        # sizes are recomputed from disk on next use
+        self.sizes.clear()
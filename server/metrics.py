@@ -0,0 +1,221 @@
+""" Relay metrics. Counters on the hot path are plain integers (per client attributes on the
+    connection, relay wide ones in a Counter) and histograms only do a bisect per observation;
+    everything else is computed when the metrics are scraped.
+
+    The metrics are served in Prometheus text format over HTTP (GET /metrics, or GET /snapshot for
+    JSON) and can be appended to a file as a JSON snapshot at a fixed interval.
+"""
+import asyncio
+import bisect
+import collections
+import json
+import time
+
+# bucket upper bounds
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+COUNTER_HELP = {
+    'connections_total': 'Client connections accepted',
+    'mailbox_stored_total': 'Messages stored in the mailbox',
+    'mailbox_delivered_total': 'Messages delivered from the mailbox',
+    'mailbox_rejected_total': 'Messages not stored because they were over the mailbox size cap on their own',
+    'spilled_total': 'Messages spilled to the mailbox because a client queue was full',
+    'dropped_total': 'Messages dropped because a client queue was full',
+    'slow_consumer_disconnects_total': 'Clients disconnected because their queue was full',
+    'rate_limited_total': 'Times a client\'s received messages waited because it was over its rate limit',
+    'reading_paused_total': 'Times reading from a client paused because its received frames were not handled yet',
+    'pings_sent_total': 'Heartbeat PINGs sent to quiet clients',
+    'connections_reaped_total': 'Connections closed because nothing was heard from them for the idle timeout',
+    'frames_spilled_total': 'Received messages large enough to be kept in a temporary file',
+    'oversized_dropped_total': 'Messages not sent to a client because they were over the client\'s frame size limit',
+    'duplicates_suppressed_total': 'Packed messages not forwarded because they were seen before',
+    'sessions_resumed_total': 'Sessions resumed by a reconnecting client',
+    'session_frames_resent_total': 'Unacknowledged messages sent again to a resuming client',
+    'session_frames_forgotten_total': 'Unacknowledged messages no longer kept because a session was over its cap',
+    'federation_routed_total': 'Messages forwarded to peer relays',
+    'federation_received_total': 'Messages received from peer relays',
+    'federation_misses_total': 'Messages returned by a peer relay that did not own the recipient key',
+    'compression_in_bytes_total': 'Payload bytes compressed for clients',
+    'compression_out_bytes_total': 'Bytes the compressed payloads came to',
+    'compression_seconds_total': 'CPU seconds spent compressing',
+    'decompression_in_bytes_total': 'Compressed bytes received from clients',
+    'decompression_out_bytes_total': 'Bytes the received payloads decompressed to',
+    'decompression_seconds_total': 'CPU seconds spent decompressing',
+}
+
+
+class Histogram:
+    '''
+    Cumulative histogram with fixed buckets
+    '''
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket holding the q-quantile
+        '''
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = ['# HELP relay_{} {}'.format(self.name, self.help), '# TYPE relay_{} histogram'.format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('relay_{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('relay_{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append('relay_{}_sum {}'.format(self.name, self.sum))
+        lines.append('relay_{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    '''
+    Metrics of one relay process
+    '''
+    def __init__(self, relay):
+        self.relay = relay
+        self.started = time.time()
+        self.counters = collections.Counter()
+        self.frame_size = Histogram('frame_size_bytes', 'Size of received message frames', SIZE_BUCKETS)
+        self.forward_latency = Histogram('forward_latency_seconds',
+                                         'Time from reading a message to writing it to the recipient socket',
+                                         LATENCY_BUCKETS)
+
+    def inc(self, name, amount=1):
+        self.counters[name] += amount
+
+    def snapshot(self):
+        '''
+        Current metrics as a dict
+        '''
+        clients = []
+        for client in list(self.relay.clients):
+            clients.append({
+                'name': client.name(),
+                'connection': client.connection_id,
+                'frames_in': client.frames_in,
+                'bytes_in': client.bytes_in,
+                'frames_out': client.frames_out,
+                'bytes_out': client.bytes_out,
+                'queue_depth': len(client.queue),
+                'queued_bytes': client.queued_bytes,
+            })
+        counters = self.counters
+        return {
+            'time': time.time(),
+            'worker': self.relay.cluster.index if self.relay.cluster is not None else 0,
+            'uptime': time.time() - self.started,
+            'connected_clients': len(self.relay.clients),
+            'duplicate_cache_entries': self.relay.duplicates.size if self.relay.duplicates is not None else 0,
+            'counters': dict(counters),
+            # compressed size / original size, for what the relay compressed and what clients sent compressed
+            'compression_ratio': (counters['compression_out_bytes_total'] / counters['compression_in_bytes_total']
+                                  if counters['compression_in_bytes_total'] else None),
+            'received_compression_ratio': (counters['decompression_in_bytes_total'] /
+                                           counters['decompression_out_bytes_total']
+                                           if counters['decompression_out_bytes_total'] else None),
+            'frame_size_p50': self.frame_size.quantile(0.5),
+            'frame_size_p99': self.frame_size.quantile(0.99),
+            'forward_latency_p50': self.forward_latency.quantile(0.5),
+            'forward_latency_p99': self.forward_latency.quantile(0.99),
+            'clients': clients,
+        }
+
+    def render(self):
+        '''
+        Current metrics in Prometheus text format
+        '''
+        lines = ['# HELP relay_connected_clients Connected clients',
+                 '# TYPE relay_connected_clients gauge',
+                 'relay_connected_clients {}'.format(len(self.relay.clients))]
+        for name, help_text in COUNTER_HELP.items():
+            lines.append('# HELP relay_{} {}'.format(name, help_text))
+            lines.append('# TYPE relay_{} counter'.format(name))
+            lines.append('relay_{} {}'.format(name, self.counters[name]))
+
+        per_client = (
+            ('client_frames_in_total', 'counter', 'Frames received from the client', 'frames_in'),
+            ('client_bytes_in_total', 'counter', 'Bytes received from the client', 'bytes_in'),
+            ('client_frames_out_total', 'counter', 'Messages written to the client', 'frames_out'),
+            ('client_bytes_out_total', 'counter', 'Bytes written to the client', 'bytes_out'),
+            ('client_queued_bytes', 'gauge', 'Payload bytes waiting in the client queue', 'queued_bytes'),
+        )
+        # a username may be connected more than once, the connection label keeps the series apart
+        clients = [(client, 'client="{}",connection="{}"'.format(_label(client.name()), client.connection_id))
+                   for client in self.relay.clients]
+        for name, kind, help_text, attribute in per_client:
+            lines.append('# HELP relay_{} {}'.format(name, help_text))
+            lines.append('# TYPE relay_{} {}'.format(name, kind))
+            for client, labels in clients:
+                lines.append('relay_{}{{{}}} {}'.format(name, labels, getattr(client, attribute)))
+        lines.append('# HELP relay_client_queue_depth Messages waiting in the client queue')
+        lines.append('# TYPE relay_client_queue_depth gauge')
+        for client, labels in clients:
+            lines.append('relay_client_queue_depth{{{}}} {}'.format(labels, len(client.queue)))
+
+        lines += self.frame_size.render()
+        lines += self.forward_latency.render()
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host, port):
+        '''
+        Serve GET /metrics and GET /snapshot over HTTP
+        '''
+        server = await asyncio.start_server(self.handle_http, host, port)
+        print('Metrics on http://{}:{}/metrics'.format(host, port))
+        return server
+
+    async def handle_http(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass            # skip headers
+            parts = request.split()
+            path = parts[1].decode('ascii', 'replace') if len(parts) > 1 else ''
+            if path == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', self.render()
+            elif path == '/snapshot':
+                status, content_type, body = '200 OK', 'application/json', json.dumps(self.snapshot())
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'not found\n'
+            body = body.encode('utf-8')
+            writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                status, content_type, len(body)).encode('ascii') + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def dump_periodically(self, path, interval):
+        '''
+        Append a JSON snapshot to path every interval seconds
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
@@ -0,0 +1,1357 @@
+""" Asyncio relay. Every client connection gets its own protocol instance with a buffered
+    frame parser, so a slow or half-sent client only ever delays itself.
+
+    Clients register the verkeys they own and packed messages are only forwarded to the owners of
+    the recipient keys listed in the message's protected header. Clients that never registered
+    (older clients) still receive messages whose recipients are not registered.
+    Messages for recipients that are not connected are kept in the mailbox and delivered, in order,
+    when the recipient registers its key again.
+
+    Every client has a bounded outbound queue that only fills while its transport's write buffer is
+    over the high-water mark, and is written out as the socket becomes writable again. When the
+    queue is full the relay's slow consumer policy decides what happens: drop the oldest queued
+    messages, spill new messages to the mailbox, or disconnect the client.
+
+    Frames written to a connection are collected and flushed once per event loop iteration (or after
+    a short coalescing window), so fanning out a batch of messages costs one writev per recipient
+    instead of a joined copy and a send per frame.
+
+    v2 clients may negotiate frame compression. Compressed messages are decompressed once to read
+    their recipients, and a message sent to several compressing clients is compressed only once (or
+    not at all when it arrived compressed with the same codec).
+
+    v2 clients may also ask for a resumable session. Messages written to such a client are kept
+    until it acknowledges them, and sent again if it reconnects with its session token. A session
+    whose client does not come back within the session TTL hands its unacknowledged messages to the
+    mailbox.
+
+    Received frames are not handled straight away but queued on the connection and handled by the
+    fair scheduler (server.scheduler), which can also hold clients to a rate limit.
+
+    v2 clients that have been silent for the heartbeat interval are sent a PING, and connections
+    silent for the idle timeout (dead peers, or clients that never finished their handshake) are
+    reaped. Legacy clients cannot answer a PING, their sockets get TCP keepalives instead. Messages
+    still pending for a reaped client go to the mailbox or are dropped, by the reap policy.
+
+    Besides TCP the relay can listen on a Unix domain socket for agents on the same host, with the
+    same framing and routing.
+
+    A v2 connection may also carry streams, one per identity hosted by the client (see framing). A
+    Stream is routed like a connection of its own but writes through its connection's transport.
+
+    The relay listens with SO_REUSEPORT so a new relay can be started on the same port before the old
+    one goes away. On SIGTERM the relay drains: it stops accepting, asks its v2 clients to reconnect
+    (spread over the drain timeout), and once they left or the timeout passed it closes the rest and
+    puts every message still pending in the mailbox. A relay started to replace another one signals
+    it once it is listening, and picks up the mail the old relay stores for its clients meanwhile.
+"""
+import asyncio
+import collections
+import hashlib
+import itertools
+import json
+import os
+import secrets
+import signal
+import socket
+import stat
+import time
+
+import framing
+from server.dedup import DuplicateCache
+from server.metrics import Metrics
+from server.scheduler import LaneQueue, Scheduler, TokenBucket
+
+
+def keepalive(sock, interval):
+    '''
+    Have the kernel probe the peer of a quiet TCP socket every interval seconds, so a dead peer breaks
+    the connection after a few unanswered probes
+    '''
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', interval), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), max(1, int(value)))
+
+
+def bind_unix(path, replace=False):
+    '''
+    Listening Unix domain socket at path. A socket file left behind by a relay that is no longer
+    running is replaced, one of a running relay only if replace is set (that relay keeps its
+    connections but gets no new ones).
+    '''
+    if replace and os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    elif os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.unlink(path)     # stale
+        else:
+            raise OSError('Another relay is listening on {}'.format(path))
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(socket.SOMAXCONN)
+    return sock
+
+
+class Sender:
+    '''
+    Identity messages are forwarded under: the username, its legacy username frame and its v2 sender id
+    '''
+    __slots__ = ('name', 'id', 'user_frame')
+
+    def __init__(self, name, sender_id):
+        self.name = name
+        self.id = sender_id
+        self.user_frame = framing.encode_frame(name)
+
+
+class Session:
+    '''
+    Resumable v2 session. DATA frames written to the client are kept, numbered, until the client
+    acknowledges them.
+    '''
+    def __init__(self, token, name, max_bytes):
+        self.token = token
+        self.name = name            # username the session belongs to
+        self.max_bytes = max_bytes  # cap on the payload bytes kept for resending
+        self.client = None          # ClientConnection, None while the client is away
+        self.verkeys = set()        # keys registered again when the client resumes
+        self.sent = 0               # DATA frames written to the client
+        self.received = 0           # DATA frames received from the client
+        self.acked_received = 0     # received count last acknowledged to the client
+        self.unacked = collections.deque()  # (seq, sender, payload, kid) written but not acknowledged
+        self.unacked_bytes = 0
+        self.expiry = None          # timer handle while the client is away
+
+    def sent_frame(self, sender, payload, kid):
+        '''
+        Keep a frame written to the client. Returns the number of old frames forgotten to stay under the cap.
+        '''
+        self.sent += 1
+        self.unacked.append((self.sent, sender, payload, kid))
+        self.unacked_bytes += len(payload)
+        forgotten = 0
+        while self.unacked_bytes > self.max_bytes:
+            self.unacked_bytes -= len(self.unacked.popleft()[2])
+            forgotten += 1
+        return forgotten
+
+    def acked(self, seq):
+        '''
+        The client received every frame up to seq
+        '''
+        unacked = self.unacked
+        while unacked and unacked[0][0] <= seq:
+            self.unacked_bytes -= len(unacked.popleft()[2])
+
+
+class FlowControlProtocol(asyncio.Protocol):
+    '''
+    Protocol that coalesces its writes and can wait for its transport's write buffer to drain
+    '''
+    write_paused = None     # future set while the transport's write buffer is over its high-water mark
+    flush_bytes = 64 * 1024     # flush right away once this much is waiting
+    sending_file = False    # a spilled frame is being written, other frames wait behind it in pending_out
+
+    def __init__(self, coalesce_delay=0):
+        self.transport = None
+        self.coalesce_delay = coalesce_delay    # seconds to wait for more frames, 0 flushes once per loop iteration
+        self.outbox = []            # buffers waiting for the next flush
+        self.outbox_bytes = 0
+        self.flush_handle = None
+        self.pending_out = collections.deque()  # (parts, size, SpilledFrame or None) behind a spilled frame
+
+    def write_parts(self, parts, size):
+        '''
+        Queue the buffers of a frame (size bytes in total) for the next flush, behind a spilled frame
+        that is being written
+        '''
+        if self.sending_file:
+            self.pending_out.append((parts, size, None))
+        else:
+            self.queue_parts(parts, size)
+
+    def queue_parts(self, parts, size):
+        '''
+        Add the buffers to the outbox, flushing it if it has grown large enough
+        '''
+        self.outbox += parts
+        self.outbox_bytes += size
+        if self.outbox_bytes >= self.flush_bytes:
+            self.flush()
+        elif self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self.coalesce_delay:
+                self.flush_handle = loop.call_later(self.coalesce_delay, self.flush)
+            else:
+                self.flush_handle = loop.call_soon(self.flush)
+
+    def write_frame(self, parts, size):
+        '''
+        Queue a frame whose last part may be a spilled payload, which is then written from its file
+        '''
+        if isinstance(parts[-1], framing.SpilledFrame):
+            self.write_file(parts[:-1], size, parts[-1])
+        else:
+            self.write_parts(parts, size)
+
+    def write_file(self, parts, size, frame):
+        '''
+        Write a frame whose payload was spilled to a file: its header parts, then the payload read back
+        in pieces as the transport takes them. Frames written meanwhile wait behind it.
+        '''
+        self.pending_out.append((parts, size, frame))
+        if not self.sending_file:
+            self.sending_file = True
+            asyncio.get_running_loop().create_task(self.send_files())
+
+    async def send_files(self):
+        try:
+            while self.pending_out and not self.closed():
+                parts, size, frame = self.pending_out.popleft()
+                self.queue_parts(parts, size - (len(frame) if frame is not None else 0))
+                if frame is None:
+                    continue
+                for chunk in frame.chunks():
+                    self.queue_parts([chunk], len(chunk))
+                    await self.drain()
+                    if self.closed():
+                        break
+        finally:
+            self.sending_file = False
+            self.pending_out.clear()
+        if not self.closed():
+            self.files_sent()
+
+    def files_sent(self):
+        '''
+        Called once the spilled frames and the frames behind them are written
+        '''
+
+    def closed(self):
+        return self.transport is None or self.transport.is_closing()
+
+    def flush(self):
+        '''
+        Write out the queued buffers. While the transport has nothing buffered they go straight to the
+        socket in one writev, whatever the socket does not take is left to the transport.
+        '''
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        parts = self.outbox
+        self.outbox = []
+        self.outbox_bytes = 0
+        if not parts or self.transport is None or self.transport.is_closing():
+            return
+        if hasattr(os, 'writev') and not self.transport.get_write_buffer_size():
+            try:
+                sent = os.writev(self.transport.get_extra_info('socket').fileno(), parts[:framing.IOV_MAX])
+            except OSError:
+                sent = 0        # would block, or an error the transport reports when it writes
+            parts = framing.unsent(parts, sent)
+        if parts:
+            self.transport.writelines(parts)
+
+    def pause_writing(self):
+        if self.write_paused is None:
+            self.write_paused = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self.write_paused is not None:
+            self.write_paused.set_result(None)
+            self.write_paused = None
+
+    async def drain(self):
+        '''
+        Wait until the transport has flushed enough of its write buffer
+        '''
+        if self.write_paused is not None:
+            await self.write_paused
+
+
+class ClientConnection(FlowControlProtocol):
+    '''
+    One connected client. The protocol version is picked from the first bytes received: v2 clients
+    open with framing.V2_MAGIC and a HELLO frame, legacy clients send their username frame right away.
+    Every later frame is a message that is handed to the relay for forwarding, or a control message.
+    '''
+    def __init__(self, relay):
+        super().__init__(relay.coalesce_delay)
+        self.relay = relay
+        self.connection_id = next(relay.connection_ids)     # one username may have several connections
+        self.handshake = bytearray()
+        self.parser = None
+        self.version = None
+        self.address = None
+        self.sender = None          # our identity, set once the username is known
+        self.codec = None           # v2: negotiated framing.Codec, None to send frames uncompressed
+        self.session = None         # v2: Session if the client asked for one
+        self.ack_handle = None      # timer for acknowledging the client's frames
+        self.role = None            # v2: role announced in HELLO, for rate limits
+        self.bucket = None          # TokenBucket limiting the DATA bytes handled for this client
+        self.inbound = collections.deque()  # (frame, read at) received but not handled yet
+        self.inbound_bytes = 0
+        self.scheduled = False      # waiting for its turn in the scheduler
+        self.reading_paused = False
+        self.closing = False        # closed by the relay, remaining frames are dropped
+        self.last_heard = time.monotonic()  # when the client last sent anything
+        self.streams = {}           # v2: stream id -> Stream of an identity hosted on this connection
+        self.max_frame = None       # v2: longest frame the client accepts, from its HELLO
+        self.known_senders = set()  # v2: sender ids already announced to this client with a PEER frame
+        self.verkeys = set()        # keys registered by this client
+        self.delivering = set()     # keys whose mailbox is currently being delivered to this client
+        # (sender, payload, kid, read_at) waiting for the socket to become writable, by lane
+        self.queue = LaneQueue(relay.lane_weights)
+        self.queued_bytes = 0
+        self.dropped = 0            # messages dropped by the drop-oldest policy
+        self.spilled = set()        # keys whose messages go to the spill log because the queue was full
+        self.unspilling = set()     # keys whose spill log is being sent
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_out = 0
+        self.bytes_out = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Unix domain socket peers have no name
+        self.address = transport.get_extra_info('peername') or 'unix:{}'.format(self.relay.unix_path)
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            # writes are already coalesced here, Nagle would only hold back the last segment of a batch
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.relay.heartbeat_interval:
+                keepalive(sock, self.relay.heartbeat_interval)
+        self.relay.connections.add(self)
+
+    def data_received(self, data):
+        self.bytes_in += len(data)
+        self.last_heard = time.monotonic()
+        if self.parser is None:
+            data = self.negotiate(data)
+            if data is None:
+                return
+        self.parser.feed(data)
+        try:
+            frames = self.parser.frames()
+        except framing.FrameError as e:
+            self.close('{}'.format(e))
+            return
+        if not frames:
+            return
+        self.frames_in += len(frames)
+        # forward latency is measured from here
+        read_at = time.monotonic()
+        for frame in frames:
+            if self.version == 2 and frame[0] in (framing.ACK, framing.PING, framing.PONG) and self.sender is not None:
+                # control lane, handled right away rather than behind the messages waiting their turn
+                if not self.closing:
+                    self.v2_frame(frame[0], frame[2])
+                continue
+            self.inbound.append((frame, read_at))
+            self.inbound_bytes += len(frame[2] if self.version == 2 else frame)
+            if self.version == 2 and isinstance(frame[2], framing.SpilledFrame):
+                self.relay.metrics.inc('frames_spilled_total')
+        self.relay.scheduler.add(self)
+        if self.inbound_bytes > self.relay.inbound_bytes and not self.reading_paused:
+            # stop reading until the scheduler catches up
+            self.reading_paused = True
+            self.transport.pause_reading()
+            self.relay.metrics.inc('reading_paused_total')
+
+    def process(self, budget, limited=True):
+        '''
+        Handle received frames until budget bytes are spent. Returns the seconds until the client may
+        send more if it ran out of tokens, otherwise None.
+        '''
+        relay = self.relay
+        spent = 0
+        wait = None
+        while self.inbound and spent < budget and not self.closing:
+            frame, read_at = self.inbound[0]
+            if self.version == 2:
+                size = len(frame[2])
+                data = frame[0] & ~(framing.COMPRESSED | framing.STREAM | framing.BULK) == framing.DATA
+            else:
+                size = len(frame)
+                data = self.sender is not None
+            bucket = self.frame_bucket(frame) if limited and data else None
+            if bucket is not None:
+                wait = bucket.reserve(size)
+                if wait is not None:
+                    relay.metrics.inc('rate_limited_total')
+                    break
+            self.inbound.popleft()
+            self.inbound_bytes -= size
+            spent += size
+            relay.read_at = read_at
+            if self.version == 2:
+                self.v2_frame(frame[0], frame[2])
+            else:
+                self.legacy_frame(frame)
+        relay.read_at = None
+        if self.closing:
+            self.inbound.clear()
+            self.inbound_bytes = 0
+        if self.session is not None and self.session.client is self and not self.closed():
+            self.acknowledge()
+        if self.reading_paused and self.inbound_bytes <= relay.inbound_bytes // 2 and not self.closed():
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return wait
+
+    def negotiate(self, data):
+        '''
+        Pick the protocol version from the first bytes. Returns the data left to parse, or None if
+        more bytes are needed.
+        '''
+        self.handshake += data
+        magic = framing.V2_MAGIC
+        if self.handshake[:1] != magic[:1]:
+            self.version = 1
+            self.parser = framing.FrameParser(self.relay.max_frame_bytes)
+            return bytes(self.handshake)
+        if len(self.handshake) < len(magic):
+            return None
+        if not self.handshake.startswith(magic):
+            self.close('Invalid protocol header')
+            return None
+        self.version = 2
+        self.parser = framing.V2FrameParser(self.relay.max_frame_bytes, self.relay.spill_frame_bytes,
+                                            self.relay.spill_dir)
+        return bytes(self.handshake[len(magic):])
+
+    def legacy_frame(self, payload):
+        if self.sender is None:
+            # Client should send his name right away
+            self.sender = self.relay.sender(payload)
+            self.relay.add_client(self)
+            return
+        control = framing.decode_control(payload)
+        if control is None:
+            self.relay.forward(self, payload)
+        else:
+            self.relay.control(self, control)
+
+    def frame_bucket(self, frame):
+        '''
+        TokenBucket a received DATA frame is charged to: for a stream frame the one of the stream's
+        identity, so one identity cannot use up the rate of the others on the connection
+        '''
+        if self.version == 2 and frame[0] & framing.STREAM:
+            if len(frame[2]) < framing.STREAM_ID.size:
+                return None     # v2_frame closes the connection
+            stream = self.streams.get(framing.STREAM_ID.unpack_from(frame[2])[0])
+            return stream.bucket if stream is not None else None
+        return self.bucket
+
+    def v2_frame(self, frame_type, payload):
+        if frame_type & framing.STREAM:
+            if self.sender is None or len(payload) < framing.STREAM_ID.size:
+                self.close('Invalid stream frame')
+                return
+            stream_id, = framing.STREAM_ID.unpack_from(payload)
+            self.stream_frame(frame_type & ~framing.STREAM, stream_id, payload[framing.STREAM_ID.size:])
+            return
+        lane = framing.LANE_BULK if frame_type & framing.BULK else None
+        frame_type &= ~framing.BULK
+        if frame_type & framing.COMPRESSED:
+            if self.codec is None:
+                self.close('Compressed frame without a negotiated codec')
+                return
+            try:
+                payload = self.relay.decompress(self.codec, payload)
+            except framing.FrameError as e:
+                self.close('{}'.format(e))
+                return
+            frame_type &= ~framing.COMPRESSED
+        if frame_type == framing.DATA and self.sender is not None:
+            if self.session is not None:
+                self.session.received += 1
+            self.relay.forward(self, payload, lane)
+        elif frame_type == framing.ACK and self.session is not None and len(payload) == framing.ACK_PAYLOAD.size:
+            self.session.acked(framing.ACK_PAYLOAD.unpack(payload)[0])
+        elif frame_type == framing.PING:
+            self.write_parts([framing.encode_v2_header(framing.PONG, len(payload)), payload],
+                             framing.V2_HEADER.size + len(payload))
+        elif frame_type == framing.PONG:
+            pass        # being heard from is all that counts
+        elif frame_type == framing.CONTROL and self.sender is not None:
+            try:
+                control = json.loads(payload)
+            except ValueError:
+                self.close('Invalid control message')
+                return
+            self.relay.control(self, control)
+        elif frame_type == framing.HELLO and self.sender is None:
+            try:
+                hello = json.loads(payload)
+                username = hello['username'].encode('utf-8')
+                self.sender = self.relay.sender(username)
+                self.role = hello.get('role')
+                if hello.get('max_frame') is not None:
+                    self.max_frame = int(hello['max_frame'])
+                welcome = {'sender_id': self.sender.id, 'max_frame': self.relay.max_frame_bytes, 'lanes': True}
+                if hello.get('session') is not None and self.relay.session_ttl:
+                    welcome.update(self.relay.open_session(self, hello.get('session'), int(hello.get('received', 0))))
+            except (ValueError, KeyError, AttributeError, TypeError):
+                self.close('Invalid HELLO')
+                return
+            codec = framing.pick_codec(hello.get('compression') or [], self.relay.codecs)
+            if codec is not None:
+                self.codec = self.relay.codecs[codec]
+                welcome['compression'] = codec
+            welcome = json.dumps(welcome).encode('utf-8')
+            self.transport.write(framing.encode_v2_frame(framing.WELCOME, welcome, self.sender.id))
+            self.relay.add_client(self)
+            if self.session is not None:
+                self.relay.resume_session(self)
+        else:
+            self.close('Unexpected frame type {}'.format(frame_type))
+
+    def stream_frame(self, frame_type, stream_id, payload):
+        '''
+        Frame of one of the identities hosted on this connection
+        '''
+        stream = self.streams.get(stream_id)
+        if frame_type == framing.OPEN:
+            if stream is not None:
+                self.close('Stream {} is already open'.format(stream_id))
+                return
+            try:
+                hello = json.loads(payload)
+                sender = self.relay.sender(hello['username'].encode('utf-8'))
+            except (ValueError, KeyError, AttributeError, TypeError):
+                self.close('Invalid OPEN')
+                return
+            stream = self.streams[stream_id] = Stream(self, stream_id, sender, hello.get('role'))
+            self.relay.add_client(stream)
+        elif stream is None:
+            self.close('Frame for stream {} that is not open'.format(stream_id))
+        elif frame_type == framing.CLOSE:
+            del self.streams[stream_id]
+            stream.connection_lost(None)
+        else:
+            stream.v2_frame(frame_type, payload)
+
+    def close(self, reason):
+        print('Closed connection from {}: {}'.format(self.address, reason))
+        self.closing = True
+        self.flush()
+        self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        self.outbox = []
+        self.pending_out.clear()
+        if self.inbound and self.session is None:
+            # the client is gone but what it sent is still handled
+            self.process(float('inf'), limited=False)
+        # in a session, frames not handled yet are not acknowledged and the client sends them again
+        self.closing = True
+        self.inbound.clear()
+        self.inbound_bytes = 0
+        if self.session is not None and self.session.client is self:
+            self.relay.detach_session(self)
+        self.relay.connections.discard(self)
+        for stream in self.streams.values():
+            stream.connection_lost(exc)
+        self.streams.clear()
+        self.relay.remove_client(self)
+        super().resume_writing()
+
+    def resume_writing(self):
+        super().resume_writing()
+        if not self.sending_file:
+            self.write_queues()
+
+    def write_queues(self):
+        self.write_queue()
+        for stream in list(self.streams.values()):
+            stream.write_queue()
+
+    def write_queue(self):
+        '''
+        Write out the queue until the transport's buffer is full again
+        '''
+        while self.queue and self.write_paused is None and not self.sending_file:
+            sender, payload, kid, read_at = self.queue.popleft()
+            self.queued_bytes -= len(payload)
+            self.write(sender, payload, read_at, kid)
+        if not self.queue and self.spilled:
+            self.relay.redeliver(self)
+
+    def data_header(self, frame_type, length, sender_id):
+        '''
+        v2 header of a message frame to the client
+        '''
+        return framing.encode_v2_header(frame_type, length, sender_id)
+
+    def name(self):
+        return self.sender.name.decode('utf-8', 'replace') if self.sender is not None else str(self.address)
+
+    def send(self, sender, payload, kid=None, lane=None):
+        '''
+        Send a message from sender, addressed to kid, on this connection. The message is queued in its
+        lane (by default picked from its size) while the socket is not writable.
+        '''
+        if lane is None:
+            lane = self.relay.lane(payload)
+        if kid is not None and kid in self.spilled:
+            # keep ordering behind the messages already spilled for this key
+            self.relay.spill(self, kid, sender, payload)
+        elif self.max_frame is not None and len(payload) > self.max_frame:
+            print('Dropped a message of {} bytes for {}, over its limit of {}'.format(
+                len(payload), self.name(), self.max_frame))
+            self.relay.metrics.inc('oversized_dropped_total')
+        elif self.write_paused is None and not self.queue and not self.sending_file:
+            self.write(sender, payload, self.relay.read_at, kid)
+        elif self.queued_bytes + len(payload) > self.relay.queue_bytes:
+            self.relay.slow_consumer(self, sender, payload, kid, lane)
+        else:
+            self.queue.append((sender, payload, kid, self.relay.read_at), lane, len(payload))
+            self.queued_bytes += len(payload)
+
+    def hand_over(self):
+        '''
+        The relay is draining: messages for this client's keys are stored from now on, behind the ones
+        still waiting in its queue, for the relay taking over to deliver. What was written goes out ahead
+        of DRAIN, so the client acknowledges all of it before it leaves and none is stored again.
+        '''
+        if self.relay.mailbox is None:
+            return
+        self.delivering.update(self.verkeys)
+        waiting = []
+        while self.queue:
+            waiting.append(self.queue.popleft())
+        self.queued_bytes = 0
+        for sender, payload, kid, read_at in waiting:
+            if kid is not None:
+                self.relay.store(kid, sender, payload)
+            else:
+                self.queue.append((sender, payload, kid, read_at), self.relay.lane(payload), len(payload))
+                self.queued_bytes += len(payload)
+
+    def acknowledge(self):
+        '''
+        Acknowledge the client's frames right away once enough are unacknowledged, otherwise shortly
+        '''
+        session = self.session
+        if session.received - session.acked_received >= framing.ACK_EVERY:
+            self.send_ack()
+        elif session.received > session.acked_received and self.ack_handle is None:
+            self.ack_handle = asyncio.get_running_loop().call_later(framing.ACK_DELAY, self.send_ack)
+
+    def send_ack(self):
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        if self.closed():
+            return
+        self.session.acked_received = self.session.received
+        self.write_parts([framing.encode_v2_header(framing.ACK, framing.ACK_PAYLOAD.size),
+                          framing.ACK_PAYLOAD.pack(self.session.received)],
+                         framing.V2_HEADER.size + framing.ACK_PAYLOAD.size)
+
+    def write(self, sender, payload, read_at=None, kid=None, seq=None):
+        '''
+        Write a message to the transport. In a session it is kept until acknowledged, unless it is being
+        sent again under its old sequence number seq.
+        '''
+        if self.version == 2:
+            if self.session is not None and seq is None:
+                forgotten = self.session.sent_frame(sender, payload, kid)
+                if forgotten:
+                    self.relay.metrics.inc('session_frames_forgotten_total', forgotten)
+            if sender.id not in self.known_senders:
+                self.known_senders.add(sender.id)
+                self.write_parts([framing.encode_v2_header(framing.PEER, len(sender.name), sender.id), sender.name],
+                                 framing.V2_HEADER.size + len(sender.name))
+            frame_type = framing.DATA
+            if isinstance(payload, framing.SpilledFrame):
+                header = self.data_header(frame_type, len(payload), sender.id)
+                size = len(header) + len(payload)
+                self.write_file([header], size, payload)
+            elif self.codec is not None and len(payload) >= self.relay.compress_min_bytes:
+                compressed = self.relay.compress(self.codec, payload)
+                if compressed is not None:
+                    frame_type = framing.DATA | framing.COMPRESSED
+                    payload = compressed
+            if not isinstance(payload, framing.SpilledFrame):
+                header = self.data_header(frame_type, len(payload), sender.id)
+                size = len(header) + len(payload)
+                self.write_parts([header, payload], size)
+        else:
+            # legacy clients get the sender's username frame in front of every message
+            size = len(sender.user_frame) + framing.HEADER_LENGTH + len(payload)
+            parts = [sender.user_frame, framing.encode_header(len(payload))]
+            if isinstance(payload, framing.SpilledFrame):
+                self.write_file(parts, size, payload)
+            else:
+                self.write_parts(parts + [payload], size)
+        self.bytes_out += size
+        self.frames_out += 1
+        if read_at is not None:
+            self.relay.metrics.forward_latency.observe(time.monotonic() - read_at)
+
+    def files_sent(self):
+        self.write_queues()
+
+
+class Stream(ClientConnection):
+    '''
+    Identity hosted on a v2 connection. Its frames are read and written by the connection, which it
+    shares flow control with.
+    '''
+    def __init__(self, connection, stream_id, sender, role=None):
+        super().__init__(connection.relay)
+        self.connection = connection
+        self.stream_id = stream_id
+        self.transport = connection.transport
+        self.address = connection.address
+        self.version = 2
+        self.sender = sender
+        self.role = role
+        self.codec = connection.codec
+        self.known_senders = connection.known_senders   # PEER frames hold for the whole connection
+
+    @property
+    def write_paused(self):
+        return self.connection.write_paused
+
+    @property
+    def sending_file(self):
+        return self.connection.sending_file
+
+    def write_parts(self, parts, size):
+        self.connection.write_parts(parts, size)
+
+    def write_file(self, parts, size, frame):
+        self.connection.write_file(parts, size, frame)
+
+    def flush(self):
+        self.connection.flush()
+
+    def data_header(self, frame_type, length, sender_id):
+        return framing.encode_stream_header(frame_type, self.stream_id, length, sender_id)
+
+    def closed(self):
+        return self.closing or self.connection.closed()
+
+    def close(self, reason):
+        # a broken stream frame breaks the connection
+        self.connection.close('stream {}: {}'.format(self.stream_id, reason))
+
+    def connection_lost(self, exc):
+        self.closing = True
+        self.relay.remove_client(self)
+
+
+class Relay:
+    '''
+    Keeps track of connected clients and forwards every message to the clients owning its recipient keys.
+    '''
+    SLOW_CONSUMER_POLICIES = ('drop-oldest', 'spill', 'disconnect')
+    REAP_POLICIES = ('mailbox', 'drop')
+
+    def __init__(self, ip, port, mailbox=None, queue_bytes=1024 * 1024, slow_consumer='spill',
+                 metrics_port=None, metrics_dump=None, metrics_interval=60, coalesce_delay=0,
+                 compression=('zlib',), compress_min_bytes=framing.COMPRESS_MIN_BYTES,
+                 dedup_window=60, dedup_max_entries=200000, session_ttl=60, session_bytes=4 * 1024 * 1024,
+                 turn_bytes=64 * 1024, inbound_bytes=1024 * 1024, rate_limits=None, reap_policy='mailbox',
+                 heartbeat_interval=framing.HEARTBEAT_INTERVAL, idle_timeout=framing.IDLE_TIMEOUT,
+                 unix_path=None, unix_socket=None, drain_timeout=10, replaces=None, replaceable=False,
+                 max_frame_bytes=framing.MAX_FRAME_BYTES, spill_frame_bytes=None, spill_dir=None,
+                 bulk_bytes=framing.BULK_BYTES, lane_weights=(4, 1)):
+        if slow_consumer not in self.SLOW_CONSUMER_POLICIES:
+            raise ValueError('Unknown slow consumer policy: {}'.format(slow_consumer))
+        if reap_policy not in self.REAP_POLICIES:
+            raise ValueError('Unknown reap policy: {}'.format(reap_policy))
+        for name in compression:
+            if name not in framing.CODECS:
+                raise ValueError('Unknown compression codec: {}'.format(name))
+        self.ip = ip
+        self.port = port
+        self.unix_path = unix_path      # Unix domain socket to listen on as well, None for TCP only
+        self.unix_socket = unix_socket  # listening socket bound to unix_path before the cluster workers forked
+        self.drain_timeout = drain_timeout  # seconds clients get to reconnect elsewhere when the relay stops
+        self.replaces = replaces        # pid of the relay this one takes over from, signalled once listening
+        self.replaceable = replaceable  # another relay may take over from this one, and bind the port next to it
+        self.draining = False
+        self.stopped = None             # future serve_forever waits on
+        self.mailbox = mailbox      # server.mailbox.Mailbox, or None to drop messages for offline recipients
+        self.queue_bytes = queue_bytes          # cap on the payload bytes queued for one client
+        self.coalesce_delay = coalesce_delay    # seconds frames may wait to be flushed together
+        # codecs offered to v2 clients, shared by all connections
+        self.codecs = {name: framing.CODECS[name]() for name in compression}
+        self.compress_min_bytes = compress_min_bytes
+        self.compressed = None      # (payload, codec, compressed payload or None) of the last compression
+        self.session_ttl = session_ttl  # seconds a session waits for its client to resume, 0 disables them
+        self.session_bytes = session_bytes      # cap on the unacknowledged payload bytes kept per session
+        self.sessions = {}          # token -> Session
+        self.scheduler = Scheduler(turn_bytes)
+        self.inbound_bytes = inbound_bytes      # received bytes queued per client before reading pauses
+        self.rate_limits = rate_limits or {}    # username, 'role:NAME' or '*' -> (bytes per second, burst)
+        self.buckets = {}           # username -> TokenBucket, shared by the user's connections
+        self.heartbeat_interval = heartbeat_interval    # seconds of silence before a client is pinged, 0 disables
+        self.idle_timeout = idle_timeout    # seconds of silence before a connection is reaped
+        self.reap_policy = reap_policy      # what happens to messages pending for a reaped client
+        self.max_frame_bytes = max_frame_bytes      # longest frame accepted from a client
+        self.spill_frame_bytes = spill_frame_bytes  # DATA frames this long are kept in a file, None keeps all in memory
+        self.spill_dir = spill_dir      # directory of those files, None for the system's temporary directory
+        self.bulk_bytes = bulk_bytes    # messages this long are sent in the bulk lane, 0 to only go by the sender
+        # share of the output of the interactive and bulk lanes while a client's messages are queued
+        self.lane_weights = {framing.LANE_INTERACTIVE: lane_weights[0], framing.LANE_BULK: lane_weights[1]}
+        # digests of recently forwarded packed messages, None to forward duplicates
+        self.duplicates = DuplicateCache(dedup_window, dedup_max_entries) if dedup_window else None
+        self.metrics = Metrics(self)
+        self.metrics_port = metrics_port        # local HTTP port for /metrics, None to disable
+        self.metrics_dump = metrics_dump        # file to append snapshots to, None to disable
+        self.metrics_interval = metrics_interval
+        self.read_at = None         # monotonic time the message being forwarded was read, None for stored ones
+        self.slow_consumer_policy = slow_consumer
+        self.cluster = None         # server.cluster.Cluster when running as one of several worker processes
+        self.federation = None      # server.federation.Federation when peering with the relays of other sites
+        self.connections = set()    # every open ClientConnection, including ones still in their handshake
+        self.connection_ids = itertools.count(1)    # numbers the connections and streams, for metrics
+        self.clients = set()
+        self.unregistered = set()   # clients that have not registered any verkey
+        self.routes = {}            # verkey -> client owning it
+        self.senders = {}           # username -> Sender
+        self.sender_ids = itertools.count(1)
+        self.server = None
+        self.unix_server = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.cluster is not None:
+            await self.cluster.start()
+        if self.federation is not None:
+            await self.federation.start()
+        # workers of a cluster share the listening port, the kernel spreads connections between them. A
+        # relay replacing this one binds it too and gets the new connections once this one stops accepting.
+        # Otherwise the port is not shared, so a relay started twice by mistake fails to bind.
+        reuse_port = ((self.cluster is not None or self.replaces is not None or self.replaceable)
+                      and hasattr(socket, 'SO_REUSEPORT'))
+        self.server = await loop.create_server(lambda: ClientConnection(self), self.ip, self.port,
+                                               reuse_address=True, reuse_port=reuse_port)
+        if self.mailbox is not None:
+            loop.create_task(self.expire_mailbox())
+        if self.heartbeat_interval:
+            loop.create_task(self.heartbeat())
+        if self.metrics_port is not None:
+            # every worker of a cluster gets its own port
+            worker = self.cluster.index if self.cluster is not None else 0
+            await self.metrics.serve('127.0.0.1', self.metrics_port + worker)
+        if self.metrics_dump is not None:
+            loop.create_task(self.metrics.dump_periodically(self.metrics_dump, self.metrics_interval))
+        print(f'Listening for connections on {self.ip}:{self.port}...')
+        if self.unix_path is not None:
+            if self.unix_socket is None:
+                self.unix_socket = bind_unix(self.unix_path, replace=self.replaces is not None)
+            self.unix_server = await loop.create_unix_server(lambda: ClientConnection(self), sock=self.unix_socket)
+            print(f'Listening for connections on unix://{self.unix_path}...')
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+        except (NotImplementedError, AttributeError):
+            pass        # no signal handlers in this event loop, the relay just dies on SIGTERM
+        if self.replaces is not None and (self.cluster is None or self.cluster.index == 0):
+            try:
+                os.kill(self.replaces, signal.SIGTERM)
+                print('Taking over from relay {}'.format(self.replaces))
+            except ProcessLookupError:
+                pass
+        if self.replaces is not None:
+            loop.create_task(self.take_over_mailbox(self.replaces))
+
+    async def expire_mailbox(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            self.mailbox.expire()
+
+    async def heartbeat(self):
+        '''
+        Ping the v2 clients that have gone quiet and reap the connections that stayed silent too long
+        '''
+        while True:
+            await asyncio.sleep(min(self.heartbeat_interval, self.idle_timeout) / 2)
+            now = time.monotonic()
+            for client in list(self.connections):
+                if client.closed():
+                    continue
+                idle = now - client.last_heard
+                # legacy clients have no reason to talk once they sent their username
+                quiet = client.version == 1 and client.sender is not None
+                if idle >= self.idle_timeout and not quiet:
+                    self.reap(client, idle)
+                elif idle >= self.heartbeat_interval and client.version == 2 and client.sender is not None:
+                    client.write_parts([framing.encode_v2_header(framing.PING, 0)], framing.V2_HEADER.size)
+                    self.metrics.inc('pings_sent_total')
+
+    def reap(self, client, idle):
+        '''
+        Close a connection that has been silent for idle seconds. Its pending messages go to the mailbox
+        as they do when any client leaves, or are dropped under the drop policy.
+        '''
+        print('Reaping connection from {}: nothing heard for {:.0f}s'.format(client.name(), idle))
+        self.metrics.inc('connections_reaped_total')
+        if self.reap_policy == 'drop':
+            dropped = len(client.queue)
+            client.queue.clear()
+            client.queued_bytes = 0
+            for kid in client.spilled - client.unspilling:
+                dropped += sum(1 for _ in self.mailbox.read(self.spill_key(kid)))
+            client.spilled.clear()
+            if client.session is not None:
+                # the session stays for the client to resume, without the messages
+                dropped += len(client.session.unacked)
+                client.session.unacked.clear()
+                client.session.unacked_bytes = 0
+            client.dropped += dropped
+            self.metrics.inc('dropped_total', dropped)
+        client.closing = True
+        # a dead peer never reads the write buffer, closing would wait for it forever
+        client.transport.abort()
+
+    async def serve_forever(self):
+        self.stopped = asyncio.get_running_loop().create_future()
+        await self.start()
+        await self.stopped
+
+    def stop(self):
+        if not self.draining:
+            self.draining = True
+            asyncio.get_running_loop().create_task(self.drain())
+
+    async def drain(self):
+        '''
+        Stop accepting, have the clients reconnect (to the relay taking over the port) and put whatever
+        is still pending for them in the mailbox before stopping
+        '''
+        print('Draining {} connections'.format(len(self.connections)))
+        self.server.close()
+        if self.unix_server is not None:
+            self.unix_server.close()
+        drain = json.dumps({'reconnect_within': self.drain_timeout / 2}).encode('utf-8')
+        for client in list(self.connections):
+            if client.version == 2 and client.sender is not None:
+                if client.session is not None and client.session.client is client:
+                    client.send_ack()       # what we got is not sent to the next relay again
+                client.hand_over()
+                for stream in client.streams.values():
+                    stream.hand_over()
+                client.write_parts([framing.encode_v2_header(framing.DRAIN, len(drain)), drain],
+                                   framing.V2_HEADER.size + len(drain))
+        deadline = time.monotonic() + self.drain_timeout
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for client in list(self.connections):
+            if client.session is not None and client.session.client is client and not client.closed():
+                client.send_ack()           # it may have sent more since DRAIN
+            client.close('relay restarting')
+        # give the closing transports a moment to write out what they have
+        deadline = time.monotonic() + 1
+        while self.connections and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for client in list(self.connections):
+            client.transport.abort()
+        await asyncio.sleep(0)
+        for session in list(self.sessions.values()):
+            if session.expiry is not None:
+                session.expiry.cancel()
+            self.expire_session(session)
+        if self.cluster is not None:
+            # other workers may still have messages for our clients on the way, they are stored when they arrive
+            await asyncio.sleep(1)
+        print('Drained, stopping')
+        self.stopped.set_result(None)
+
+    async def take_over_mailbox(self, pid, interval=1):
+        '''
+        While the relay we replace drains, mail it stores for clients that already moved here is
+        delivered from the (shared) mailbox, and once more after it exited
+        '''
+        if self.mailbox is None:
+            return
+        self.mailbox.shared = True
+        running = True
+        while running:
+            await asyncio.sleep(interval)
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                running = False
+            except PermissionError:
+                pass
+            for kid, client in list(self.routes.items()):
+                if kid not in client.delivering and self.mailbox.has_mail(kid):
+                    self.register(client, [kid])
+        self.mailbox.shared = False
+
+    def sender(self, name):
+        '''
+        Sender for a username, assigning it a numeric id the first time it is seen
+        '''
+        sender = self.senders.get(name)
+        if sender is None:
+            sender = self.senders[name] = Sender(name, next(self.sender_ids))
+        return sender
+
+    def rate_limit(self, client):
+        '''
+        TokenBucket for the client's username, role or all clients, or None if the client is not limited
+        '''
+        name = client.sender.name.decode('utf-8', 'replace')
+        for who in (name, 'role:{}'.format(client.role), '*'):
+            if who in self.rate_limits:
+                break
+        else:
+            return None
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = TokenBucket(*self.rate_limits[who])
+        return bucket
+
+    def add_client(self, client):
+        client.bucket = self.rate_limit(client)
+        self.clients.add(client)
+        self.metrics.inc('connections_total')
+        self.unregistered.add(client)
+        print('Accepted new connection from {}, username: {}'.format(client.address, client.name()))
+
+    def remove_client(self, client):
+        if client in self.clients:
+            self.clients.discard(client)
+            self.unregistered.discard(client)
+            for verkey in client.verkeys:
+                if self.routes.get(verkey) is client:
+                    del self.routes[verkey]
+                    if self.cluster is not None:
+                        self.cluster.release(verkey)
+            if client.verkeys and self.federation is not None:
+                self.federation.changed()
+            # messages still queued or spilled for the client go to the mailbox
+            for sender, payload, kid, _ in client.queue:
+                if kid is not None:
+                    self.route_offline(kid, sender, payload)
+            client.queue.clear()
+            client.queued_bytes = 0
+            for kid in client.spilled - client.unspilling:
+                for sender_name, payload in self.mailbox.read(self.spill_key(kid)):
+                    self.route_offline(kid, self.sender(sender_name), payload)
+            print('Closed connection from: {}'.format(client.name()))
+
+    def open_session(self, client, token, received):
+        '''
+        Attach client to the session named by token, or to a new session if that one is not kept (or
+        belongs to another user). received is the number of frames the client got in the session.
+        Returns the session fields for WELCOME.
+        '''
+        session = self.sessions.get(token) if token else None
+        if session is None or session.name != client.sender.name:
+            session = Session(secrets.token_urlsafe(16), client.sender.name, self.session_bytes)
+            self.sessions[session.token] = session
+            session.client = client
+            client.session = session
+            return {'session': session.token, 'resumed': False, 'seq': 0, 'received': 0}
+
+        if session.expiry is not None:
+            session.expiry.cancel()
+            session.expiry = None
+        old = session.client
+        if old is not None:
+            # the client reconnected before its old connection was noticed dead
+            session.verkeys = set(old.verkeys)
+            old.session = None
+            old.transport.abort()
+        session.acked(received)
+        session.client = client
+        client.session = session
+        self.metrics.inc('sessions_resumed_total')
+        seq = session.unacked[0][0] - 1 if session.unacked else session.sent
+        return {'session': session.token, 'resumed': True, 'seq': seq, 'received': session.received}
+
+    def resume_session(self, client):
+        '''
+        Send the resumed client the frames it has not acknowledged, and register its keys again
+        '''
+        session = client.session
+        for seq, sender, payload, kid in list(session.unacked):
+            client.write(sender, payload, None, kid, seq)
+        self.metrics.inc('session_frames_resent_total', len(session.unacked))
+        if session.verkeys:
+            self.register(client, session.verkeys)
+
+    def detach_session(self, client):
+        session = client.session
+        session.client = None
+        session.verkeys = set(client.verkeys)
+        session.expiry = asyncio.get_running_loop().call_later(self.session_ttl, self.expire_session, session)
+
+    def expire_session(self, session):
+        '''
+        The session's client did not come back, its unacknowledged messages go to the mailbox
+        '''
+        del self.sessions[session.token]
+        for _, sender, payload, kid in session.unacked:
+            if kid is not None:
+                self.route_offline(kid, sender, payload)
+        session.unacked.clear()
+
+    def control(self, client, msg):
+        '''
+        Handle a control message sent by a client
+        '''
+        if msg.get('@type') == framing.REGISTER:
+            self.register(client, msg.get('verkeys', []))
+        else:
+            print('Unknown control message from {}: {}'.format(client.name(), msg.get('@type')))
+
+    def register(self, client, verkeys):
+        '''
+        Route messages for the given verkeys to client. A key registered again by another client moves to it.
+        '''
+        for verkey in verkeys:
+            owner = self.routes.get(verkey)
+            if owner is not None and owner is not client:
+                owner.verkeys.discard(verkey)
+            self.routes[verkey] = client
+            client.verkeys.add(verkey)
+            if self.cluster is not None:
+                # the worker owning the key's partition keeps its mailbox, it clears delivering when done
+                client.delivering.add(verkey)
+                self.cluster.claim(verkey)
+            elif self.mailbox is not None and verkey not in client.delivering and self.mailbox.has_mail(verkey):
+                client.delivering.add(verkey)
+                asyncio.get_running_loop().create_task(self.deliver_mailbox(client, verkey))
+        self.unregistered.discard(client)
+        if self.federation is not None:
+            self.federation.changed()
+
+    async def deliver_mailbox(self, client, verkey):
+        '''
+        Stream the messages queued for verkey to client. Messages arriving for verkey meanwhile are
+        appended to the mailbox so they are delivered after the queued ones.
+        '''
+        count = 0
+        try:
+            for sender, payload in self.mailbox.read(verkey):
+                if client.closed():
+                    return
+                client.send(self.sender(sender), payload, verkey)
+                count += 1
+                await client.drain()
+        finally:
+            client.delivering.discard(verkey)
+            self.metrics.inc('mailbox_delivered_total', count)
+        print('Delivered {} queued messages to {}'.format(count, client.name()))
+
+    def mail_waiting(self, client, kid):
+        '''
+        While taking over from a draining relay, mail it stored for kid after the client moved here is
+        delivered before newer messages. Returns True if there is any, the delivery is then started.
+        '''
+        if self.mailbox is None or not self.mailbox.shared or self.cluster is not None:
+            return False
+        if not self.mailbox.has_mail(kid):
+            return False
+        client.delivering.add(kid)
+        asyncio.get_running_loop().create_task(self.deliver_mailbox(client, kid))
+        return True
+
+    def lane(self, payload):
+        return framing.LANE_BULK if self.bulk_bytes and len(payload) >= self.bulk_bytes else framing.LANE_INTERACTIVE
+
+    def forward(self, source, payload, lane=None):
+        '''
+        Forward the message to the clients owning its recipient keys, in the given lane or the one its
+        size puts it in
+        '''
+        sender = source.sender
+        self.metrics.frame_size.observe(len(payload))
+        spilled = isinstance(payload, framing.SpilledFrame)
+        # the header of a packed message is at its start
+        kids = framing.recipient_kids(payload.head() if spilled else payload)
+        if kids is not None and self.duplicates is not None:
+            digest = payload.digest() if spilled else hashlib.blake2b(payload, digest_size=16).digest()
+            if self.duplicates.seen(digest):
+                self.metrics.inc('duplicates_suppressed_total')
+                return
+        if kids is None:
+            # not a packed message, nothing to route on
+            targets = [(client, None) for client in self.clients if client is not source]
+            if self.cluster is not None:
+                self.cluster.broadcast(sender, payload)
+        else:
+            targets = self.resolve(kids, sender, payload)
+            targets.pop(source, None)
+            targets = targets.items()
+        for client, kid in targets:
+            client.send(sender, payload, kid, lane)
+
+    def resolve(self, kids, sender, payload):
+        '''
+        Local clients owning the recipient keys, mapped to the key they own. Messages for other keys are
+        handed to the cluster or stored in the mailbox.
+        '''
+        targets = {}
+        unresolved = False
+        for kid in kids:
+            client = self.routes.get(kid)
+            if client is not None and kid not in client.delivering and not self.mail_waiting(client, kid):
+                targets[client] = kid
+            elif self.cluster is not None and not self.draining:
+                # owner is on another worker, offline, or being sent its mailbox
+                self.cluster.route(kid, sender, payload)
+            elif client is None and self.federation is not None and self.federation.route(kid, sender, payload):
+                pass        # owned by a client of another site
+            else:
+                # offline, or keep ordering behind the queued messages being delivered
+                unresolved = unresolved or client is None
+                self.store(kid, sender, payload)
+        if unresolved:
+            # the owner may be a client that does not register its keys
+            for client in self.unregistered:
+                targets.setdefault(client, None)
+        return targets
+
+    def compress(self, codec, payload):
+        '''
+        payload compressed with codec, or None if that does not make it smaller. The last result is
+        kept, so a message fanned out to several clients is only compressed once.
+        '''
+        last = self.compressed
+        if last is not None and last[0] is payload and last[1] is codec:
+            return last[2]
+        start = time.process_time()
+        compressed = codec.compress(payload)
+        self.metrics.inc('compression_seconds_total', time.process_time() - start)
+        self.metrics.inc('compression_in_bytes_total', len(payload))
+        self.metrics.inc('compression_out_bytes_total', len(compressed))
+        if len(compressed) >= len(payload):
+            compressed = None
+        self.compressed = (payload, codec, compressed)
+        return compressed
+
+    def decompress(self, codec, data):
+        '''
+        Decompress a frame received from a client, which may not expand past max_frame_bytes. Remembered
+        as the compressed form of the message, so forwarding it to clients using the same codec needs no
+        compression.
+        '''
+        start = time.process_time()
+        payload = codec.decompress(data, self.max_frame_bytes)
+        self.metrics.inc('decompression_seconds_total', time.process_time() - start)
+        self.metrics.inc('decompression_in_bytes_total', len(data))
+        self.metrics.inc('decompression_out_bytes_total', len(payload))
+        self.compressed = (payload, codec, data)
+        return payload
+
+    def store(self, kid, sender, payload):
+        if self.mailbox is not None:
+            if not self.mailbox.append(kid, sender.name, payload):
+                self.metrics.inc('mailbox_rejected_total')
+                return
+            self.metrics.inc('mailbox_stored_total')
+            if self.federation is not None:
+                self.federation.stored.add(kid)
+
+    def route_offline(self, kid, sender, payload):
+        '''
+        Hand a message for a key that lost its local owner to the key's new owner, the cluster or the mailbox
+        '''
+        client = self.routes.get(kid)
+        if client is not None and kid not in client.delivering:
+            client.send(sender, payload, kid)
+        elif self.cluster is not None and not self.draining:
+            # a draining worker stores it itself, the key's home may already be gone
+            self.cluster.route(kid, sender, payload)
+        elif self.federation is None or not self.federation.route(kid, sender, payload):
+            self.store(kid, sender, payload)
+
+    def slow_consumer(self, client, sender, payload, kid, lane):
+        '''
+        Apply the slow consumer policy to a message for a client whose outbound queue is full
+        '''
+        policy = self.slow_consumer_policy
+        if policy == 'spill' and (kid is None or self.mailbox is None):
+            policy = 'drop-oldest'      # nothing to spill to
+        if policy == 'drop-oldest':
+            # bulk messages go first
+            while client.queue and client.queued_bytes + len(payload) > self.queue_bytes:
+                _, dropped, _, _ = client.queue.drop()
+                client.queued_bytes -= len(dropped)
+                client.dropped += 1
+                self.metrics.inc('dropped_total')
+            if client.queued_bytes + len(payload) <= self.queue_bytes:
+                client.queue.append((sender, payload, kid, self.read_at), lane, len(payload))
+                client.queued_bytes += len(payload)
+            else:
+                client.dropped += 1
+                self.metrics.inc('dropped_total')
+        elif policy == 'spill':
+            self.spill(client, kid, sender, payload)
+        else:
+            print('Slow consumer {}: disconnecting'.format(client.name()))
+            self.metrics.inc('slow_consumer_disconnects_total')
+            # queued messages go to the mailbox when the connection is cleaned up
+            if kid is not None:
+                client.queue.append((sender, payload, kid, None), lane, len(payload))
+            client.transport.abort()
+
+    def spill_key(self, kid):
+        '''
+        Mailbox key of this process's spill log for kid, separate from the key's own mailbox
+        '''
+        return '{}#spill{}'.format(kid, self.cluster.index if self.cluster is not None else 0)
+
+    def spill(self, client, kid, sender, payload):
+        '''
+        Put a message for a slow client in its spill log. Later messages for the key follow it there
+        until the queue has drained and the spill log has been sent.
+        '''
+        if not self.mailbox.append(self.spill_key(kid), sender.name, payload):
+            self.metrics.inc('mailbox_rejected_total')
+            return
+        client.spilled.add(kid)
+        self.metrics.inc('spilled_total')
+
+    def redeliver(self, client):
+        '''
+        The client's queue has drained, send the messages from its spill logs
+        '''
+        for kid in client.spilled - client.unspilling:
+            client.unspilling.add(kid)
+            asyncio.get_running_loop().create_task(self.unspill(client, kid))
+
+    async def unspill(self, client, kid):
+        try:
+            for sender_name, payload in self.mailbox.read(self.spill_key(kid)):
+                if client.closed():
+                    # client went away, the rest goes to its mailbox
+                    self.route_offline(kid, self.sender(sender_name), payload)
+                    continue
+                client.send(self.sender(sender_name), payload)
+                await client.drain()
+            client.spilled.discard(kid)
+        finally:
+            client.unspilling.discard(kid)
+
+    def fanout(self, sender, payload, everyone=False):
+        '''
+        Send a message to every client that has not registered its keys (or to every client), except
+        the ones connected under the sender's name
+        '''
+        for client in list(self.clients if everyone else self.unregistered):
+            if client.sender is not None and client.sender.name != sender.name:
+                client.send(sender, payload)
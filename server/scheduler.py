@@ -0,0 +1,167 @@
+""" Fair scheduling of received frames. Frames read from a client are queued on its connection and
+    handled by the scheduler, which takes the clients with frames waiting in turn and lets each
+    handle up to a byte budget per turn, so a client sending in bulk cannot hold up the loop for
+    everyone else. A client can also be held to a token bucket rate; frames over its rate wait in
+    its queue, and once the queue is full the relay stops reading from its socket.
+
+    Messages waiting to be sent to a client are queued by priority lane (LaneQueue) and the lanes
+    share the socket by weight, so interactive messages get ahead of bulk ones without starving them.
+"""
+import asyncio
+import collections
+import time
+
+
+class TokenBucket:
+    '''
+    rate bytes per second, in bursts of up to burst bytes
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        '''
+        Take amount tokens. Returns None if there were tokens left (a frame bigger than the bucket puts it
+        in debt), otherwise the seconds until there are.
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens <= 0:
+            return -self.tokens / self.rate + 0.001
+        self.tokens -= amount
+        return None
+
+
+def parse_rate_limit(spec):
+    '''
+    Parse [WHO=]RATE[:BURST], WHO being a username or role:NAME (all clients if left out), into
+    (who, rate, burst)
+    '''
+    who, _, limit = spec.rpartition('=')
+    rate, _, burst = limit.partition(':')
+    return who or '*', float(rate), float(burst) if burst else None
+
+
+class Scheduler:
+    '''
+    Round robin over the clients that have received frames waiting
+    '''
+    def __init__(self, budget=64 * 1024):
+        self.budget = budget                # bytes a client may handle per turn
+        self.ready = collections.deque()    # clients with frames to handle
+        self.handle = None
+
+    def add(self, client):
+        '''
+        client has frames waiting. A client already waiting for its turn, or for tokens, keeps its place.
+        '''
+        if not client.scheduled:
+            client.scheduled = True
+            self.ready.append(client)
+            self.wake()
+
+    def wake(self):
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_soon(self.run)
+
+    def unpark(self, client):
+        self.ready.append(client)
+        self.wake()
+
+    def run(self):
+        '''
+        Give every ready client one turn; clients with frames left get another one on the next loop iteration
+        '''
+        self.handle = None
+        for _ in range(len(self.ready)):
+            client = self.ready.popleft()
+            wait = client.process(self.budget)
+            if not client.inbound:
+                client.scheduled = False
+            elif wait is not None:
+                # over its rate, it keeps its place until the bucket refills
+                asyncio.get_running_loop().call_later(wait, self.unpark, client)
+            else:
+                self.ready.append(client)
+        if self.ready:
+            self.wake()
+
+
+class LaneQueue:
+    '''
+    Queue with a FIFO per lane, served by deficit round robin: on its turn a lane may take its weight
+    times quantum bytes, so lanes share the output by weight. A frame larger than that waits for the
+    lane's credit to build up over several turns.
+    '''
+    def __init__(self, weights, quantum=16 * 1024):
+        self.weights = dict(weights)    # lane -> weight
+        self.quantum = quantum
+        self.order = sorted(self.weights)
+        self.lanes = {lane: collections.deque() for lane in self.order}
+        self.credit = dict.fromkeys(self.order, 0)
+        self.turn = 0
+        self.credited = False   # the lane whose turn it is got its quantum for this turn
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for lane in self.order:
+            for item, _ in self.lanes[lane]:
+                yield item
+
+    def append(self, item, lane, size):
+        self.lanes[lane].append((item, size))
+        self.length += 1
+
+    def popleft(self):
+        '''
+        The next item to send. A round starts on the first lane (interactive) whenever the queue was empty.
+        '''
+        if not self.length:
+            raise IndexError('pop from an empty LaneQueue')
+        while True:
+            lane = self.order[self.turn]
+            queue = self.lanes[lane]
+            if queue and not self.credited:
+                self.credit[lane] += self.weights[lane] * self.quantum
+                self.credited = True
+            if queue and queue[0][1] <= self.credit[lane]:
+                item, size = queue.popleft()
+                self.credit[lane] = self.credit[lane] - size if queue else 0
+                self.length -= 1
+                if not self.length:
+                    self.turn = 0
+                    self.credited = False
+                return item
+            if not queue:
+                self.credit[lane] = 0
+            # the next lane's turn
+            self.turn = (self.turn + 1) % len(self.order)
+            self.credited = False
+
+    def drop(self):
+        '''
+        Remove and return the oldest item of the lowest priority lane that has any
+        '''
+        for lane in reversed(self.order):
+            if self.lanes[lane]:
+                self.length -= 1
+                if not self.length:
+                    self.turn = 0
+                    self.credited = False
+                return self.lanes[lane].popleft()[0]
+        raise IndexError('drop from an empty LaneQueue')
+
+    def clear(self):
+        for lane in self.order:
+            self.lanes[lane].clear()
+            self.credit[lane] = 0
+        self.turn = 0
+        self.credited = False
+        self.length = 0
@@ -1,141 +1,204 @@
-import socket
-import select
-
-HEADER_LENGTH = 10
+""" Relay server entry point.
+
+    Run from the repository root:
+        python -m server.server --ip 127.0.0.1 --port 1234
+    or with one worker process per core:
+        python -m server.server --workers 4
+    or also accepting agents on the same host over a Unix domain socket:
+        python -m server.server --unix /run/relay.sock
+    or replacing a running relay without dropping its clients (the old one drains and exits):
+        python -m server.server --pid-file relay.pid --take-over
+    or peering with the relay of another site:
+        python -m server.server --site b --federation-port 1300 --peer site-a.example:1300
+"""
+import argparse
+import asyncio
+import os
+
+import framing
+from server import cluster
+from server.federation import Federation
+from server.mailbox import Mailbox
+from server.relay import Relay, bind_unix
+from server.scheduler import parse_rate_limit
 
 IP = "127.0.0.1"
 PORT = 1234
 
-# Create a socket
-# socket.AF_INET - address family, IPv4, some otehr possible are AF_INET6, AF_BLUETOOTH, AF_UNIX
-# socket.SOCK_STREAM - TCP, conection-based, socket.SOCK_DGRAM - UDP, connectionless, datagrams, socket.SOCK_RAW - raw IP packets
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-# SO_ - socket option
-# SOL_ - socket option level
-# Sets REUSEADDR (as a socket option) to 1 on socket
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-# Bind, so server informs operating system that it's going to use given IP and port
-# For a server using 0.0.0.0 means to listen on all available interfaces, useful to connect locally to 127.0.0.1 and remotely to LAN interface IP
-server_socket.bind((IP, PORT))
-
-# This makes server listen to new connections
-server_socket.listen()
-
-# List of sockets for select.select()
-sockets_list = [server_socket]
-
-# List of connected clients - socket as a key, user header and name as data
-clients = {}
-
-print(f'Listening for connections on {IP}:{PORT}...')
-
-# Handles message receiving
-def receive_message(client_socket):
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Relay framed agent messages between connected clients.')
+    parser.add_argument('--ip', default=IP, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--unix', default=None, metavar='PATH',
+                        help='also listen on this Unix domain socket, for agents on the same host')
+    parser.add_argument('--mailbox-dir', default='mailbox',
+                        help='directory for messages to offline recipients, empty to disable the mailbox')
+    parser.add_argument('--mailbox-ttl', type=float, default=7 * 24 * 3600,
+                        help='seconds a queued message is kept')
+    parser.add_argument('--mailbox-max-bytes', type=int, default=64 * 1024 * 1024,
+                        help='size cap of a single recipient\'s mailbox')
+    parser.add_argument('--queue-bytes', type=int, default=1024 * 1024,
+                        help='cap on the bytes queued for a client whose socket is not writable')
+    parser.add_argument('--slow-consumer', choices=Relay.SLOW_CONSUMER_POLICIES, default='spill',
+                        help='what to do when a client\'s queue is full')
+    parser.add_argument('--coalesce-ms', type=float, default=0,
+                        help='milliseconds frames may wait to be written together, 0 flushes once per loop iteration')
+    parser.add_argument('--compression', default='zlib',
+                        help='comma separated codecs offered to v2 clients, empty to disable compression')
+    parser.add_argument('--compress-min-bytes', type=int, default=framing.COMPRESS_MIN_BYTES,
+                        help='smallest message payload that is compressed')
+    parser.add_argument('--dedup-window', type=float, default=60,
+                        help='seconds a forwarded message is remembered to drop duplicates, 0 to disable')
+    parser.add_argument('--dedup-max-entries', type=int, default=200000,
+                        help='cap on the messages remembered for duplicate suppression')
+    parser.add_argument('--session-ttl', type=float, default=60,
+                        help='seconds a disconnected client\'s session is kept for it to resume, 0 to disable sessions')
+    parser.add_argument('--session-bytes', type=int, default=4 * 1024 * 1024,
+                        help='cap on the unacknowledged message bytes kept per session')
+    parser.add_argument('--max-frame-bytes', type=int, default=framing.MAX_FRAME_BYTES,
+                        help='longest frame accepted from a client, longer ones close the connection')
+    parser.add_argument('--spill-frame-bytes', type=int, default=0,
+                        help='messages this long are kept in a temporary file rather than memory, 0 to disable')
+    parser.add_argument('--spill-dir', default=None,
+                        help='directory for those files, the system\'s temporary directory by default')
+    parser.add_argument('--bulk-bytes', type=int, default=framing.BULK_BYTES,
+                        help='messages this long are sent in the bulk lane, 0 to leave it to the sender')
+    parser.add_argument('--lane-weights', default='4:1', metavar='INTERACTIVE:BULK',
+                        help='share of a slow client\'s socket taken by interactive and bulk messages')
+    parser.add_argument('--turn-bytes', type=int, default=64 * 1024,
+                        help='received bytes a client may have handled before the next client\'s turn')
+    parser.add_argument('--inbound-bytes', type=int, default=1024 * 1024,
+                        help='received bytes queued for a client before its socket is no longer read')
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='[WHO=]RATE[:BURST]',
+                        help='limit the message bytes per second handled for a username, role:NAME, or every '
+                             'client if WHO is left out; may be repeated')
+    parser.add_argument('--heartbeat-interval', type=float, default=framing.HEARTBEAT_INTERVAL,
+                        help='seconds of silence before a v2 client is pinged, 0 disables heartbeats and reaping')
+    parser.add_argument('--idle-timeout', type=float, default=framing.IDLE_TIMEOUT,
+                        help='seconds of silence before a connection is reaped')
+    parser.add_argument('--reap-policy', choices=Relay.REAP_POLICIES, default='mailbox',
+                        help='what happens to the messages pending for a reaped client')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve /metrics on this local port (worker N of a cluster uses port + N)')
+    parser.add_argument('--metrics-dump', default=None, help='file to append a JSON metrics snapshot to')
+    parser.add_argument('--metrics-interval', type=float, default=60, help='seconds between metrics snapshots')
+    parser.add_argument('--site', default=None, help='name of this relay\'s site in the federation')
+    parser.add_argument('--federation-port', type=int, default=None,
+                        help='port to accept links from the relays of other sites on')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help='federation port of another site\'s relay to link to, may be repeated')
+    parser.add_argument('--summary-interval', type=float, default=1.0,
+                        help='seconds between routing summaries sent to peer relays')
+    parser.add_argument('--drain-timeout', type=float, default=10,
+                        help='seconds clients get to reconnect elsewhere when the relay is stopped with SIGTERM')
+    parser.add_argument('--pid-file', default=None,
+                        help='file to write the relay\'s pid to; the relay then shares its port with one started '
+                             'with --take-over')
+    parser.add_argument('--take-over', action='store_true',
+                        help='start next to the relay whose pid is in --pid-file and have it drain once this one '
+                             'is listening')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes sharing the port (needs fork and SO_REUSEPORT)')
+    args = parser.parse_args(argv)
     try:
+        args.rate_limits = {who: (rate, burst) for who, rate, burst in map(parse_rate_limit, args.rate_limit)}
+    except ValueError:
+        parser.error('invalid --rate-limit')
+    try:
+        args.lane_weights = tuple(int(weight) for weight in args.lane_weights.split(':'))
+    except ValueError:
+        args.lane_weights = ()
+    if len(args.lane_weights) != 2 or min(args.lane_weights) < 1:
+        parser.error('invalid --lane-weights')
+    if args.take_over and not args.pid_file:
+        parser.error('--take-over needs --pid-file')
+    if (args.peer or args.federation_port is not None) and args.workers > 1:
+        parser.error('federation needs a single worker process')
+    return args
+
+
+def make_relay(args):
+    mailbox = None
+    if args.mailbox_dir:
+        mailbox = Mailbox(args.mailbox_dir, ttl=args.mailbox_ttl, max_bytes=args.mailbox_max_bytes)
+    relay = Relay(args.ip, args.port, mailbox=mailbox, queue_bytes=args.queue_bytes,
+                  slow_consumer=args.slow_consumer, metrics_port=args.metrics_port,
+                  metrics_dump=args.metrics_dump, metrics_interval=args.metrics_interval,
+                  coalesce_delay=args.coalesce_ms / 1000,
+                  compression=[name for name in args.compression.split(',') if name],
+                  compress_min_bytes=args.compress_min_bytes, dedup_window=args.dedup_window,
+                  dedup_max_entries=args.dedup_max_entries, session_ttl=args.session_ttl,
+                  session_bytes=args.session_bytes, turn_bytes=args.turn_bytes,
+                  inbound_bytes=args.inbound_bytes, rate_limits=args.rate_limits,
+                  heartbeat_interval=args.heartbeat_interval, idle_timeout=args.idle_timeout,
+                  reap_policy=args.reap_policy, unix_path=args.unix,
+                  unix_socket=getattr(args, 'unix_socket', None), drain_timeout=args.drain_timeout,
+                  replaces=args.replaces, replaceable=args.pid_file is not None,
+                  max_frame_bytes=args.max_frame_bytes,
+                  spill_frame_bytes=args.spill_frame_bytes or None, spill_dir=args.spill_dir,
+                  bulk_bytes=args.bulk_bytes, lane_weights=args.lane_weights)
+    if args.peer or args.federation_port is not None:
+        peers = []
+        for peer in args.peer:
+            host, _, port = peer.rpartition(':')
+            peers.append((host, int(port)))
+        listen = (args.ip, args.federation_port) if args.federation_port is not None else None
+        Federation(relay, args.site or '{}:{}'.format(args.ip, args.port), listen=listen, peers=peers,
+                   summary_interval=args.summary_interval)
+    return relay
+
+
+def read_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
 
-        # Receive our "header" containing message length, it's size is defined and constant
-        message_header = client_socket.recv(HEADER_LENGTH)
-
-        # If we received no data, client gracefully closed a connection, for example using socket.close() or socket.shutdown(socket.SHUT_RDWR)
-        if not len(message_header):
-            return False
-
-        # Convert header to int value
-        message_length = int(message_header.decode('utf-8').strip())
-        print("\nMES LEN: ", message_length)
-
-        # Return an object of message header and message data
-        return {'header': message_header, 'data': client_socket.recv(message_length)}
-
-    except:
 
-        # If we are here, client closed connection violently, for example by pressing ctrl+c on his script
-        # or just lost his connection
-        # socket.close() also invokes socket.shutdown(socket.SHUT_RDWR) what sends information about closing the socket (shutdown read/write)
-        # and that's also a cause when we receive an empty message
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
         return False
-
-while True:
-
-    # Calls Unix select() system call or Windows select() WinSock call with three parameters:
-    #   - rlist - sockets to be monitored for incoming data
-    #   - wlist - sockets for data to be send to (checks if for example buffers are not full and socket is ready to send some data)
-    #   - xlist - sockets to be monitored for exceptions (we want to monitor all sockets for errors, so we can use rlist)
-    # Returns lists:
-    #   - reading - sockets we received some data on (that way we don't have to check sockets manually)
-    #   - writing - sockets ready for data to be send thru them
-    #   - errors  - sockets with some exceptions
-    # This is a blocking call, code execution will "wait" here and "get" notified in case any action should be taken
-    read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list)
-
-
-    # Iterate over notified sockets
-    for notified_socket in read_sockets:
-
-        # If notified socket is a server socket - new connection, accept it
-        if notified_socket == server_socket:
-
-            # Accept new connection
-            # That gives us new socket - client socket, connected to this given client only, it's unique for that client
-            # The other returned object is ip/port set
-            client_socket, client_address = server_socket.accept()
-
-            # Client should send his name right away, receive it
-            user = receive_message(client_socket)
-
-            # If False - client disconnected before he sent his name
-            if user is False:
-                continue
-
-            # Add accepted socket to select.select() list
-            sockets_list.append(client_socket)
-
-            # Also save username and username header
-            clients[client_socket] = user
-
-            print('Accepted new connection from {}:{}, username: {}'.format(*client_address, user['data'].decode('utf-8')))
-
-        # Else existing socket is sending a message
-        else:
-
-            # Receive message
-            message = receive_message(notified_socket)
-
-            # If False, client disconnected, cleanup
-            if message is False:
-                print('Closed connection from: {}'.format(clients[notified_socket]['data'].decode('utf-8')))
-
-                # Remove from list for socket.socket()
-                sockets_list.remove(notified_socket)
-
-                # Remove from our list of users
-                del clients[notified_socket]
-
-                continue
-
-            # Get user by notified socket, so we will know who sent the message
-            user = clients[notified_socket]
-
-            print(f'Received message from {user["data"].decode("utf-8")}: {message["data"].decode("utf-8")}')
-
-            # Iterate over connected clients and broadcast message
-            for client_socket in clients:
-
-                # But don't sent it to sender
-                if client_socket != notified_socket:
-
-                    # Send user and message (both with their headers)
-                    # We are reusing here message header sent by sender, and saved username header send by user when he connected
-                    client_socket.send(user['header'] + user['data'] + message['header'] + message['data'])
-
-    # It's not really necessary to have this, but will handle some socket exceptions just in case
-    for notified_socket in exception_sockets:
-
-        # Remove from list for socket.socket()
-        sockets_list.remove(notified_socket)
-
-        # Remove from our list of users
-        del clients[notified_socket]
+    except PermissionError:
+        pass
+    return True
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.replaces = None
+    if args.pid_file and not args.take_over:
+        pid = read_pid(args.pid_file)
+        if pid is not None and pid != os.getpid() and running(pid):
+            raise SystemExit('Relay {} in {} is still running, use --take-over to replace it'.format(
+                pid, args.pid_file))
+    if args.take_over:
+        args.replaces = read_pid(args.pid_file)
+        if args.replaces is None:
+            print('No relay to take over from in {}'.format(args.pid_file))
+    if args.pid_file:
+        with open(args.pid_file, 'w') as f:
+            f.write('{}\n'.format(os.getpid()))
+    try:
+        if args.workers > 1:
+            if args.unix:
+                # bound once, the workers share the listening socket
+                args.unix_socket = bind_unix(args.unix, replace=args.replaces is not None)
+            cluster.run(lambda: make_relay(args), args.workers)
+            return
+        relay = make_relay(args)
+        try:
+            asyncio.run(relay.serve_forever())
+        except KeyboardInterrupt:
+            print("exiting")
+    finally:
+        # unless the relay that took over already wrote its own
+        if args.pid_file and read_pid(args.pid_file) == os.getpid():
+            os.remove(args.pid_file)
+
+
+if __name__ == "__main__":
+    main()
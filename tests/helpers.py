@@ -0,0 +1,24 @@
+""" Helpers shared by the tests """
+import base64
+import json
+
+from server.relay import Relay
+
+
+def packed(kid, body):
+    '''
+    Packed message shaped JSON for the recipient verkey kid, with body as its ciphertext
+    '''
+    protected = base64.urlsafe_b64encode(json.dumps({'recipients': [{'header': {'kid': kid}}]}).encode('utf-8'))
+    return json.dumps({'protected': protected.decode('ascii'), 'ciphertext': body}).encode('utf-8')
+
+
+async def start_relay(**options):
+    '''
+    Relay on a free port of localhost, without mailbox or heartbeats unless options say otherwise.
+    Returns (relay, port).
+    '''
+    options = dict({'mailbox': None, 'heartbeat_interval': 0}, **options)
+    relay = Relay('127.0.0.1', 0, **options)
+    await relay.start()
+    return relay, relay.server.sockets[0].getsockname()[1]
@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip('indy')     # agent imports the indy wrapper
+
+import agent
+from helpers import packed
+
+
+def test_foreign_message_skipped_before_the_wallet(monkeypatch):
+    unpacked = []
+
+    async def unpack_message(wallet_handle, wire_msg):
+        unpacked.append(wire_msg)
+        return json.dumps({'recipient_verkey': 'KNOWN', 'message': json.dumps({'@type': 'test'})})
+
+    async def did_for_key(wallet_handle, verkey):
+        return None
+
+    monkeypatch.setattr(agent.crypto, 'unpack_message', unpack_message)
+    monkeypatch.setattr(agent.utils, 'did_for_key', did_for_key)
+    recipient = agent.Agent('patient')
+    recipient.verkeys = {'KNOWN'}
+    known, foreign = packed('KNOWN', 'for us'), packed('FOREIGN', 'not for us')
+
+    async def main():
+        return await recipient.read_msg(known), await recipient.read_msg(foreign)
+
+    msg, skipped = asyncio.run(main())
+    assert unpacked == [known]
+    assert msg.type == 'test' and msg.context['to_key'] == 'KNOWN'
+    assert skipped is None
+    assert recipient.message_stats == {'received': 2, 'foreign_skipped': 1, 'unpacked': 1, 'unpack_failed': 0}
+
+
+async def dispatch(recipient, handler, messages, handled, concurrency=agent.MESSAGE_CONCURRENCY):
+    '''
+    Put messages on the agent's queue and run handle_messages until handled() is true
+    '''
+    for message in messages:
+        recipient.message_queue.put_nowait(message)
+    task = asyncio.get_running_loop().create_task(recipient.handle_messages(handler, concurrency))
+    try:
+        for _ in range(500):
+            if handled():
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    assert not recipient.dispatching
+
+
+def test_message_order_key():
+    recipient = agent.Agent('patient')
+    assert recipient.message_order_key('alice', packed('KA', 'x')) == ('KA',)
+    assert recipient.message_order_key('alice', b'not packed') == 'alice'
+
+
+def test_messages_of_a_key_in_order_and_keys_overlap():
+    async def main():
+        recipient = agent.Agent('patient')
+        log = []
+        b_started = asyncio.Event()
+
+        async def handler(username, message):
+            body = json.loads(message)['ciphertext']
+            log.append(('start', body))
+            if body == 'b1':
+                b_started.set()
+            elif body == 'a1':
+                await asyncio.wait_for(b_started.wait(), 5)    # only set if KB is handled meanwhile
+            await asyncio.sleep(0.01)
+            log.append(('end', body))
+
+        messages = [('alice', packed('KA', 'a1')), ('alice', packed('KA', 'a2')), ('bob', packed('KB', 'b1'))]
+        await dispatch(recipient, handler, messages, lambda: len(log) == 6)
+        return log
+
+    log = asyncio.run(main())
+    assert len(log) == 6
+    assert log.index(('end', 'a1')) < log.index(('start', 'a2'))
+    assert log.index(('start', 'b1')) < log.index(('end', 'a1'))
+
+
+def test_no_more_than_concurrency_handlers_run():
+    async def main():
+        recipient = agent.Agent('patient')
+        running, most, handled = 0, 0, []
+
+        async def handler(username, message):
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+            handled.append(json.loads(message)['ciphertext'])
+
+        messages = [('alice', packed('K{}'.format(i), 'm{}'.format(i))) for i in range(6)]
+        await dispatch(recipient, handler, messages, lambda: len(handled) == 6, concurrency=2)
+        return most, handled
+
+    most, handled = asyncio.run(main())
+    assert most == 2
+    assert sorted(handled) == ['m{}'.format(i) for i in range(6)]
@@ -0,0 +1,37 @@
+import asyncio
+import os
+import socket
+import types
+
+import framing
+from server.cluster import ROUTE, WorkerLink, pack_route, unpack_route
+
+
+def test_spilled_route_written_in_chunks_and_in_order(tmp_path):
+    async def main():
+        payload = os.urandom(5 * framing.SPILL_CHUNK + 7)
+        spilled = framing.SpilledFrame(len(payload), str(tmp_path))
+        spilled.write(payload)
+        reads = []
+        read = spilled.read
+        spilled.read = lambda offset=0, size=None: reads.append(size) or read(offset, size)
+
+        ours, theirs = socket.socketpair()
+        cluster = types.SimpleNamespace(relay=types.SimpleNamespace(coalesce_delay=0), index=0)
+        _, link = await asyncio.get_running_loop().create_unix_connection(lambda: WorkerLink(cluster, 1), sock=ours)
+        link.send(ROUTE, pack_route('KB', b'alice', spilled))
+        link.send(ROUTE, pack_route('KC', b'bob', b'behind it'))
+
+        reader, writer = await asyncio.open_unix_connection(sock=theirs)
+        parser = framing.V2FrameParser()
+        frames = []
+        while len(frames) < 2:
+            parser.feed(await asyncio.wait_for(reader.read(65536), 5))
+            frames += parser.frames()
+        assert [unpack_route(data) for _, _, data in frames] == [('KB', b'alice', payload),
+                                                                 ('KC', b'bob', b'behind it')]
+        assert None not in reads
+        link.transport.close()
+        writer.close()
+
+    asyncio.run(main())
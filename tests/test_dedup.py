@@ -0,0 +1,27 @@
+from server.dedup import DuplicateCache
+
+
+def test_duplicate_within_window():
+    cache = DuplicateCache(window=60)
+    assert not cache.seen(b'a', now=0)
+    assert cache.seen(b'a', now=1)
+    assert cache.seen(b'a', now=59)
+    assert not cache.seen(b'b', now=59)
+
+
+def test_forgotten_after_window():
+    cache = DuplicateCache(window=60, buckets=6)
+    assert not cache.seen(b'a', now=0)
+    assert not cache.seen(b'a', now=71)
+    assert cache.size == 1
+
+
+def test_max_entries_drops_oldest_buckets():
+    cache = DuplicateCache(window=60, max_entries=10, buckets=6)
+    for i in range(10):
+        cache.seen(i, now=0)
+    for i in range(5):
+        cache.seen(100 + i, now=20)
+    assert cache.size <= 10
+    assert not cache.seen(0, now=21)        # its bucket was dropped early
+    assert cache.seen(104, now=21)
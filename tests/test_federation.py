@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+from helpers import packed, start_relay
+from server.federation import BloomFilter, Federation
+from server.mailbox import Mailbox
+from transport import Transport
+
+
+async def eventually(condition, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, 'timed out'
+        await asyncio.sleep(0.02)
+
+
+async def client(port, username, *verkeys):
+    transport = Transport(asyncio.Queue(), print, heartbeat_interval=0)
+    await transport.connect('127.0.0.1', port, username)
+    transport.register(verkeys)
+    return transport
+
+
+def test_bloom_filter():
+    bloom = BloomFilter.for_keys(['K{}'.format(i) for i in range(100)])
+    assert all('K{}'.format(i) in bloom for i in range(100))
+    decoded = BloomFilter.decode(bloom.encode())
+    assert 'K7' in decoded
+    assert sum('other{}'.format(i) in decoded for i in range(1000)) < 50
+
+
+def test_route_across_relays_and_miss_to_mailbox(tmp_path):
+    async def main():
+        # site a accepts the link, site b dials it
+        a = (await start_relay(mailbox=Mailbox(str(tmp_path / 'a'))))[0]
+        a_federation = Federation(a, 'a', listen=('127.0.0.1', 0), summary_interval=0.05)
+        await a_federation.start()
+        a_port = a.server.sockets[0].getsockname()[1]
+        b, b_port = await start_relay(mailbox=Mailbox(str(tmp_path / 'b')))
+        b_federation = Federation(b, 'b', peers=[('127.0.0.1', a_federation.server.sockets[0].getsockname()[1])],
+                                  summary_interval=0.05)
+        await b_federation.start()
+
+        bob = await client(b_port, 'bob', 'KB')
+        alice = await client(a_port, 'alice', 'KA')
+        await eventually(lambda: a_federation.links and a_federation.links[0].filter is not None
+                         and 'KB' in a_federation.links[0].filter)
+
+        # ROUTE: bob's key is not on a, its summary of b has it
+        await alice.send(packed('KB', 'over the link'))
+        username, message = await asyncio.wait_for(bob.queue.get(), 5)
+        assert (username, json.loads(message)['ciphertext']) == ('alice', 'over the link')
+        assert a.metrics.counters['federation_routed_total'] == 1
+        assert b.metrics.counters['federation_received_total'] == 1
+
+        # MISS: bob left b before b told a, the message comes back and is stored on a
+        b_federation.summary_interval = 3600
+        await asyncio.sleep(0.1)
+        await bob.close()
+        await eventually(lambda: 'KB' not in b.routes)
+        await alice.send(packed('KB', 'missed'))
+        await eventually(lambda: a.mailbox.has_mail('KB'))
+        assert a.metrics.counters['federation_misses_total'] == 1
+        assert [json.loads(payload)['ciphertext'] for _, payload in a.mailbox.read('KB')] == ['missed']
+        assert not b.mailbox.has_mail('KB')
+        await alice.close()
+        for relay in (a, b):
+            relay.server.close()
+        a_federation.server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+import hashlib
+
+import pytest
+
+import framing
+
+
+def legacy(payload):
+    return framing.encode_frame(payload)
+
+
+def test_frames_split_over_reads():
+    parser = framing.FrameParser()
+    data = legacy(b'alice') + legacy(b'x' * 300)
+    frames = []
+    for i in range(0, len(data), 7):
+        parser.feed(data[i:i + 7])
+        frames += parser.frames()
+    assert frames == [b'alice', b'x' * 300]
+    assert parser.pending() == 0
+
+
+def test_many_frames_in_one_read():
+    parser = framing.FrameParser()
+    parser.feed(b''.join(legacy(str(i).encode()) for i in range(100)) + b'12')
+    assert parser.frames() == [str(i).encode() for i in range(100)]
+    assert parser.pending() == 2
+
+
+def test_empty_frame():
+    parser = framing.FrameParser()
+    parser.feed(legacy(b'') + legacy(b'a'))
+    assert parser.frames() == [b'', b'a']
+
+
+def test_frame_over_limit_refused_at_header():
+    parser = framing.FrameParser(max_length=10)
+    parser.feed(framing.encode_header(11))
+    with pytest.raises(framing.FrameError):
+        parser.frames()
+
+
+@pytest.mark.parametrize('header', [b'-10       ', b'abc       ', b'          '])
+def test_invalid_header(header):
+    parser = framing.FrameParser(max_length=1000)
+    parser.feed(header + b'x' * 20)
+    with pytest.raises(framing.FrameError):
+        parser.frames()
+
+
+def test_v2_frames():
+    parser = framing.V2FrameParser()
+    data = (framing.encode_v2_frame(framing.HELLO, b'{}', 0) + framing.encode_v2_frame(framing.DATA, b'abc', 7)
+            + framing.encode_v2_frame(framing.ACK, framing.ACK_PAYLOAD.pack(3)))
+    frames = []
+    for i in range(len(data)):
+        parser.feed(data[i:i + 1])
+        frames += parser.frames()
+    assert frames == [(framing.HELLO, 0, b'{}'), (framing.DATA, 7, b'abc'),
+                      (framing.ACK, 0, framing.ACK_PAYLOAD.pack(3))]
+
+
+def test_v2_frame_over_limit():
+    parser = framing.V2FrameParser(max_length=100)
+    parser.feed(framing.encode_v2_header(framing.DATA, 101))
+    with pytest.raises(framing.FrameError):
+        parser.frames()
+
+
+def test_v2_spill_across_reads(tmp_path):
+    parser = framing.V2FrameParser(spill_length=1000, directory=str(tmp_path))
+    payload = bytes(range(256)) * 20
+    data = framing.encode_v2_frame(framing.DATA, payload, 3) + framing.encode_v2_frame(framing.DATA, b'small', 4)
+    frames = []
+    for i in range(0, len(data), 333):
+        parser.feed(data[i:i + 333])
+        frames += parser.frames()
+    (frame_type, sender_id, spilled), small = frames
+    assert (frame_type, sender_id) == (framing.DATA, 3)
+    assert isinstance(spilled, framing.SpilledFrame)
+    assert len(spilled) == len(payload)
+    assert spilled.read() == payload
+    assert b''.join(spilled.chunks(100)) == payload
+    assert spilled.digest() == hashlib.blake2b(payload, digest_size=16).digest()
+    assert small == (framing.DATA, 4, b'small')
+
+
+def test_v2_only_data_spilled():
+    parser = framing.V2FrameParser(spill_length=10)
+    parser.feed(framing.encode_v2_frame(framing.CONTROL, b'c' * 50))
+    assert parser.frames() == [(framing.CONTROL, 0, b'c' * 50)]
+
+
+def test_unsent():
+    parts = [b'abc', b'defg', b'h']
+    assert framing.unsent(parts, 0) == parts
+    assert [bytes(part) for part in framing.unsent(parts, 4)] == [b'efg', b'h']
+    assert framing.unsent(parts, 8) == []
+
+
+def test_zlib_round_trip():
+    codec = framing.ZlibCodec()
+    data = b'credential ' * 1000
+    assert codec.decompress(codec.compress(data), len(data)) == data
+
+
+def test_zlib_refuses_output_over_limit():
+    codec = framing.ZlibCodec()
+    bomb = codec.compress(b'\0' * 10 * 1024 * 1024)
+    assert len(bomb) < 64 * 1024
+    with pytest.raises(framing.FrameError):
+        codec.decompress(bomb, 1024 * 1024)
+
+
+@pytest.mark.parametrize('data', [b'not zlib', framing.ZlibCodec().compress(b'x' * 5000)[:-6]])
+def test_zlib_refuses_invalid_frames(data):
+    with pytest.raises(framing.FrameError):
+        framing.ZlibCodec().decompress(data, 10000)
+
+
+def test_v2_bulk_data_spilled():
+    parser = framing.V2FrameParser(spill_length=1000)
+    payload = b'b' * 5000
+    parser.feed(framing.encode_v2_frame(framing.DATA | framing.BULK, payload, 2))
+    (frame_type, sender_id, spilled), = parser.frames()
+    assert frame_type == framing.DATA | framing.BULK
+    assert isinstance(spilled, framing.SpilledFrame)
+    assert spilled.read() == payload
@@ -0,0 +1,95 @@
+import os
+import time
+
+import framing
+from server.mailbox import Mailbox, RECORD_HEADER
+
+
+def record_size(sender, payload):
+    return RECORD_HEADER.size + len(sender) + len(payload)
+
+
+def test_append_and_read(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    assert not mailbox.has_mail('K1')
+    for i in range(5):
+        assert mailbox.append('K1', b'alice', b'message %d' % i)
+    mailbox.append('K2', b'bob', b'other')
+    assert mailbox.has_mail('K1')
+    assert list(mailbox.read('K1')) == [(b'alice', b'message %d' % i) for i in range(5)]
+    assert not mailbox.has_mail('K1')
+    assert list(mailbox.read('K2')) == [(b'bob', b'other')]
+
+
+def test_spilled_payload_copied_in_chunks(tmp_path):
+    payload = os.urandom(3 * framing.SPILL_CHUNK + 5)
+    spilled = framing.SpilledFrame(len(payload), str(tmp_path))
+    spilled.write(payload)
+    reads = []
+    read = spilled.read
+    spilled.read = lambda offset=0, size=None: reads.append(size) or read(offset, size)
+    mailbox = Mailbox(str(tmp_path / 'mail'))
+    assert mailbox.append('K', b'alice', spilled)
+    assert None not in reads
+    assert list(mailbox.read('K')) == [(b'alice', payload)]
+
+
+def test_read_across_segments(tmp_path):
+    mailbox = Mailbox(str(tmp_path), segment_bytes=100)
+    payloads = [b'x%03d' % i * 10 for i in range(20)]
+    for payload in payloads:
+        mailbox.append('K', b's', payload)
+    assert len(os.listdir(mailbox._path('K'))) > 1
+    assert [payload for _, payload in mailbox.read('K')] == payloads
+
+
+def test_interrupted_read_is_repeated(tmp_path):
+    mailbox = Mailbox(str(tmp_path))
+    for i in range(3):
+        mailbox.append('K', b's', b'%d' % i)
+    reader = mailbox.read('K')
+    assert next(reader) == (b's', b'0')
+    reader.close()
+    assert [payload for _, payload in mailbox.read('K')] == [b'0', b'1', b'2']
+
+
+def test_cap_drops_oldest_segments(tmp_path):
+    payload = b'p' * 100
+    size = record_size(b's', payload)
+    mailbox = Mailbox(str(tmp_path), max_bytes=size * 4, segment_bytes=size * 2)
+    for i in range(10):
+        assert mailbox.append('K', b's', payload[:-2] + b'%02d' % i)
+    got = [payload[-2:] for _, payload in mailbox.read('K')]
+    assert got[-1] == b'09'
+    assert len(got) <= 4
+    assert got == sorted(got)
+
+
+def test_cap_keeps_message_in_only_segment(tmp_path):
+    # the segment written to is never dropped, even when it is the only one left
+    payload = b'p' * 100
+    size = record_size(b's', payload)
+    mailbox = Mailbox(str(tmp_path), max_bytes=size * 2 + 10, segment_bytes=size * 10)
+    for i in range(5):
+        assert mailbox.append('K', b's', payload[:-1] + b'%d' % i)
+        assert mailbox.has_mail('K')
+    got = [payload[-1:] for _, payload in mailbox.read('K')]
+    assert got[-1] == b'4'
+
+
+def test_message_over_cap_not_stored(tmp_path):
+    mailbox = Mailbox(str(tmp_path), max_bytes=100)
+    assert mailbox.append('K', b's', b'small')
+    assert not mailbox.append('K', b's', b'x' * 200)
+    assert list(mailbox.read('K')) == [(b's', b'small')]
+
+
+def test_expired_records_not_returned(tmp_path):
+    mailbox = Mailbox(str(tmp_path), ttl=60)
+    mailbox.append('K', b's', b'old')
+    for segment in os.listdir(mailbox._path('K')):
+        old = time.time() - 120
+        os.utime(os.path.join(mailbox._path('K'), segment), (old, old))
+    mailbox.expire()
+    assert not mailbox.has_mail('K')
+    assert list(mailbox.read('K')) == []
@@ -0,0 +1,29 @@
+import collections
+import types
+
+from server.metrics import Metrics
+
+
+def client(name, connection_id):
+    return types.SimpleNamespace(name=lambda: name, connection_id=connection_id, frames_in=1, bytes_in=2,
+                                 frames_out=3, bytes_out=4, queued_bytes=0, queue=collections.deque())
+
+
+def relay(clients):
+    return types.SimpleNamespace(clients=list(clients), cluster=None, duplicates=None)
+
+
+def test_same_username_twice_gives_distinct_series():
+    metrics = Metrics(relay([client('alice', 1), client('alice', 2), client('bo"b', 3)]))
+    samples = [line.rsplit(' ', 1)[0] for line in metrics.render().splitlines() if not line.startswith('#')]
+    assert len(samples) == len(set(samples))
+    assert 'relay_client_queue_depth{client="alice",connection="2"}' in samples
+    assert 'relay_client_frames_in_total{client="bo\\"b",connection="3"}' in samples
+
+
+def test_snapshot_lists_connections():
+    metrics = Metrics(relay([client('alice', 1), client('alice', 2)]))
+    metrics.inc('connections_total', 2)
+    snapshot = metrics.snapshot()
+    assert sorted(c['connection'] for c in snapshot['clients']) == [1, 2]
+    assert snapshot['counters']['connections_total'] == 2
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+import socket
+
+import pytest
+
+import transport
+from helpers import packed, start_relay
+from server.mailbox import Mailbox
+from server.relay import Relay
+from transport import Transport
+
+
+def test_port_not_shared_unless_replaceable():
+    async def main():
+        first = Relay('127.0.0.1', 0, mailbox=None, heartbeat_interval=0)
+        await first.start()
+        port = first.server.sockets[0].getsockname()[1]
+        with pytest.raises(OSError):
+            await Relay('127.0.0.1', port, mailbox=None, heartbeat_interval=0).start()
+        first.server.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason='needs SO_REUSEPORT')
+def test_replaceable_relay_shares_port_with_its_successor():
+    async def main():
+        first = Relay('127.0.0.1', 0, mailbox=None, heartbeat_interval=0, replaceable=True)
+        await first.start()
+        port = first.server.sockets[0].getsockname()[1]
+        # the pid of a process that does not exist, so nothing is signalled
+        second = Relay('127.0.0.1', port, mailbox=None, heartbeat_interval=0, replaces=2 ** 22 + 1)
+        await second.start()
+        second.server.close()
+        first.server.close()
+
+    asyncio.run(main())
+
+
+def test_stream_frames_are_charged_to_the_stream_identity():
+    async def main():
+        relay, port = await start_relay(rate_limits={'bob': (1000, 1000)})
+        host = Transport(asyncio.Queue(), print, heartbeat_interval=0)
+        await host.connect('127.0.0.1', port, 'host')
+        bob = host.open_stream('bob', asyncio.Queue())
+        carol = host.open_stream('carol', asyncio.Queue())
+        alice = Transport(asyncio.Queue(), print, heartbeat_interval=0)
+        await alice.connect('127.0.0.1', port, 'alice')
+        alice.register(['KA'])
+        await asyncio.sleep(0.1)
+        connection = next(client for client in relay.connections if client.sender.name == b'host')
+        assert connection.bucket is None
+        assert connection.streams[bob].bucket is relay.buckets['bob']
+        assert connection.streams[carol].bucket is None
+
+        for i in range(3):
+            await host.send(packed('KA', 'bob {} '.format(i) + 'x' * 600), stream=bob)
+        await asyncio.sleep(0.1)
+        assert relay.metrics.counters['rate_limited_total'] >= 1
+        assert alice.queue.qsize() == 2
+        await asyncio.sleep(0.5)
+        assert alice.queue.qsize() == 3
+        await host.close()
+        await alice.close()
+        relay.server.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason='needs SO_REUSEPORT')
+def test_take_over_delivers_every_message_once_and_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.05)
+
+    async def main():
+        old, port = await start_relay(mailbox=Mailbox(str(tmp_path)), replaceable=True, drain_timeout=2)
+        bob = Transport(asyncio.Queue(), print, heartbeat_interval=0)
+        await bob.connect('127.0.0.1', port, 'bob')
+        bob.register(['KB'])
+        alice = Transport(asyncio.Queue(), print, heartbeat_interval=0)
+        await alice.connect('127.0.0.1', port, 'alice')
+        await asyncio.sleep(0.1)
+
+        # the new relay shares the port and the mailbox; this process stands in for the old relay's
+        new = Relay('127.0.0.1', port, mailbox=Mailbox(str(tmp_path)), heartbeat_interval=0, replaceable=True)
+        await new.start()
+        taking_over = asyncio.get_running_loop().create_task(new.take_over_mailbox(os.getpid(), interval=0.1))
+        old.stopped = asyncio.get_running_loop().create_future()
+        for i in range(40):
+            if i == 10:
+                old.stop()
+            await alice.send(packed('KB', 'm{}'.format(i)))
+            await asyncio.sleep(0.05)
+        await asyncio.wait_for(old.stopped, 10)
+
+        received = []
+        try:
+            while True:
+                _, message = await asyncio.wait_for(bob.queue.get(), 2)
+                received.append(json.loads(message)['ciphertext'])
+        except asyncio.TimeoutError:
+            pass
+        assert received == ['m{}'.format(i) for i in range(40)]
+        assert all(client.sender.name in (b'alice', b'bob') for client in new.clients)
+        taking_over.cancel()
+        await alice.close()
+        await bob.close()
+        new.server.close()
+
+    asyncio.run(main())
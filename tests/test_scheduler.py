@@ -0,0 +1,148 @@
+import asyncio
+import collections
+
+import pytest
+
+import framing
+from server import scheduler
+from server.scheduler import LaneQueue, Scheduler, TokenBucket
+
+INTERACTIVE, BULK = framing.LANE_INTERACTIVE, framing.LANE_BULK
+
+
+def test_order_kept_within_a_lane():
+    queue = LaneQueue({INTERACTIVE: 4, BULK: 1}, quantum=100)
+    for i in range(5):
+        queue.append(('i', i), INTERACTIVE, 10)
+        queue.append(('b', i), BULK, 10)
+    assert len(queue) == 10
+    out = [queue.popleft() for _ in range(10)]
+    assert [i for lane, i in out if lane == 'i'] == list(range(5))
+    assert [i for lane, i in out if lane == 'b'] == list(range(5))
+    assert len(queue) == 0
+    with pytest.raises(IndexError):
+        queue.popleft()
+
+
+def test_lanes_share_output_by_weight():
+    queue = LaneQueue({INTERACTIVE: 4, BULK: 1}, quantum=100)
+    for i in range(400):
+        queue.append('i', INTERACTIVE, 100)
+        queue.append('b', BULK, 100)
+    out = [queue.popleft() for _ in range(250)]
+    assert out.count('i') == 200
+    assert out.count('b') == 50
+
+
+def test_round_starts_on_the_interactive_lane():
+    queue = LaneQueue({INTERACTIVE: 4, BULK: 1}, quantum=100)
+    for _ in range(2):
+        queue.append('b', BULK, 100)
+        for i in range(4):
+            queue.append(i, INTERACTIVE, 100)
+        assert [queue.popleft() for _ in range(5)] == [0, 1, 2, 3, 'b']
+
+
+def test_large_item_waits_for_credit_but_is_sent():
+    queue = LaneQueue({INTERACTIVE: 4, BULK: 1}, quantum=100)
+    queue.append('big', BULK, 1000)
+    for i in range(100):
+        queue.append(i, INTERACTIVE, 10)
+    out = [queue.popleft() for _ in range(101)]
+    assert 'big' in out
+    assert [item for item in out if item != 'big'] == list(range(100))
+
+
+def test_drop_takes_oldest_of_lowest_lane():
+    queue = LaneQueue({INTERACTIVE: 4, BULK: 1})
+    queue.append('i0', INTERACTIVE, 1)
+    queue.append('b0', BULK, 1)
+    queue.append('b1', BULK, 1)
+    assert list(queue) == ['i0', 'b0', 'b1']
+    assert queue.drop() == 'b0'
+    assert queue.drop() == 'b1'
+    assert queue.drop() == 'i0'
+    with pytest.raises(IndexError):
+        queue.drop()
+
+
+def test_clear():
+    queue = LaneQueue({INTERACTIVE: 4, BULK: 1})
+    queue.append('i0', INTERACTIVE, 1)
+    queue.append('b0', BULK, 1)
+    queue.clear()
+    assert len(queue) == 0 and list(queue) == []
+
+
+def test_token_bucket_refills_and_says_how_long_to_wait(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(scheduler.time, 'monotonic', lambda: now[0])
+    bucket = TokenBucket(100, burst=200)
+    assert bucket.reserve(150) is None
+    assert bucket.reserve(100) is None      # a frame over the tokens left puts the bucket in debt
+    assert bucket.reserve(1) == pytest.approx(0.5 + 0.001)
+    now[0] += 0.25
+    assert bucket.reserve(1) == pytest.approx(0.25 + 0.001)
+    now[0] += 0.5
+    assert bucket.reserve(1) is None
+    now[0] += 100
+    bucket.reserve(0)
+    assert bucket.tokens == 200             # refills up to the burst only
+
+
+class Client:
+    '''
+    Stand-in for a ClientConnection: frames are their sizes, process() logs (name, frames handled)
+    '''
+    def __init__(self, name, frames, log, wait=None):
+        self.name = name
+        self.inbound = collections.deque(frames)
+        self.scheduled = False
+        self.log = log
+        self.wait = wait    # seconds process() says to wait on its first turn, as if over its rate
+
+    def process(self, budget):
+        if self.wait is not None:
+            wait, self.wait = self.wait, None
+            self.log.append((self.name, 0))
+            return wait
+        spent = handled = 0
+        while self.inbound and spent < budget:
+            spent += self.inbound.popleft()
+            handled += 1
+        self.log.append((self.name, handled))
+        return None
+
+
+def test_scheduler_gives_each_client_a_byte_budget_per_turn():
+    async def main():
+        log = []
+        turns = Scheduler(budget=250)
+        a = Client('a', [100] * 10, log)
+        b = Client('b', [100] * 2, log)
+        turns.add(a)
+        turns.add(b)
+        turns.add(a)        # already waiting, keeps its place
+        await asyncio.sleep(0.05)
+        assert log == [('a', 3), ('b', 2), ('a', 3), ('a', 3), ('a', 1)]
+        assert not a.scheduled and not b.scheduled
+
+    asyncio.run(main())
+
+
+def test_scheduler_parks_a_client_over_its_rate():
+    async def main():
+        log = []
+        turns = Scheduler(budget=1000)
+        limited = Client('limited', [100], log, wait=0.1)
+        other = Client('other', [100], log)
+        turns.add(limited)
+        turns.add(other)
+        await asyncio.sleep(0.05)
+        assert log == [('limited', 0), ('other', 1)]
+        assert limited.scheduled
+        await asyncio.sleep(0.1)
+        assert log[-1] == ('limited', 1)
+        assert not limited.scheduled
+
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import framing
+from helpers import packed, start_relay
+from server.relay import Session, Sender
+
+
+async def read_frame(reader):
+    length, frame_type, sender_id = framing.V2_HEADER.unpack(await reader.readexactly(framing.V2_HEADER.size))
+    return frame_type, sender_id, await reader.readexactly(length)
+
+
+async def connect(port, username, **hello):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    hello = json.dumps(dict(hello, username=username)).encode('utf-8')
+    writer.write(framing.V2_MAGIC + framing.encode_v2_frame(framing.HELLO, hello))
+    frame_type, _, payload = await read_frame(reader)
+    assert frame_type == framing.WELCOME
+    return reader, writer, json.loads(payload)
+
+
+async def read_data(reader, count):
+    messages = []
+    while len(messages) < count:
+        frame_type, _, payload = await asyncio.wait_for(read_frame(reader), 5)
+        if frame_type == framing.DATA:
+            messages.append(json.loads(payload)['ciphertext'])
+    return messages
+
+
+def register(writer, *verkeys):
+    control = framing.encode_control(framing.REGISTER, verkeys=list(verkeys))
+    writer.write(framing.encode_v2_frame(framing.CONTROL, control))
+
+
+def test_session_keeps_unacknowledged_frames():
+    session = Session('token', b'bob', max_bytes=100)
+    sender = Sender(b'alice', 1)
+    for i in range(3):
+        assert session.sent_frame(sender, b'x' * 30, 'K') == 0
+    assert session.sent_frame(sender, b'x' * 30, 'K') == 1     # over the cap, the oldest is forgotten
+    assert [seq for seq, _, _, _ in session.unacked] == [2, 3, 4]
+    session.acked(3)
+    assert [seq for seq, _, _, _ in session.unacked] == [4]
+    assert session.unacked_bytes == 30
+
+
+def test_resume_resends_unacknowledged_frames():
+    async def main():
+        relay, port = await start_relay()
+        bob_reader, bob_writer, welcome = await connect(port, 'bob', session='')
+        assert welcome['resumed'] is False
+        token = welcome['session']
+        register(bob_writer, 'KB')
+        # bob sends two messages in the session, which the relay counts
+        bob_writer.write(framing.encode_v2_frame(framing.DATA, packed('KX', 'from bob 0')))
+        bob_writer.write(framing.encode_v2_frame(framing.DATA, packed('KX', 'from bob 1')))
+        _, alice_writer, _ = await connect(port, 'alice')
+        await asyncio.sleep(0.1)
+        for i in range(3):
+            alice_writer.write(framing.encode_v2_frame(framing.DATA, packed('KB', 'm{}'.format(i))))
+        assert await read_data(bob_reader, 3) == ['m0', 'm1', 'm2']
+        # gone without acknowledging anything, and only m0 and m1 made it to the application
+        bob_writer.close()
+        await asyncio.sleep(0.1)
+
+        bob_reader, bob_writer, welcome = await connect(port, 'bob', session=token, received=2)
+        assert welcome['resumed'] is True
+        assert welcome['session'] == token
+        assert welcome['seq'] == 2
+        assert welcome['received'] == 2
+        assert await read_data(bob_reader, 1) == ['m2']
+        # the verkeys of the session are registered again
+        alice_writer.write(framing.encode_v2_frame(framing.DATA, packed('KB', 'm3')))
+        assert await read_data(bob_reader, 1) == ['m3']
+        assert relay.metrics.counters['sessions_resumed_total'] == 1
+        bob_writer.close()
+        alice_writer.close()
+        relay.server.close()
+
+    asyncio.run(main())
+
+
+def test_unknown_session_starts_a_new_one():
+    async def main():
+        relay, port = await start_relay()
+        _, writer, welcome = await connect(port, 'bob', session='no-such-token', received=5)
+        assert welcome['resumed'] is False
+        assert welcome['session'] != 'no-such-token'
+        assert welcome['seq'] == 0 and welcome['received'] == 0
+        writer.close()
+        relay.server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+import asyncio
+import json
+
+import pytest
+
+import framing
+import transport
+from helpers import packed, start_relay
+from transport import Transport
+
+
+async def connect(port, username, queue=None):
+    client = Transport(queue or asyncio.Queue(), print, heartbeat_interval=0)
+    await client.connect('127.0.0.1', port, username)
+    return client
+
+
+async def received(queue):
+    username, message = await asyncio.wait_for(queue.get(), 5)
+    return username, json.loads(message)['ciphertext']
+
+
+def test_connect_failure_raises():
+    async def main():
+        relay, port = await start_relay()
+        relay.server.close()
+        await relay.server.wait_closed()
+        with pytest.raises(OSError):
+            await connect(port, 'alice')
+
+    asyncio.run(main())
+
+
+def test_compressed_bulk_message_keeps_bulk_flag():
+    async def main():
+        frames = asyncio.Queue()
+
+        async def server(reader, writer):
+            await reader.readexactly(len(framing.V2_MAGIC))
+            length, _, _ = framing.V2_HEADER.unpack(await reader.readexactly(framing.V2_HEADER.size))
+            await reader.readexactly(length)
+            welcome = {'session': None, 'compression': 'zlib', 'lanes': True}
+            writer.write(framing.encode_v2_frame(framing.WELCOME, json.dumps(welcome).encode('utf-8'), 1))
+            while True:
+                length, frame_type, _ = framing.V2_HEADER.unpack(await reader.readexactly(framing.V2_HEADER.size))
+                await frames.put((frame_type, await reader.readexactly(length)))
+
+        fake = await asyncio.start_server(server, '127.0.0.1', 0)
+        client = await connect(fake.sockets[0].getsockname()[1], 'alice')
+        message = b'{"ciphertext":"' + b'credential ' * 200 + b'"}'
+        await client.send(message, framing.LANE_BULK)
+        frame_type, payload = await asyncio.wait_for(frames.get(), 5)
+        assert frame_type == framing.DATA | framing.BULK | framing.COMPRESSED
+        assert framing.ZlibCodec().decompress(payload, len(message)) == message
+        assert client.compression_report()['sent_ratio'] < 1
+        await client.close()
+        fake.close()
+
+    asyncio.run(main())
+
+
+def test_streams_deliver_to_their_own_queue(monkeypatch):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.01)
+
+    async def main():
+        relay, port = await start_relay()
+        host = await connect(port, 'host')
+        bob, carol = asyncio.Queue(), asyncio.Queue()
+        bob_stream = host.open_stream('bob', bob)
+        carol_stream = host.open_stream('carol', carol)
+        host.register(['KB'], bob_stream)
+        host.register(['KC'], carol_stream)
+        alice = await connect(port, 'alice')
+        alice.register(['KA'])
+        await asyncio.sleep(0.1)
+
+        await alice.send(packed('KB', 'to bob'))
+        await alice.send(packed('KC', 'to carol'))
+        assert await received(bob) == ('alice', 'to bob')
+        assert await received(carol) == ('alice', 'to carol')
+        await host.send(packed('KA', 'from carol'), stream=carol_stream)
+        assert await received(alice.queue) == ('carol', 'from carol')
+        assert host.queue.empty()
+
+        # streams are opened and registered again after the connection breaks
+        for connection in list(relay.connections):
+            if connection.sender.name == b'host':
+                connection.transport.close()
+        await asyncio.sleep(0.5)
+        await alice.send(packed('KB', 'after reconnect'))
+        assert await received(bob) == ('alice', 'after reconnect')
+
+        # a closed stream gets nothing more, the message waits in the relay for bob
+        host.close_stream(bob_stream)
+        await asyncio.sleep(0.1)
+        await alice.send(packed('KC', 'still here'))
+        assert await received(carol) == ('alice', 'still here')
+        assert bob.empty()
+        await host.close()
+        await alice.close()
+        relay.server.close()
+
+    asyncio.run(main())
+
+
+def test_resumed_session_resends_what_the_server_missed(monkeypatch, capsys):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.01)
+
+    async def main():
+        # per connection: WELCOME to answer with, DATA frames to read before dropping the connection
+        script = [({'session': 's', 'resumed': False}, 3),
+                  ({'session': 's', 'resumed': True, 'seq': 0, 'received': 3}, 2),
+                  ({'session': 's', 'resumed': True, 'seq': 0, 'received': 4}, 1)]
+        frames = asyncio.Queue()
+
+        async def server(reader, writer):
+            welcome, count = script.pop(0)
+            await reader.readexactly(len(framing.V2_MAGIC))
+            length, _, _ = framing.V2_HEADER.unpack(await reader.readexactly(framing.V2_HEADER.size))
+            hello = json.loads(await reader.readexactly(length))
+            writer.write(framing.encode_v2_frame(framing.WELCOME, json.dumps(welcome).encode('utf-8'), 1))
+            for _ in range(count):
+                length, frame_type, _ = framing.V2_HEADER.unpack(await reader.readexactly(framing.V2_HEADER.size))
+                await frames.put((hello['session'], await reader.readexactly(length)))
+            writer.close()
+
+        fake = await asyncio.start_server(server, '127.0.0.1', 0)
+        client = await connect(fake.sockets[0].getsockname()[1], 'alice')
+        assert client.session == 's' and not client.resumed
+        for i in range(3):
+            await client.send(b'm%d' % i)
+        assert [await frames.get() for _ in range(3)] == [('', b'm0'), ('', b'm1'), ('', b'm2')]
+        await asyncio.sleep(0.2)
+        # resumed: the server got m0 to m2, and of what follows only m3
+        for i in (3, 4):
+            await client.send(b'm%d' % i)
+        assert [await frames.get() for _ in range(2)] == [('s', b'm3'), ('s', b'm4')]
+        assert client.resumed
+        assert 'Reconnected to the server, session resumed' in capsys.readouterr().out
+        assert await asyncio.wait_for(frames.get(), 5) == ('s', b'm4')
+        assert client.sent == 5
+        await client.close()
+        fake.close()
+
+    asyncio.run(main())
+
+
+def test_new_session_after_reconnect_is_not_reported_resumed(monkeypatch, capsys):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.01)
+
+    async def main():
+        connections = []
+
+        async def server(reader, writer):
+            connections.append(writer)
+            await reader.readexactly(len(framing.V2_MAGIC))
+            length, _, _ = framing.V2_HEADER.unpack(await reader.readexactly(framing.V2_HEADER.size))
+            await reader.readexactly(length)
+            welcome = {'session': 's%d' % len(connections), 'resumed': False}
+            writer.write(framing.encode_v2_frame(framing.WELCOME, json.dumps(welcome).encode('utf-8'), 1))
+            if len(connections) == 1:
+                writer.close()
+
+        fake = await asyncio.start_server(server, '127.0.0.1', 0)
+        client = await connect(fake.sockets[0].getsockname()[1], 'alice')
+        while client.session != 's2':
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        assert not client.resumed
+        out = capsys.readouterr().out
+        assert 'Reconnected to the server' in out and 'session resumed' not in out
+        await client.close()
+        fake.close()
+
+    asyncio.run(main())
+
+
+def test_legacy_message_sent_while_down_waits_for_reconnect(monkeypatch):
+    monkeypatch.setattr(transport, 'RECONNECT_DELAY', 0.3)
+
+    async def main():
+        relay, port = await start_relay()
+        bob = Transport(asyncio.Queue(), print, heartbeat_interval=0)
+        await bob.connect('127.0.0.1', port, 'bob', version=1)
+        bob.register(['KB'])
+        alice = Transport(asyncio.Queue(), print, heartbeat_interval=0)
+        await alice.connect('127.0.0.1', port, 'alice', version=1)
+        await asyncio.sleep(0.1)
+        for connection in list(relay.connections):
+            if connection.sender.name == b'alice':
+                connection.transport.close()
+        await asyncio.sleep(0.1)
+
+        written = await alice.send(packed('KB', 'queued'))
+        assert not written.done()
+        assert await received(bob.queue) == ('alice', 'queued')
+        assert written.done()
+        await alice.close()
+        await bob.close()
+        relay.server.close()
+
+    asyncio.run(main())
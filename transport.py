@@ -0,0 +1,579 @@
+""" asyncio client connection to the relay.
+
+    Transport lives on the agent's event loop: frames are read with StreamReader.readexactly and every
+    message received is put on a queue (Agent.message_queue) as (username, message), for a task on the
+    same loop to handle. Messages stay the bytes read from the socket all the way to
+    crypto.unpack_message. Frames to send are queued by priority lane and written by one task, which
+    waits for the socket's buffer to drain, so sending never blocks the loop.
+
+    With protocol v2 one transport can host many agents of a process: open_stream gives each its own
+    stream, whose messages are put on that agent's queue.
+
+    Messages are kept in the outbound queue until they are written, so they survive the connection
+    breaking. The transport then reconnects with a jittered exponential backoff, registers our
+    verkeys again and sends what is queued in order. With a v2 session, messages written but not
+    acknowledged by the relay are sent again as well, and the relay does the same for us. Without one,
+    messages already written when the connection broke are not sent again.
+
+        transport = Transport(agent.message_queue, print)
+        await transport.connect('127.0.0.1', 1234, 'alice', role='patient')
+        transport.register(verkeys)
+        written = await transport.send(wire_message)
+        await written       # optional, the message went out to the socket
+
+        stream = transport.open_stream('bob', other_agent.message_queue, role='doctor')
+        transport.register(other_verkeys, stream)
+        await transport.send(wire_message, stream=stream)
+"""
+import asyncio
+import collections
+import itertools
+import json
+import random
+import socket
+import time
+
+import framing
+
+UNIX_SCHEME = 'unix://'     # connect('unix:///path/relay.sock', None, ...) uses a Unix domain socket
+NEGOTIATION_TIMEOUT = 2     # seconds to wait for the server to accept protocol v2
+HIGH_WATER = 64 * 1024      # bytes queued to send before send() waits for them to go out
+RECONNECT_DELAY = 1         # seconds before the first reconnect, doubling for each further one
+RECONNECT_MAX_DELAY = 30
+MAX_UNACKED = 1000          # sent messages kept until the server acknowledges them
+LEAVE_TIMEOUT = 2           # seconds to wait for a draining server to acknowledge what we sent before leaving it
+
+
+class Transport:
+    '''
+    Connection to the relay, putting received messages on queue. error_callback(message) is called
+    when the connection breaks, and when reconnect_attempts attempts in a row failed (None keeps trying).
+    '''
+    def __init__(self, queue, error_callback, compression=True, max_frame=framing.MAX_FRAME_BYTES,
+                 heartbeat_interval=framing.HEARTBEAT_INTERVAL, idle_timeout=framing.IDLE_TIMEOUT,
+                 reconnect_attempts=None):
+        self.queue = queue                  # asyncio.Queue of (username, message)
+        self.error_callback = error_callback
+        self.compression = compression
+        self.max_frame = max_frame          # longest frame accepted from the server
+        self.heartbeat_interval = heartbeat_interval    # v2: seconds of silence before the server is pinged, 0 disables
+        self.idle_timeout = idle_timeout    # v2: seconds of silence before the connection is given up
+        self.reconnect_attempts = reconnect_attempts
+        self.reader = None
+        self.writer = None
+        self.version = None
+        self.address = None                 # (ip, port, username, role, version) to reconnect to
+        self.sender_id = None               # v2: our own sender id assigned by the server
+        self.peers = {}                     # v2: sender id -> username announced by the server
+        self.codec = None                   # v2: framing.Codec agreed with the server
+        self.server_max_frame = None        # v2: longest frame the server accepts from us
+        self.server_lanes = False           # v2: the server takes the BULK flag
+        self.registered = set()             # verkeys registered with the server, again after a reconnect
+        self.streams = {}                   # v2: stream id -> {'username', 'queue', 'role', 'verkeys'} of hosted identities
+        self.stream_ids = itertools.count(1)
+        self.compression_stats = {          # for compression_report()
+            'compressed_in': 0, 'compressed_out': 0, 'compress_seconds': 0.0,
+            'decompressed_in': 0, 'decompressed_out': 0, 'decompress_seconds': 0.0,
+        }
+        # per lane: (frame type, payload, future set once written, stream id or None) of frames to send
+        self.outbox = [collections.deque() for _ in framing.LANES]
+        self.queued_bytes = 0
+        self.pending = asyncio.Event()      # set while frames are queued
+        self.writable = asyncio.Event()     # set while less than HIGH_WATER bytes are queued
+        self.writable.set()
+        self.session = None                 # v2: session token, None if the server keeps no session for us
+        self.resumed = False                # v2: the server resumed our session on the current connection
+        self.received = 0                   # v2: DATA frames received in the session
+        self.acked = 0                      # v2: received count last acknowledged to the server
+        self.sent = 0                       # v2: DATA frames written in the session
+        self.unacked = collections.deque()  # v2: (seq, lane, payload, future) written but not acknowledged yet
+        self.ack_handle = None
+        self.last_heard = 0
+        self.tasks = []                     # tasks of the current connection
+        self.reconnecting = None            # task reconnecting after the connection broke
+        self.closing = False                # closed by us, no reconnecting
+        self.leaving = False                # leaving a draining server, messages wait for the next one
+
+    async def connect(self, ip, port, username, role=None, version=2):
+        '''
+        Connect to the server. Protocol v2 is tried first and the legacy protocol is used if the server
+        does not answer the v2 handshake. ip may also be a unix:///path URL, port is then ignored.
+        '''
+        self.address = (ip, port, username, role, version)
+        self.closing = False
+        await self._connect()
+
+    async def _connect(self):
+        ip, port, username, role, version = self.address
+        await self._open()
+        if version == 2:
+            if await self._negotiate_v2():
+                self._start()
+                return
+            if self.version == 2:
+                # the server spoke v2 before, it is not ready yet
+                self.writer.close()
+                raise ConnectionError('No WELCOME from the server')
+            print('Server does not support protocol v2, using legacy protocol')
+            self.writer.close()
+            await self._open()
+        self.version = 1
+        self.session = None
+        self.resumed = False
+        name = username.encode('utf-8')
+        self.writer.write(framing.encode_header(len(name)) + name)
+        self._start()
+
+    async def _open(self):
+        ip, port = self.address[:2]
+        if ip.startswith(UNIX_SCHEME):
+            self.reader, self.writer = await asyncio.open_unix_connection(ip[len(UNIX_SCHEME):])
+        else:
+            self.reader, self.writer = await asyncio.open_connection(ip, port)
+            sock = self.writer.get_extra_info('socket')
+            # frames are written together by one task, Nagle would only delay them further
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.last_heard = time.monotonic()
+
+    async def _negotiate_v2(self):
+        '''
+        Send the v2 magic and HELLO asking for a session (or to resume ours), and wait for the server's
+        WELCOME
+        '''
+        username, role = self.address[2:4]
+        hello = {'username': username, 'max_frame': self.max_frame, 'session': self.session or ''}
+        if self.session:
+            hello['received'] = self.received
+        if role:
+            hello['role'] = role
+        if self.compression:
+            hello['compression'] = list(framing.CODECS)
+        self.writer.write(framing.V2_MAGIC + framing.encode_v2_frame(framing.HELLO, json.dumps(hello).encode('utf-8')))
+        try:
+            header = await asyncio.wait_for(self.reader.readexactly(framing.V2_HEADER.size), NEGOTIATION_TIMEOUT)
+            length, frame_type, my_id = framing.V2_HEADER.unpack(header)
+            if frame_type != framing.WELCOME or length > self.max_frame:
+                return False
+            welcome = json.loads(await self.reader.readexactly(length))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, ValueError):
+            return False
+        self.version = 2
+        self.sender_id = my_id
+        self.peers.clear()
+        chosen = welcome.get('compression')
+        self.codec = framing.CODECS[chosen]() if chosen in framing.CODECS else None
+        self.server_max_frame = welcome.get('max_frame')
+        self.server_lanes = bool(welcome.get('lanes'))
+        self._start_session(welcome)
+        return True
+
+    def _start_session(self, welcome):
+        '''
+        Set up the session named in WELCOME. Messages the server did not get are queued again, ahead of
+        the ones not sent yet.
+        '''
+        self.resumed = bool(welcome.get('resumed'))
+        if self.resumed:
+            # the server sends what we did not acknowledge, starting after frame number seq, and counts
+            # on from the frames of ours it received
+            self.received = self.acked = welcome.get('seq', 0)
+            resend = [frame for frame in self.unacked if frame[0] > welcome.get('received', 0)]
+            self.sent = welcome.get('received', 0)
+        else:
+            self.received = self.acked = self.sent = 0
+            resend = list(self.unacked)
+        self.unacked.clear()
+        self.session = welcome.get('session')
+        for _, lane, payload, future in reversed(resend):
+            self.outbox[lane].appendleft((framing.DATA, payload, future, None))
+            self.queued_bytes += len(payload)
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        self.leaving = False
+        self.tasks = [loop.create_task(self._read()), loop.create_task(self._write())]
+        if self.version == 2 and self.heartbeat_interval:
+            self.tasks.append(loop.create_task(self._heartbeat()))
+        # frames of the control lane belonged to the old connection, registrations are sent again, and
+        # streams are opened again before their frames
+        control = self.outbox[framing.LANE_CONTROL]
+        self.queued_bytes -= sum(len(frame[1]) for frame in control)
+        control.clear()
+        if self.version != 2:
+            self.streams.clear()
+        for lane, frames in enumerate(self.outbox):
+            # frames of streams closed while the connection was down
+            gone = [frame for frame in frames if frame[3] is not None and frame[3] not in self.streams]
+            if gone:
+                self.queued_bytes -= sum(len(frame[1]) for frame in gone)
+                self.outbox[lane] = collections.deque(
+                    frame for frame in frames if frame[3] is None or frame[3] in self.streams)
+        if self.registered:
+            self._register(self.registered)
+        for stream, info in self.streams.items():
+            self._open_stream(stream)
+            if info['verkeys']:
+                self._register(info['verkeys'], stream)
+        self.pending.set()
+
+    def _stop(self):
+        for task in self.tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self.tasks = []
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        if self.writer is not None:
+            self.writer.close()
+
+    async def close(self):
+        self.closing = True
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+            self.reconnecting = None
+        self._stop()
+
+    def _lost(self, exc, delay=None):
+        '''
+        The connection broke: reconnect after delay seconds, or the backoff if None
+        '''
+        if self.closing or self.reconnecting is not None:
+            return
+        self._stop()
+        if exc is not None:
+            self.error_callback('Connection lost: {}'.format(exc))
+        self.reconnecting = asyncio.get_running_loop().create_task(self._reconnect(delay))
+
+    async def _reconnect(self, delay=None):
+        '''
+        Connect again with a jittered exponential backoff, so clients cut off together do not all come
+        back at the same moment
+        '''
+        backoff = RECONNECT_DELAY
+        attempt = 0
+        while True:
+            await asyncio.sleep(delay if delay is not None else backoff * random.uniform(0.5, 1.5))
+            delay = None
+            try:
+                await self._connect()
+                break
+            except OSError as e:
+                attempt += 1
+                print('Reconnecting to the server failed: {}'.format(e))
+                if self.reconnect_attempts is not None and attempt >= self.reconnect_attempts:
+                    self.error_callback('Cannot reconnect to the server: {}'.format(e))
+                    self.reconnecting = None
+                    return
+                backoff = min(backoff * 2, RECONNECT_MAX_DELAY)
+        print('Reconnected to the server' + (', session resumed' if self.resumed else ''))
+        self.reconnecting = None
+
+    # Sending
+
+    def _queue_frame(self, frame_type, payload, lane, future=None, stream=None):
+        self.outbox[lane].append((frame_type, payload, future, stream))
+        self.queued_bytes += len(payload)
+        self.pending.set()
+        if self.queued_bytes >= HIGH_WATER:
+            self.writable.clear()
+
+    def _next_frames(self):
+        '''
+        Frames to write next: every frame waiting in the highest lane that has any, but only one bulk
+        frame at a time so frames of the other lanes queued meanwhile do not wait for all of them
+        '''
+        for lane, frames in enumerate(self.outbox):
+            if frames:
+                break
+        else:
+            return []
+        if self.leaving and lane != framing.LANE_CONTROL:
+            return []
+        return [(lane,) + frames.popleft() for _ in range(1 if lane == framing.LANE_BULK else len(frames))]
+
+    def _encode(self, lane, frame_type, payload, stream):
+        if self.version != 2:
+            return [framing.encode_header(len(payload)), payload]
+        if frame_type == framing.DATA:
+            if lane == framing.LANE_BULK and self.server_lanes:
+                frame_type |= framing.BULK
+            if self.codec is not None and len(payload) >= framing.COMPRESS_MIN_BYTES:
+                start = time.process_time()
+                compressed = self.codec.compress(payload)
+                self.compression_stats['compress_seconds'] += time.process_time() - start
+                self.compression_stats['compressed_in'] += len(payload)
+                self.compression_stats['compressed_out'] += len(compressed)
+                if len(compressed) < len(payload):
+                    frame_type |= framing.COMPRESSED
+                    payload = compressed
+        if stream is not None:
+            return [framing.encode_stream_header(frame_type, stream, len(payload)), payload]
+        return [framing.encode_v2_header(frame_type, len(payload)), payload]
+
+    async def _write(self):
+        while True:
+            await self.pending.wait()
+            frames = self._next_frames()
+            if not frames:
+                self.pending.clear()
+                continue
+            if self.writer.is_closing():
+                self._unwritten(frames, False)
+                self._lost(ConnectionError('Connection closed'))
+                return
+            parts = []
+            for lane, frame_type, payload, future, stream in frames:
+                parts += self._encode(lane, frame_type, payload, stream)
+                if frame_type == framing.DATA and stream is None and self.session:
+                    # numbered in the order they go out, streams are not part of the session
+                    self.sent += 1
+                    self.unacked.append((self.sent, lane, payload, future))
+                    if len(self.unacked) > MAX_UNACKED:
+                        self.unacked.popleft()
+            try:
+                self.writer.writelines(parts)
+                await self.writer.drain()
+            except (OSError, asyncio.CancelledError) as e:
+                self._unwritten(frames, True)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._lost(e)
+                return
+            self._done(frames)
+
+    def _unwritten(self, frames, numbered):
+        '''
+        The connection broke while writing frames. Messages may not have gone out: the session sends them
+        again if they were numbered, otherwise they go back to the front of the queue.
+        '''
+        for lane, frame_type, payload, future, stream in reversed(frames):
+            if frame_type == framing.DATA and not (numbered and self.session and stream is None):
+                self.outbox[lane].appendleft((frame_type, payload, future, stream))
+            else:
+                self.queued_bytes -= len(payload)
+
+    def _done(self, frames):
+        for _, _, payload, future, _ in frames:
+            self.queued_bytes -= len(payload)
+            if future is not None and not future.done():
+                future.set_result(None)
+        if self.queued_bytes < HIGH_WATER:
+            self.writable.set()
+
+    async def drain(self):
+        '''
+        Wait until less than HIGH_WATER bytes are waiting to be sent
+        '''
+        await self.writable.wait()
+
+    async def send(self, message, lane=None, stream=None):
+        '''
+        Queue a message in the given lane (framing.LANE_INTERACTIVE or LANE_BULK, by default picked from
+        its size), from the identity of the given stream (see open_stream) or our own, waiting while too
+        much is queued. Returns a future set once the message is written to the socket; it stays queued
+        while the connection is down. Without a session (legacy protocol, or a server keeping none) a
+        message written just before the connection broke may still be lost, as nothing tells which ones
+        the server got. A message longer than the server accepts raises ValueError.
+        '''
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        if self.version == 2 and self.server_max_frame is not None and len(message) > self.server_max_frame:
+            raise ValueError('Message of {} bytes is over the server\'s limit of {}'.format(
+                len(message), self.server_max_frame))
+        if lane is None:
+            lane = framing.LANE_BULK if len(message) >= framing.BULK_BYTES else framing.LANE_INTERACTIVE
+        written = asyncio.get_running_loop().create_future()
+        self._queue_frame(framing.DATA, message, lane, written, stream)
+        await self.drain()
+        return written
+
+    def register(self, verkeys, stream=None):
+        '''
+        Tell the server which verkeys belong to us (or to the identity of the given stream) so it only
+        forwards messages packed for them
+        '''
+        if not verkeys:
+            return
+        if stream is not None:
+            self.streams[stream]['verkeys'].update(verkeys)
+        else:
+            self.registered.update(verkeys)
+        self._register(verkeys, stream)
+
+    def _register(self, verkeys, stream=None):
+        # legacy servers take the control message as a message frame
+        self._queue_frame(framing.CONTROL, framing.encode_control(framing.REGISTER, verkeys=list(verkeys)),
+                          framing.LANE_CONTROL, stream=stream)
+
+    def open_stream(self, username, queue, role=None):
+        '''
+        v2: host another identity on this connection, so many agents of one process share a socket.
+        Messages for the verkeys registered with register(verkeys, stream) are put on queue instead of
+        the transport's. Returns the stream id to pass to send, register and close_stream.
+        '''
+        if self.version != 2:
+            raise ConnectionError('Hosting several identities needs protocol v2')
+        stream = next(self.stream_ids)
+        self.streams[stream] = {'username': username, 'queue': queue, 'role': role, 'verkeys': set()}
+        self._open_stream(stream)
+        return stream
+
+    def _open_stream(self, stream):
+        hello = {'username': self.streams[stream]['username']}
+        if self.streams[stream]['role']:
+            hello['role'] = self.streams[stream]['role']
+        self._queue_frame(framing.OPEN, json.dumps(hello).encode('utf-8'), framing.LANE_CONTROL, stream=stream)
+
+    def close_stream(self, stream):
+        '''
+        The identity of the stream leaves, the server keeps its messages in the mailbox
+        '''
+        if self.streams.pop(stream, None) is not None:
+            # lowest lane, so it follows whatever the stream sent before
+            self._queue_frame(framing.CLOSE, b'', framing.LANE_BULK, stream=stream)
+
+    def compression_report(self):
+        '''
+        Compression ratios (compressed size / original size) and CPU seconds spent on compression so far
+        '''
+        stats = dict(self.compression_stats)
+        stats['codec'] = self.codec.name if self.codec is not None else None
+        stats['sent_ratio'] = stats['compressed_out'] / stats['compressed_in'] if stats['compressed_in'] else None
+        stats['received_ratio'] = (stats['decompressed_in'] / stats['decompressed_out']
+                                   if stats['decompressed_out'] else None)
+        return stats
+
+    def _acknowledge(self):
+        '''
+        Acknowledge the DATA frames received so far right away once enough are unacknowledged, otherwise shortly
+        '''
+        if self.received - self.acked >= framing.ACK_EVERY:
+            self._send_ack()
+        elif self.ack_handle is None:
+            self.ack_handle = asyncio.get_running_loop().call_later(framing.ACK_DELAY, self._send_ack)
+
+    def _send_ack(self):
+        '''
+        Acknowledge the DATA frames received so far. Returns a future set once the ACK is written, None
+        if there was nothing to acknowledge.
+        '''
+        if self.ack_handle is not None:
+            self.ack_handle.cancel()
+            self.ack_handle = None
+        if self.session and self.received != self.acked:
+            self.acked = self.received
+            written = asyncio.get_running_loop().create_future()
+            self._queue_frame(framing.ACK, framing.ACK_PAYLOAD.pack(self.acked), framing.LANE_CONTROL, written)
+            return written
+        return None
+
+    def _acked(self, seq):
+        while self.unacked and self.unacked[0][0] <= seq:
+            self.unacked.popleft()
+
+    # Receiving
+
+    async def _read_frame(self, length):
+        if length > self.max_frame:
+            raise framing.FrameError('Frame of {} bytes is over the limit of {}'.format(length, self.max_frame))
+        return await self.reader.readexactly(length)
+
+    async def _read(self):
+        try:
+            while True:
+                if self.version == 2:
+                    received = await self._read_v2()
+                    if received is None:
+                        continue
+                    queue, message = received
+                else:
+                    username_length = framing.decode_header(await self.reader.readexactly(framing.HEADER_LENGTH))
+                    username = (await self._read_frame(username_length)).decode('utf-8')
+                    message_length = framing.decode_header(await self.reader.readexactly(framing.HEADER_LENGTH))
+                    queue, message = self.queue, (username, await self._read_frame(message_length))
+                await queue.put(message)
+        except asyncio.IncompleteReadError:
+            self._lost(ConnectionError('Connection closed by the server'))
+        except (OSError, ValueError, framing.FrameError) as e:
+            self._lost(e)
+
+    async def _read_v2(self):
+        '''
+        Read one v2 frame. Returns (queue, (username, message)) for a message, None for any other frame.
+        '''
+        length, frame_type, from_id = framing.V2_HEADER.unpack(await self.reader.readexactly(framing.V2_HEADER.size))
+        stream = None
+        if frame_type & framing.STREAM:
+            # read apart from the message, so the message is not copied to cut it off
+            if length < framing.STREAM_ID.size:
+                raise framing.FrameError('Stream frame of {} bytes'.format(length))
+            stream, = framing.STREAM_ID.unpack(await self.reader.readexactly(framing.STREAM_ID.size))
+            length -= framing.STREAM_ID.size
+            frame_type &= ~framing.STREAM
+        payload = await self._read_frame(length)
+        self.last_heard = time.monotonic()
+        if frame_type & framing.COMPRESSED and self.codec is not None:
+            start = time.process_time()
+            compressed, payload = payload, self.codec.decompress(payload, self.max_frame)
+            self.compression_stats['decompress_seconds'] += time.process_time() - start
+            self.compression_stats['decompressed_in'] += len(compressed)
+            self.compression_stats['decompressed_out'] += len(payload)
+            frame_type &= ~framing.COMPRESSED
+        if frame_type == framing.PEER:
+            self.peers[from_id] = payload.decode('utf-8')
+        elif frame_type == framing.ACK:
+            self._acked(framing.ACK_PAYLOAD.unpack(payload)[0])
+        elif frame_type == framing.PING:
+            self._queue_frame(framing.PONG, payload, framing.LANE_CONTROL)
+        elif frame_type == framing.DRAIN:
+            # reconnect at a random moment within the given seconds, reaching the relay taking over
+            within = json.loads(payload).get('reconnect_within', 0)
+            asyncio.get_running_loop().call_later(random.uniform(0, within), self._move, self.writer)
+        elif frame_type == framing.DATA and stream is not None:
+            # message for one of the identities hosted on this connection
+            if stream in self.streams:
+                return self.streams[stream]['queue'], (self.peers.get(from_id, str(from_id)), payload)
+        elif frame_type == framing.DATA:
+            if self.session:
+                self.received += 1
+                self._acknowledge()
+            return self.queue, (self.peers.get(from_id, str(from_id)), payload)
+        return None
+
+    def _move(self, writer):
+        if writer is self.writer:
+            self.tasks.append(asyncio.get_running_loop().create_task(self._leave(writer)))
+
+    async def _leave(self, writer):
+        '''
+        Leave a draining server for the one taking over. Our messages wait for the next server until
+        this one acknowledged the ones it got (or LEAVE_TIMEOUT passed), so they are not sent twice.
+        Then we stop reading and acknowledge every message we took: the server hands only the others
+        to the next one.
+        '''
+        self.leaving = True
+        deadline = time.monotonic() + LEAVE_TIMEOUT
+        while self.unacked and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.tasks[0].cancel()      # the reading task
+        written = self._send_ack()
+        if written is not None:
+            await asyncio.wait([written], timeout=max(deadline - time.monotonic(), 0.1))
+        if writer is self.writer:
+            self._lost(None, delay=0)
+
+    async def _heartbeat(self):
+        '''
+        Ping the server once nothing was heard from it for heartbeat_interval seconds, and drop the
+        connection once nothing was heard for idle_timeout
+        '''
+        while True:
+            await asyncio.sleep(min(self.heartbeat_interval, self.idle_timeout) / 2)
+            idle = time.monotonic() - self.last_heard
+            if idle >= self.idle_timeout:
+                self._lost(ConnectionError('Nothing heard from the server for {:.0f}s'.format(idle)))
+                return
+            if idle >= self.heartbeat_interval:
+                self._queue_frame(framing.PING, b'', framing.LANE_CONTROL)